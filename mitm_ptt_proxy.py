@@ -29,6 +29,10 @@ from mitmproxy.proxy.layers.websocket import WebSocketMessageInjected, Websocket
 from mitmproxy.proxy import events, layer
 
 import ptt_proxy
+import ptt_log
+from ptt_stats import latency
+
+log = ptt_log.getLogger("master")
 
 # handler = on_signal()
 @dataclass
@@ -120,7 +124,7 @@ class myDumpMaster(DumpMaster):
         if not isinstance(flow, http.HTTPFlow) or not flow.websocket:
             self.log.warn("Cannot inject WebSocket messages into non-WebSocket flows.")
 
-        print("self-injected, to_client:", to_client, len(message))
+        log.debug("self-injected, to_client: %s %d", to_client, len(message))
         msg = webSocketMessage(
             Opcode.TEXT if is_text else Opcode.BINARY,
             not to_client,
@@ -135,7 +139,7 @@ class myDumpMaster(DumpMaster):
 
     def sendToServer(self, flow, data):
         assert isinstance(data, bytes)
-        print("sendToServer:", data)
+        log.debug("sendToServer: %s", data)
         to_client = False
         is_text = False
         self.proxyserver.inject_websocket(flow, to_client, data, is_text)
@@ -143,7 +147,7 @@ class myDumpMaster(DumpMaster):
 
     def sendToClient(self, flow, data):
         assert isinstance(data, bytes)
-        print("sendToClient:", len(data))
+        log.debug("sendToClient: %d", len(data))
         to_client = True
         is_text = False
         self.inject_websocket(flow, to_client, data, is_text)
@@ -153,7 +157,7 @@ class myDumpMaster(DumpMaster):
         marklen = len(self.injected_mark)
         if len(flow_msg.content) > marklen and flow_msg.content[:marklen] == self.injected_mark:
             flow_msg.content = flow_msg.content[marklen:]
-            print("self-injected, from_client:", flow_msg.from_client, len(flow_msg.content), flow_msg.timestamp)
+            log.debug("self-injected, from_client: %s %d %s", flow_msg.from_client, len(flow_msg.content), flow_msg.timestamp)
             return True
         return False
 
@@ -203,18 +207,33 @@ class myDumpMaster(DumpMaster):
 
         yield from self.wsl_relay_messages(event)
 
+    # e.g. ":.setLogLevel('DEBUG')" to see every segment and keystroke
+    def setLogLevel(self, level):
+        ptt_log.setLevel(level)
+        print("log level:", ptt_log.getLevel())
+
+    # latency histograms of the proxy stages, e.g. ":.showLatency('feed')"
+    def showLatency(self, stage=None):
+        latency.show(stage)
+
+    def resetLatency(self, stage=None):
+        latency.reset(stage)
+
+    # e.g. ":.saveSnapshot()" to restore the sessions after a restart
+    def saveSnapshot(self):
+        self.ptt_proxy.addons[0].saveSnapshot()
+
     def reload_ptt_proxy(self):
         from importlib import reload
 
         self.addons.remove(self.ptt_proxy)
 
         oldproxy = self.ptt_proxy.addons[0]
-        oldterm = self.ptt_proxy.pttTerm
 
         self.ptt_proxy = reload(ptt_proxy)
 
         self.addons.add(self.ptt_proxy)     # invoke LoadHook
-        self.ptt_proxy.reload(oldproxy, oldterm)
+        self.ptt_proxy.reload(oldproxy)
 
     async def conn_watcher(self):
         from mitmproxy.proxy.server import TimeoutWatchdog
@@ -253,6 +272,8 @@ class myDumpMaster(DumpMaster):
                 ":.reload_ptt_proxy()"
 
             Please don't delete 'ptt_proxy' from sys.modules. Doing so causes error.
+        6. switch the log level, e.g. ":.setLogLevel('DEBUG')", the hot path logs in DEBUG only
+        7. show or reset latency histograms added by the proxy, ":.showLatency()" or ":.resetLatency()"
     '''
     cmd_formats = {'.':  "self.{data}",
                    '?':  "print(self.{data})",
@@ -0,0 +1,478 @@
+import re
+import sys
+import time
+
+from uao import register_uao
+register_uao()
+
+from ptt_buffer import SegmentBuffer
+
+'''
+    Micro benchmarks of the hot paths in the proxy.
+    Run all of them or the named ones, e.g. "python ptt_bench.py segment_buffer"
+'''
+
+SEGMENT_SIZE = 1021     # the size of a full WebSocket segment from the PTT server
+
+def timeit(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+SAMPLE_URL = "https://www.ptt.cc/bbs/Test/M.1600000000.A.123.html"
+
+# the n-th line of a sample article with ANSI colors, pushes follow the URL line
+def sampleLine(n: int):
+    header = {1: " 作者  tester (測試者)                                          看板  Test",
+              2: " 標題  [測試] 範例文章",
+              3: " 時間  Sun Sep 13 20:26:40 2020",
+              10: "--",
+              11: "※ 發信站: 批踢踢實業坊(ptt.cc), 來自: 127.0.0.1 (臺灣)",
+              12: "※ 文章網址: " + SAMPLE_URL}
+    if n in header: return header[n]
+    if n < 10:
+        return f"文章內容第 {n} 行 content line {n} with some ASCII text"
+    push = "推噓→"[n % 3]
+    return f"\x1b[1;37m{push} \x1b[33muser{n:05d}\x1b[m\x1b[33m: 這是第 {n} 行的推文內容，測試雙位元組字元\x1b[m   03/04 12:34"
+
+def samplePage(lines: int, first=1, rows=32):
+    '''
+        A page of the article browser redrawn line by line as the server does, i.e.
+        cursor positioning, colored push messages and double-byte characters.
+        Lines more than a screen are drawn over and over for a large page.
+    '''
+    page = "\x1b[H\x1b[2J"
+    for n in range(first, first + lines):
+        row = (n - first) % (rows - 1) + 1
+        page += f"\x1b[{row};1H{sampleLine(n)}\x1b[K"
+    last = first + min(lines, rows - 1) - 1
+    page += sampleStatus(first, last, rows)
+    return page.encode("big5uao", "replace")
+
+def sampleStatus(first: int, last: int, rows=32):
+    return f"\x1b[{rows};1H\x1b[34;46m 瀏覽 第 1/9 頁 ( 10%)  \x1b[1;30;47m 目前顯示: 第 {first:02}~{last:02} 行\x1b[m"
+
+# the article browser scrolled down by a line to show the line first at the top
+def sampleScroll(first: int, rows=32):
+    last = first + rows - 2
+    scroll = f"\x1b[{rows};1H\x1b[K\n\x1b[{rows - 1};1H{sampleLine(last)}\x1b[K" + sampleStatus(first, last, rows)
+    return scroll.encode("big5uao", "replace")
+
+def sampleBoard(rows=32):
+    board = "\x1b[H\x1b[2J\x1b[1;37;44m【板主:tester】          測試看板                  看板《Test》\x1b[m"
+    board += "\x1b[3;1H   編號    日 期 作  者       文  章  標  題"
+    for n in range(1, rows - 3):
+        board += f"\x1b[{n + 3};1H{'>' if n == 1 else ' '}{n:6}   3/04 user{n:05d}    □ [測試] 第 {n} 篇文章"
+    board += f"\x1b[{rows};1H\x1b[34;46m 文章選讀 \x1b[30;47m (y)回應(X)推文(^X)轉錄 (=[]<>)相關主題\x1b[m"
+    return board.encode("big5uao", "replace")
+
+def samplePanel(rows=32):
+    panel = "\x1b[H\x1b[2J\x1b[1;37;44m【主功能表】                    批踢踢實業坊\x1b[m"
+    for n, item in enumerate(["(F)avorite   【 我 的 最愛 】", "(C)lass      【 分組討論區 】",
+                              "(M)ail       【 私人信件區 】", "(G)oodbye    【 離開，再見 】"], 5):
+        panel += f"\x1b[{n};20H{item}"
+    panel += f"\x1b[{rows};1H\x1b[34;46m [3/4 星期三 12:34]\x1b[m"
+    return panel.encode("big5uao", "replace")
+
+def sampleWaiting(rows=32):
+    return b"\x1b[H\x1b[2J" + f"\x1b[{rows};1H\x1b[1;34;44m  ▌ 請按任意鍵繼續 ▐\x1b[m".encode("big5uao", "replace")
+
+# a screen drawn with the data
+def drawScreen(data: bytes, screenClass=None, columns=128, rows=32):
+    import pyte
+    from ptt_term import PttTerm
+    screen = (screenClass or PttTerm.screenClass)(columns, rows)
+    stream = pyte.Stream()
+    stream.attach(screen)
+    stream.feed(data.decode("big5uao", "replace"))
+    return screen
+
+# the lines of a screen drawn with the data
+def sampleScreen(data: bytes, columns=128, rows=32):
+    return drawScreen(data, None, columns, rows).display
+
+def segments(data: bytes, size=SEGMENT_SIZE):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+def bench_segment_buffer():
+    print("segment_buffer: queueing server segments, bytes concatenation vs SegmentBuffer")
+    for lines in [100, 1000, 10000]:
+        segs = segments(samplePage(lines))
+
+        def concat():
+            msgs = bytes()
+            for seg in segs:
+                msgs += seg
+            return msgs
+
+        def buffered():
+            msgs = SegmentBuffer()
+            for seg in segs:
+                msgs.append(seg)
+            return msgs.take()
+
+        assert concat() == buffered()
+        t_concat = timeit(concat)
+        t_buffered = timeit(buffered)
+        print(f"  {len(segs):6} segments {sum(map(len, segs)):9} bytes: "
+              f"concat {t_concat*1000:9.3f} ms, buffered {t_buffered*1000:9.3f} ms, "
+              f"x{t_concat/t_buffered:.1f}")
+
+def bench_classifier():
+    import re
+    from ptt_term import PttTerm
+
+    # the sequential matching PttTerm._refresh() used to do
+    def sequential(lines):
+        for input_pattern in [".+請?按.+鍵.*繼續", "請選擇", '搜尋.+', r'\s*★快速切換', r'\s*跳至第幾項:']:
+            if re.match(input_pattern, lines[-1]):
+                return PttTerm._State.Waiting, {}
+        for panel in ['【主功能表】', '【分類看板】', '【看板列表】', '【 選擇看板 】', '【個人設定】']:
+            if re.match(panel, lines[0]):
+                return PttTerm._State.InPanel, {'panel': panel}
+        if re.match(r"\s*文章選讀", lines[-1]):
+            board = re.search(r"^\s*【(板主:|徵求中).+(看板|系列|文摘)《([\w-]+)》\s*$", lines[0])
+            return PttTerm._State.InBoard, {'board': board.group(3) if board else None}
+        browse = re.match(r"\s*瀏覽.+\(\ *?(\d+)%\)\s+目前顯示: 第 (\d+)~(\d+) 行", lines[-1])
+        if browse:
+            fields = {'percent': int(browse.group(1)), 'firstLine': int(browse.group(2)),
+                      'lastLine': int(browse.group(3))}
+            board = re.match(r"\s+作者\s+.+看板\s+([\w-]+)\s*$", lines[0])
+            title = re.match(r"\s+標題\s+(\S.+)\s*$", lines[1])
+            fields.update({'board': board.group(1) if board else None, 'title': title.group(1) if title else None})
+            return PttTerm._State.InThread, fields
+        return PttTerm._State.Unknown, {}
+
+    print("classifier: classifying screens, sequential regexes vs ScreenClassifier")
+    screens = {'thread': sampleScreen(samplePage(31)), 'scrolled': sampleScreen(samplePage(31, 40)),
+               'board': sampleScreen(sampleBoard()), 'panel': sampleScreen(samplePanel()),
+               'waiting': sampleScreen(sampleWaiting()), 'unknown': sampleScreen(b"\x1b[H\x1b[2J")}
+    count = 10000
+    for name, lines in screens.items():
+        expected = sequential(lines)
+        assert PttTerm.classifier.classify(lines) == expected, (name, expected)
+        t_sequential = timeit(lambda: [sequential(lines) for _ in range(count)])
+        t_compiled = timeit(lambda: [PttTerm.classifier.classify(lines) for _ in range(count)])
+        print(f"  {name:10} {expected[0].name():9}: sequential {t_sequential/count*1000000:7.2f} us, "
+              f"compiled {t_compiled/count*1000000:7.2f} us, x{t_sequential/t_compiled:.1f}")
+
+# random text and sequences drawn on both screens give the same cells, attributes and cursor
+def compareScreens(screenClass, otherClass, count=300, seed=1):
+    import random
+    import pyte
+
+    pieces = ["abc", " ", "é", "\xa0", "作者", "→", "│", "推噓", "\r", "\n", "\b", "\t", "\x1b[K", "\x1b[1K",
+              "\x1b[2J", "\x1b[J", "\x1b[1;33;44m", "\x1b[7m", "\x1b[m", "\x1b[3X", "\x1b[2@", "\x1b[2P",
+              "\x1b[L", "\x1b[M", "\x1bD", "\x1bM", "\x1b[5;70r", "\x1b[r", "\x1b[4h", "\x1b[4l",
+              "\x1b[?7l", "\x1b[?7h", "\x1b7", "\x1b8", "\x1b(0", "\x1b(B", "lqk"]
+    rand = random.Random(seed)
+    skipped = 0
+    for i in range(count):
+        screens = [screenClass(80, 24), otherClass(80, 24)]
+        streams = []
+        for screen in screens:
+            stream = pyte.Stream()
+            stream.attach(screen)
+            streams.append(stream)
+        text = "".join(rand.choice(pieces) if rand.random() < 0.8 else
+                       f"\x1b[{rand.randint(1, 26)};{rand.randint(1, 82)}H" for _ in range(200))
+        try:
+            streams[0].feed(text)
+        except IndexError:
+            # the stock screen fails to erase with the cursor past the last column
+            skipped += 1
+            continue
+        streams[1].feed(text)
+        first, second = screens
+        assert first.display == second.display, (i, text)
+        assert first.buffer == second.buffer, (i, text)
+        assert (first.cursor.x, first.cursor.y) == (second.cursor.x, second.cursor.y), (i, text)
+    print(f"  {count - skipped} random sequences: {screenClass.__name__} and {otherClass.__name__} are the same")
+
+def bench_screen():
+    import tracemalloc
+    from ptt_term import MyScreen
+    from ptt_screen import CompactScreen
+
+    print("screen: the stock pyte screen (MyScreen) vs CompactScreen")
+    pages = {'thread': samplePage(31), 'board': sampleBoard(), 'panel': samplePanel()}
+    for name, page in pages.items():
+        for screenClass in [MyScreen, CompactScreen]:
+            tracemalloc.start()
+            screen = drawScreen(page, screenClass)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"  {name:8} {screenClass.__name__:14}: {size / 1024:8.1f} KiB per 128x32 screen")
+        assert drawScreen(page, MyScreen).display == drawScreen(page, CompactScreen).display
+    compareScreens(MyScreen, CompactScreen)
+
+    for lines in [31, 1000]:
+        text = samplePage(lines).decode("big5uao", "replace")
+        results = {}
+        for screenClass in [MyScreen, CompactScreen]:
+            import pyte
+            screen = screenClass(128, 32)
+            stream = pyte.Stream()
+            stream.attach(screen)
+            results[screenClass] = timeit(lambda: stream.feed(text))
+        t_stock, t_compact = results[MyScreen], results[CompactScreen]
+        print(f"  draw {len(text):7} chars: stock {len(text) / t_stock / 1000:8.1f} kchar/s, "
+              f"compact {len(text) / t_compact / 1000:8.1f} kchar/s, x{t_stock/t_compact:.2f}")
+
+    for screenClass in [MyScreen, CompactScreen]:
+        screen = drawScreen(samplePage(31), screenClass)
+        t = timeit(lambda: [screen.display for _ in range(100)])
+        print(f"  display {screenClass.__name__:14}: {t / 100 * 1000000:8.1f} us")
+
+def bench_lazy():
+    from ptt_term import PttTerm
+
+    print("lazy: feeding and classifying frames out of threads, full emulation vs lazy")
+    frames = {'board': sampleBoard(), 'panel': samplePanel(), 'waiting': sampleWaiting()}
+    count = 200
+    for name, frame in frames.items():
+        results = {}
+        for lazy in [False, True]:
+            term = PttTerm(128, 32)
+            term.lazy = lazy
+
+            def refresh():
+                for _ in range(count):
+                    term.feed(frame)
+                    term._refresh()
+            results[lazy] = timeit(refresh)
+            state = term._refresh()
+            # the screen emulated at last is the same
+            assert list(term.display) == sampleScreen(frame), name
+        t_full, t_lazy = results[False], results[True]
+        print(f"  {name:8} {state.name():8}: full {t_full/count*1000000:8.1f} us, "
+              f"lazy {t_lazy/count*1000000:8.1f} us, x{t_full/t_lazy:.1f}")
+
+def bench_overlay():
+    from ptt_term import PttTerm
+    from ptt_overlay import ScreenOverlay
+    from user_event import UserEvent
+
+    class Flow:
+        def __init__(self):
+            self.sent = 0
+        def sendToServer(self, data):
+            pass
+        def insertToClient(self, data):
+            self.sent += len(data)
+        def sendToClient(self, data):
+            self.sent += len(data)
+
+    print("overlay: floor numbers while scrolling a thread line by line, full redraw vs tracked overlay")
+    for pushes in [300, 3000]:
+        results = {}
+        for tracked in [False, True]:
+            term = PttTerm(128, 32)
+            term.overlay = ScreenOverlay(term.overlay.column, term.overlay.width, tracked)
+            flow = Flow()
+            term.flowStarted(flow, True)
+            # the lines of the article are seen before
+            for first in range(1, pushes, 31):
+                term.feed(samplePage(31, first))
+                term.post_refresh()
+            term.feed(samplePage(31))
+            term.post_refresh()
+            assert term.state == PttTerm._State.InThread
+            flow.sent = 0
+
+            t = time.perf_counter()
+            for first in range(2, pushes - 31):
+                term._userEvent = UserEvent.Key_Down
+                term.pre_update()
+                term.feed(sampleScroll(first))
+                term.post_refresh()
+            results[tracked] = (time.perf_counter() - t, flow.sent, first - 1)
+        (t_full, sent_full, count), (t_tracked, sent_tracked, _) = results[False], results[True]
+        print(f"  {count:5} lines: full {sent_full / count:6.1f} bytes {t_full / count * 1000000:7.1f} us, "
+              f"tracked {sent_tracked / count:6.1f} bytes {t_tracked / count * 1000000:7.1f} us per line")
+
+def bench_boardlist():
+    from ptt_boardlist import BoardIndex
+
+    print("boardlist: the rows of a board list scrolled row by row, parsing the lines vs BoardIndex")
+    rows = 28
+    count = 1000
+    def line(n):
+        return f" {n:6} {n % 100:2} 3/04 user{n:05d}    □ [測試] 第 {n} 篇文章" if n % 50 else \
+               f" {n:6}    -            □ (本文已被刪除) [user{n:05d}]"
+    screens = [["", "", ""] + [line(n) for n in range(first, first + rows)] + [""] for first in range(1, count)]
+
+    def parsing():
+        for lines in screens:
+            [BoardIndex.parseRow(l) for l in lines[3:-1]]
+    def indexed():
+        index = BoardIndex()
+        for lines in screens:
+            index.update("Test", lines)
+            [index.at(y) for y in range(3, len(lines) - 1)]
+        return index
+    t_parsing, t_indexed = timeit(parsing), timeit(indexed)
+    index = indexed()
+    assert [index.at(y) for y in range(3, rows + 3)] == [BoardIndex.parseRow(l) for l in screens[-1][3:-1]]
+    print(f"  {len(screens)} screens: parsing {t_parsing/len(screens)*1000000:7.1f} us, "
+          f"indexed {t_indexed/len(screens)*1000000:7.1f} us per screen, x{t_parsing/t_indexed:.1f}, "
+          f"{index.parses} lines parsed, deleted {sum(index.isDeleted(n) for n in range(1, count + rows))}")
+
+def bench_linestore():
+    from ptt_thread import PttThread
+    from ptt_linestore import LineStore
+
+    print("linestore: the memory of the lines and floors of a thread, lists vs LineStore and FloorIndex")
+    for pushes in [1000, 10000]:
+        # the text of the lines without colors as in PttThread
+        lines = [re.sub(r"\x1b\[[\d;]*m", "", sampleLine(n)) for n in range(1, pushes + 13)]
+        floors = [None] * 12 + list(range(1, pushes + 1))
+        listed = sys.getsizeof(lines) + sum(sys.getsizeof(line) for line in lines) + sys.getsizeof(floors) + \
+                 sum(sys.getsizeof(floor) for floor in floors[12:] if floor > 256)
+        thread = PttThread()
+        thread.view(lines, 1, len(lines), True)
+        store, index = thread.lines, thread.floors
+        stored = store.nbytes() + len(index.flags) + sys.getsizeof(index.pushes) + sys.getsizeof(index.known)
+        t_listed = timeit(lambda: [line for line in lines])
+        t_stored = timeit(lambda: [line for line in store])
+        assert list(store) == lines
+        print(f"  {len(lines):6} lines: lists {listed / 1024:8.1f} KiB, compact {stored / 1024:8.1f} KiB, "
+              f"x{listed / stored:.1f}; reading all lines {t_listed * 1000:.2f} ms vs {t_stored * 1000:.2f} ms")
+
+def bench_floors():
+    from ptt_thread import PttThread
+
+    print("floors: a thread viewed from the end page by page upwards, floors shown and the time per view")
+    for pushes in [1000, 10000]:
+        lines = [re.sub(r"\x1b\[[\d;]*m", "", sampleLine(n)) for n in range(1, pushes + 13)]
+        thread = PttThread()
+        thread.setURL(SAMPLE_URL)
+        shown = []
+        t = time.perf_counter()
+        for last in range(len(lines), 0, -31):
+            first = max(1, last - 30)
+            thread.view(lines[first-1:last], first, last, last == len(lines))
+            shown.append(sum(bool(thread.floor(n)) for n in range(first, last + 1)))
+        t = time.perf_counter() - t
+        floors = [thread.floor(n) for n in range(len(lines) - 2, len(lines) + 1)]
+        print(f"  {len(lines):6} lines: {t / len(shown) * 1000000:6.1f} us per view, "
+              f"floors shown {shown[0]} on the first view, {sum(shown)} in all, the last {floors}")
+
+def bench_width():
+    import ptt_width
+    from ptt_thread import PttThread
+
+    print("width: display widths of the lines of a CJK thread, encoding vs the table vs a batch")
+    # pushes and long lines wrapped at 78 columns
+    lines = [re.sub(r"\x1b\[[\d;]*m", "", sampleLine(n)) for n in range(13, 1013)]
+    lines += [("中文字" * 13 + "ab\\")[:n % 40 + 1] + "\\" for n in range(1000)]
+    expected = [len(line.encode("big5uao", "replace")) for line in lines]
+    assert [ptt_width.width(line) for line in lines] == expected == ptt_width.widths(lines)
+
+    count = len(lines)
+    t_encode = timeit(lambda: [len(line.encode("big5uao", "replace")) for line in lines])
+    t_table = timeit(lambda: [ptt_width.width(line) for line in lines])
+    t_batch = timeit(lambda: [ptt_width.widths(lines[i:i+31]) for i in range(0, count, 31)])
+    print(f"  {count} lines: encode {t_encode/count*1000000:5.2f} us, table {t_table/count*1000000:5.2f} us, "
+          f"batch{'' if ptt_width.numpy else ' (no NumPy)'} {t_batch/count*1000000:5.2f} us per line")
+
+    wrapped = [(len(line.encode("big5uao", "replace")) > 78 and line[-1] == '\\') for line in lines]
+    t_encode = timeit(lambda: [len(line.encode("big5uao", "replace")) > 78 and line[-1] == '\\' for line in lines])
+    t_rows = timeit(lambda: [PttThread.wrappedRows(lines[i:i+31]) for i in range(0, count, 31)])
+    assert [i in PttThread.wrappedRows(lines) for i in range(count)] == wrapped
+    print(f"  wrapped rows by pages: encode {t_encode/count*1000000:5.2f} us, "
+          f"wrappedRows() {t_rows/count*1000000:5.2f} us per line, x{t_encode/t_rows:.0f}")
+
+def bench_export():
+    import os
+    import tempfile
+    from ptt_thread import PttThread
+    from ptt_persist import PttPersist
+
+    print("export: the text of a thread, concatenating lines vs chunks, and saving line by line vs export()")
+
+    # the text() and saveContent() by lines before export()
+    def concatenated(thread):
+        text = ""
+        for line in thread.lines:
+            text += (line if line != thread.LINE_HOLDER else '') + '\n'
+        return text
+    def saveLines(thread, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            for line in thread.lines:
+                f.write((line if line != thread.LINE_HOLDER else '') + '\n')
+
+    with tempfile.TemporaryDirectory() as archive:
+        for pushes in [20000, 100000]:
+            thread = PttThread()
+            for n in range(1, pushes + 13):
+                thread.lines.append(re.sub(r"\x1b\[[\d;]*m", "", sampleLine(n)))
+            thread.lastLine = len(thread.lines)
+            filename = os.path.join(archive, "thread")
+            size = thread.export(lambda chunk: None) / 1024 / 1024
+            assert thread.text() == concatenated(thread)
+
+            t_concat = timeit(lambda: concatenated(thread), 3)
+            t_text = timeit(lambda: thread.text(), 3)
+            t_lines = timeit(lambda: saveLines(thread, filename), 3)
+            t_export = timeit(lambda: thread.saveContent(filename), 3)
+            print(f"  {size:5.1f} MB: text {size / t_concat:6.1f} MB/s by lines, {size / t_text:6.1f} MB/s by chunks; "
+                  f"save {size / t_lines:6.1f} MB/s by lines, {size / t_export:6.1f} MB/s by export()")
+
+        # a board of the threads saved
+        PttPersist.archive_dir, archive_dir = archive, PttPersist.archive_dir
+        try:
+            os.makedirs(os.path.join(archive, "Test"))
+            for i in range(10):
+                thread.saveContent(os.path.join(archive, "Test", f"thread{i}"))
+            with open(os.devnull, "wb") as devnull:
+                t = time.perf_counter()
+                size = PttPersist.exportBoards(devnull.write) / 1024 / 1024
+                t = time.perf_counter() - t
+        finally:
+            PttPersist.archive_dir = archive_dir
+        print(f"  archive {size:5.1f} MB: {size / t:6.1f} MB/s")
+
+def bench_pushes():
+    import os
+    import tempfile
+    from ptt_persist import PttPersist
+    from ptt_pushes import BoardPushes
+
+    print("pushes: a board of the archive parsed into columns in bulk and aggregated")
+    threads, pushes = 2000, 150
+    with tempfile.TemporaryDirectory() as archive:
+        os.makedirs(os.path.join(archive, "Test"))
+        for i in range(threads):
+            with open(os.path.join(archive, "Test", f"thread{i}"), "w", encoding="utf-8") as f:
+                for n in range(1, pushes + 13):
+                    f.write(re.sub(r"\x1b\[[\d;]*m", "", sampleLine(n + i % 7)) + "\n")
+
+        PttPersist.archive_dir, archive_dir = archive, PttPersist.archive_dir
+        try:
+            t = time.perf_counter()
+            board = BoardPushes.fromArchive("Test")
+            t_parse = time.perf_counter() - t
+        finally:
+            PttPersist.archive_dir = archive_dir
+        t = time.perf_counter()
+        summary = board.summary(3)
+        t_summary = time.perf_counter() - t
+
+    count = summary['pushes'] + summary['boos'] + summary['arrows']
+    print(f"  {threads} threads, {count} pushes: parsing {t_parse:.2f} s ({threads / t_parse:.0f} threads/s), "
+          f"aggregating {t_summary * 1000:.1f} ms; ratio {summary['ratio']:.2f}, top {summary['topUsers'][0]}")
+
+
+benches = {name[len("bench_"):]: func for name, func in list(globals().items()) if name.startswith("bench_")}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benches.keys())
+    for name in names:
+        if name not in benches:
+            print("Unknown bench:", name, "available:", list(benches.keys()))
+            continue
+        benches[name]()
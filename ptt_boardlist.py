@@ -0,0 +1,107 @@
+import re
+from collections import OrderedDict, namedtuple
+
+# a row of the board list, number is None for a sticky thread ('★') and push is -100~100,
+# clipped if the title may be clipped at the right of the screen
+BoardRow = namedtuple("BoardRow", "number push date author title deleted clipped")
+
+
+class BoardIndex:
+    '''
+        The rows of the board list parsed into BoardRow as the screen changes.
+
+        A line is parsed once however it's scrolled, the rows are cached by the line and by the number
+        of the current board. The rows on the screen are updated by update() with the dirty rows
+        or by comparing the lines, and looked up by at() and get() without parsing.
+    '''
+
+    MAX_ROWS = 1 << 12      # rows by the number of the current board
+    MAX_LINES = 1 << 10     # rows by the line
+    CLIPPED_SPACES = 2      # at the end of a row of a clipped title, a double-byte character doesn't fit the last column
+
+    # e.g. ">  1234 + 9  3/04 author       □ [分類] title", "   1235    -            □ (本文已被刪除) [author]"
+    re_row = re.compile(r"[\s>]*(?P<number>\d+|★)\s+(?P<mark>[+~mMsS!=*])?\s*(?P<push>爆|X[X\d]|\d+)?\s+"
+                        r"(?P<date>\d{1,2}/\d{1,2}|-)\s+(?P<author>[\w-]+)?\s*(?P<title>\S.*?)\s*$")
+    # (本文已被刪除) or (已被xxx刪除)
+    re_deleted = re.compile(r"□ \(.*已被.*刪除\)")
+
+    def __init__(self):
+        self.board = None
+        self.rows = OrderedDict()   # number -> BoardRow
+        self.parsed = {}    # line -> BoardRow or None
+        self.lines = []     # the lines on the screen
+        self.screen = []    # BoardRow or None of the lines
+        self.parses = 0
+
+    def clear(self):
+        self.board = None
+        self.rows.clear()
+        self.parsed.clear()
+        self.lines = []
+        self.screen = []
+
+    @staticmethod
+    def pushCount(push):
+        if not push: return 0
+        if push == '爆': return 100
+        if push == 'XX': return -100
+        if push[0] == 'X': return -10 * int(push[1])
+        return int(push)
+
+    @classmethod
+    def parseRow(cls, line: str):
+        m = cls.re_row.match(line)
+        if m is None: return None
+        number, date, title = m.group('number'), m.group('date'), m.group('title')
+        return BoardRow(int(number) if number != '★' else None, cls.pushCount(m.group('push')),
+                        date if date != '-' else None, m.group('author'), title,
+                        date == '-' or cls.re_deleted.match(title) is not None,
+                        len(line) - len(line.rstrip()) <= cls.CLIPPED_SPACES)
+
+    def row(self, line: str):
+        row = self.parsed.get(line, False)
+        if row is False:
+            if len(self.parsed) >= self.MAX_LINES: self.parsed.clear()
+            row = self.parsed[line] = self.parseRow(line)
+            self.parses += 1
+        return row
+
+    def update(self, board: str, lines, dirty=None):
+        '''
+            Updates the rows of the lines changed, all lines are compared if dirty is None.
+        '''
+        if board != self.board:
+            self.clear()
+            self.board = board
+        if len(lines) != len(self.lines):
+            self.lines = [None] * len(lines)
+            self.screen = [None] * len(lines)
+            dirty = None
+
+        for y in (range(len(lines)) if dirty is None else dirty):
+            if y >= len(lines): continue
+            line = lines[y]
+            if line == self.lines[y]: continue
+            self.lines[y] = line
+            row = self.screen[y] = self.row(line)
+            if row is not None and row.number is not None:
+                self.rows[row.number] = row
+                self.rows.move_to_end(row.number)
+                if len(self.rows) > self.MAX_ROWS:
+                    self.rows.popitem(last=False)
+
+    # the row on the screen, 0-based
+    def at(self, y: int):
+        return self.screen[y] if 0 <= y < len(self.screen) else None
+
+    # the rows on the screen in [begin, end), None if a line isn't a row
+    def onScreen(self, begin=0, end=None):
+        return self.screen[begin:end]
+
+    # the row of the number seen on the current board
+    def get(self, number: int):
+        return self.rows.get(number)
+
+    def isDeleted(self, number: int):
+        row = self.rows.get(number)
+        return row is not None and row.deleted
@@ -0,0 +1,47 @@
+# A byte buffer which queues segments without copying.
+# Appending bytes to bytes copies everything buffered so far, so a screen of many 1021-byte segments costs
+# quadratic time. Segments here are only referenced, and joined once when the buffer is taken.
+class SegmentBuffer:
+
+    def __init__(self, data: bytes = None):
+        self.segments = []
+        self.size = 0
+        if data: self.append(data)
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __repr__(self):
+        return f"{type(self).__name__}(segments: {len(self.segments)}, size: {self.size})"
+
+    def append(self, data: bytes):
+        if data:
+            self.segments.append(data)
+            self.size += len(data)
+
+    def prepend(self, data: bytes):
+        if data:
+            self.segments.insert(0, data)
+            self.size += len(data)
+
+    def clear(self):
+        self.segments = []
+        self.size = 0
+
+    def isSegmented(self):
+        return len(self.segments) > 1
+
+    # join all segments and leave the buffer untouched
+    def join(self):
+        if len(self.segments) == 1:
+            return bytes(self.segments[0])
+        return b''.join(self.segments)
+
+    # join all segments and clear the buffer
+    def take(self):
+        data = self.join()
+        self.clear()
+        return data
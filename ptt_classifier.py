@@ -0,0 +1,57 @@
+import re
+
+
+class ScreenClassifier:
+    '''
+        Classifies a screen by a table of entries in the order of priority, e.g.
+
+            {'state': InThread, 'row': -1, 'pattern': "瀏覽.+第 (?P<first>[0-9]+)~", 'ints': ['first'],
+             'fields': {'board': (0, "作者.+看板 (?P<board>.+)")}}
+
+        The patterns of the same row are compiled once into an alternation, so a row is matched once
+        no matter how many entries there are. Named groups of the matched entry are its fields,
+        and 'fields' are extracted from the other rows only for the matched entry.
+    '''
+
+    re_group = re.compile(r"\(\?P<(\w+)>")
+
+    def __init__(self, table, default=None):
+        self.default = default
+        self.entries = []
+        patterns = {}   # row -> (index of the first entry, [pattern])
+        for i, entry in enumerate(table):
+            pattern = self.re_group.sub(lambda m: f"(?P<e{i}_{m.group(1)}>", entry['pattern'])
+            patterns.setdefault(entry['row'], (i, []))[1].append(f"(?P<e{i}>{pattern})")
+
+            fields = {name: (row, re.compile(field)) for name, (row, field) in entry.get('fields', {}).items()}
+            groups = self.re_group.findall(entry['pattern'])
+            self.entries.append((entry['state'], entry['row'], groups, set(entry.get('ints', [])), fields))
+
+        # rows in the order of their first entries, a row is skipped if an entry of a higher priority is matched
+        self.rows = sorted((first, row, re.compile("|".join(alternatives)))
+                           for row, (first, alternatives) in patterns.items())
+
+    # return the state and the fields of the first matched entry
+    def classify(self, lines):
+        found = None
+        for first, row, regex in self.rows:
+            if found is not None and found[0] < first: break
+            m = regex.match(lines[row])
+            if m is None: continue
+            # the wrapping group closes last, and the first matched alternative is of the highest priority
+            i = int(m.lastgroup[1:])
+            if found is None or i < found[0]:
+                found = (i, m)
+
+        if found is None: return self.default, {}
+
+        i, m = found
+        state, _, groups, ints, fields = self.entries[i]
+        values = {}
+        for name in groups:
+            value = m.group(f"e{i}_{name}")
+            values[name] = int(value) if name in ints and value is not None else value
+        for name, (row, regex) in fields.items():
+            field = regex.match(lines[row])
+            values[name] = field.group(name) if field else None
+        return state, values
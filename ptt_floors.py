@@ -0,0 +1,84 @@
+from array import array
+
+
+class FloorIndex:
+    '''
+        The push lines of a thread counted by prefix sums (Fenwick trees) over the lines captured, 1-based.
+
+        A line is UNKNOWN until captured. The floor of a push is the pushes counted since the article
+        once every line before it is captured, in whatever order the lines are viewed, and the floor
+        from the end once every line after it is. A line set or a range counted takes O(log n).
+    '''
+
+    UNKNOWN, LINE, PUSH = 0, 1, 2
+
+    def __init__(self):
+        self.flags = bytearray()
+        self.pushes = array('i', [0])
+        self.known = array('i', [0])
+
+    def __repr__(self):
+        return f"FloorIndex({len(self.flags)} lines, {self.count(1, len(self.flags))} pushes)"
+
+    def __len__(self):
+        return len(self.flags)
+
+    @staticmethod
+    def _prefix(tree, i):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i &= i - 1
+        return total
+
+    @staticmethod
+    def _add(tree, i, delta):
+        n = len(tree)
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+
+    # appends count UNKNOWN lines
+    def grow(self, count: int):
+        n = len(self.flags)
+        self.flags.extend(bytes(count))
+        for tree in (self.pushes, self.known):
+            for i in range(n + 1, n + count + 1):
+                # the sum of (i - lowbit(i), i] of which i is 0
+                tree.append(self._prefix(tree, i - 1) - self._prefix(tree, i - (i & -i)))
+
+    def set(self, line: int, push: bool):
+        flag = self.PUSH if push else self.LINE
+        old = self.flags[line - 1]
+        if old == flag: return
+        self.flags[line - 1] = flag
+        if old == self.UNKNOWN:
+            self._add(self.known, line, 1)
+        if (old == self.PUSH) != push:
+            self._add(self.pushes, line, 1 if push else -1)
+
+    def isPush(self, line: int):
+        return self.flags[line - 1] == self.PUSH
+
+    # the pushes in [first, last]
+    def count(self, first: int, last: int):
+        return self._prefix(self.pushes, last) - self._prefix(self.pushes, first - 1)
+
+    # all lines in [first, last] are captured
+    def isKnown(self, first: int, last: int):
+        return self._prefix(self.known, last) - self._prefix(self.known, first - 1) == last - first + 1
+
+    # built-in objects, see ptt_snapshot.py
+    def getSnapshot(self):
+        return {'flags': bytes(self.flags)}
+
+    def setSnapshot(self, state):
+        self.flags = bytearray(state['flags'])
+        n = len(self.flags)
+        # the trees are built in O(n) by adding each node to its parent
+        self.pushes = array('i', [0]) + array('i', (flag == self.PUSH for flag in self.flags))
+        self.known = array('i', [0]) + array('i', (flag != self.UNKNOWN for flag in self.flags))
+        for tree in (self.pushes, self.known):
+            for i in range(1, n + 1):
+                parent = i + (i & -i)
+                if parent <= n: tree[parent] += tree[i]
@@ -0,0 +1,141 @@
+import re
+
+import ptt_log
+
+log = ptt_log.getLogger("frame")
+
+
+class FrameDetector:
+    '''
+        Decides when a burst of server segments, i.e. a screen update, is complete.
+
+        A segment shorter than a full WebSocket segment is the last one.
+        A full segment is the last one if it ends with a terminal cue, e.g. the cursor is positioned
+        or restored, or the status line is redrawn at the end.
+        Otherwise the burst is complete once no segment comes within the timeout, which is learned
+        from the gaps between segments of the same burst on this connection.
+
+        A segment without a client message in between means the burst went on if it comes within the timeout
+        after a cue, which counts as a false cue, or within BASELINE_TIMEOUT after the last segment of a burst
+        completed by the timer. The gap of the latter is learned and the timeout is doubled as a retransmission
+        timeout is, and halved back by each burst completed indeed.
+    '''
+
+    FULL_SEGMENT = 1021     # the size of a full segment from the PTT server
+    BASELINE_TIMEOUT = 0.1  # the fixed polling interval used to be, also the maximum timeout
+    MIN_TIMEOUT = 0.005
+    MAX_BACKOFF = 32        # enough for MIN_TIMEOUT to reach BASELINE_TIMEOUT
+
+    # smoothing factors as those of TCP round-trip time estimator (RFC 6298)
+    GAP_ALPHA = 1 / 8
+    GAP_BETA = 1 / 4
+    GAP_K = 4
+
+    # cues are disabled if they turn out to be wrong too often
+    MIN_CUES = 8
+
+    re_cursor_cue = re.compile(rb"\x1b\[\d*(?:;\d*)?[Hf]\Z|\x1b8\Z")
+    re_status_cue = re.compile(rb"\x1b\[(\d+);1H(?:(?!\x1b\[\d*(?:;\d*)?[Hf]).)*\Z", re.DOTALL)
+
+    def __init__(self, statusRow: int = 0):
+        self.statusRow = statusRow   # 1-based row of the status line, 0 if unknown
+        self.reset()
+        self.resetStats()
+
+    def reset(self):
+        self.gap = None         # smoothed gap between segments in seconds
+        self.gapVar = 0.0
+        self.backoff = 1        # the multiplier of the timeout after false completions by the timer
+        self.lastSegment = None     # time of the last segment in the current burst
+        self.lastEnd = None         # time of the last segment of the last burst
+        self.lastComplete = None    # time and reason of the last completion
+        self.cueEnabled = True
+
+    def resetStats(self):
+        self.frames = {'size': 0, 'cue': 0, 'timer': 0}
+        self.falseCues = 0
+        self.falseTimers = 0
+        self.savedTime = 0.0    # compared with waiting BASELINE_TIMEOUT for every burst not ended by size
+
+    def stats(self):
+        return {'frames': dict(self.frames), 'false_cues': self.falseCues, 'false_timers': self.falseTimers,
+                'cue_enabled': self.cueEnabled, 'backoff': self.backoff,
+                'gap_ms': None if self.gap is None else round(self.gap * 1000, 3),
+                'timeout_ms': round(self.timeout() * 1000, 3),
+                'saved_ms': round(self.savedTime * 1000, 3)}
+
+    def inBurst(self):
+        return self.lastSegment is not None
+
+    def timeout(self):
+        if self.gap is None: return self.BASELINE_TIMEOUT
+        timeout = (self.gap + self.GAP_K * self.gapVar) * self.backoff
+        return min(max(timeout, self.MIN_TIMEOUT), self.BASELINE_TIMEOUT)
+
+    def learn(self, gap: float):
+        if self.gap is None:
+            self.gap = gap
+            self.gapVar = gap / 2
+        else:
+            self.gapVar += self.GAP_BETA * (abs(self.gap - gap) - self.gapVar)
+            self.gap += self.GAP_ALPHA * (gap - self.gap)
+
+    def hasCue(self, content: bytes):
+        tail = content[-256:]
+        if self.re_cursor_cue.search(tail): return True
+        if self.statusRow:
+            status = self.re_status_cue.search(tail)
+            if status and int(status.group(1)) == self.statusRow: return True
+        return False
+
+    def complete(self, now: float, reason: str):
+        self.frames[reason] += 1
+        self.lastEnd = self.lastSegment
+        self.lastSegment = None
+        self.lastComplete = (now, reason)
+
+    # return True if the segment is the last one of the burst
+    def segment(self, content: bytes, now: float):
+        if self.lastSegment is not None:
+            self.learn(now - self.lastSegment)
+        elif self.lastComplete:
+            completed, reason = self.lastComplete
+            if reason == 'cue' and now - completed < self.timeout():
+                # the burst went on after a cue
+                self.falseCues += 1
+                self.savedTime -= self.BASELINE_TIMEOUT
+                if self.frames['cue'] >= self.MIN_CUES and self.falseCues * 4 > self.frames['cue']:
+                    log.warning("Too many false cues, cues disabled")
+                    self.cueEnabled = False
+            elif reason == 'timer' and self.lastEnd is not None and now - self.lastEnd < self.BASELINE_TIMEOUT:
+                # the burst went on after the timer, which was too short
+                self.falseTimers += 1
+                self.savedTime -= max(self.BASELINE_TIMEOUT - (completed - self.lastEnd), 0)
+                self.learn(now - self.lastEnd)
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            elif self.backoff > 1:
+                # the last burst was complete indeed
+                self.backoff //= 2
+        self.lastSegment = now
+
+        if len(content) < self.FULL_SEGMENT:
+            self.complete(now, 'size')
+            return True
+
+        if self.cueEnabled and self.hasCue(content):
+            self.savedTime += self.BASELINE_TIMEOUT
+            self.complete(now, 'cue')
+            return True
+
+        return False
+
+    # called when the timer armed with timeout() expires
+    def timedOut(self, now: float):
+        if self.lastSegment is not None:
+            self.savedTime += max(self.BASELINE_TIMEOUT - (now - self.lastSegment), 0)
+        self.complete(now, 'timer')
+
+    # the burst is ended by the client
+    def interrupted(self):
+        self.lastSegment = None
+        self.lastComplete = None
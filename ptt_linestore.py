@@ -0,0 +1,161 @@
+from array import array
+from itertools import repeat
+
+
+class LineStore:
+    '''
+        A list of lines kept in a UTF-8 arena, i.e. the text of a line is arena[start:start+size].
+        A missing line reads as HOLDER (PttThread.LINE_HOLDER) and is set by assigning HOLDER.
+
+        A line rewritten no longer than it was is rewritten in place, otherwise appended to the arena.
+        The arena is compacted once more than half of it is garbage.
+        A line takes 8 bytes and a bit besides its text, instead of a str object and a pointer of a list.
+    '''
+
+    HOLDER = chr(0x7f)
+    COMPACT_SIZE = 1 << 16  # the garbage to compact at least
+    CHUNK_SIZE = 1 << 16    # the bytes of a chunk of text at least
+
+    def __init__(self, lines=()):
+        self.arena = bytearray()
+        self.starts = array('I')
+        self.sizes = array('I')
+        self.missing = bytearray()  # a bit per line
+        self.garbage = 0
+        self.extend(lines)
+
+    def __repr__(self):
+        return f"LineStore({len(self)} lines, {len(self.arena)} bytes, {self.garbage} garbage)"
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self.starts)))]
+        if i < 0: i += len(self.starts)
+        if not 0 <= i < len(self.starts):
+            raise IndexError("LineStore index out of range")
+        if self.missing[i >> 3] >> (i & 7) & 1:
+            return self.HOLDER
+        start = self.starts[i]
+        return self.arena[start:start + self.sizes[i]].decode()
+
+    def __setitem__(self, i, line: str):
+        if i < 0: i += len(self.starts)
+        if not 0 <= i < len(self.starts):
+            raise IndexError("LineStore assignment index out of range")
+        missing = self.missing[i >> 3] >> (i & 7) & 1
+        if line == self.HOLDER:
+            if not missing:
+                self.garbage += self.sizes[i]
+                self.sizes[i] = 0
+                self.missing[i >> 3] |= 1 << (i & 7)
+            return
+
+        data = line.encode()
+        if missing:
+            self.missing[i >> 3] &= ~(1 << (i & 7))
+        else:
+            start, size = self.starts[i], self.sizes[i]
+            if len(data) <= size:
+                # mostly the same line is viewed again
+                if len(data) == size and self.arena[start:start + size] == data: return
+                self.arena[start:start + len(data)] = data
+                self.sizes[i] = len(data)
+                self.garbage += size - len(data)
+                return
+            self.garbage += size
+
+        self.starts[i] = len(self.arena)
+        self.sizes[i] = len(data)
+        self.arena += data
+        if self.garbage > self.COMPACT_SIZE and self.garbage * 2 > len(self.arena):
+            self.compact()
+
+    def isMissing(self, i: int):
+        return bool(self.missing[i >> 3] >> (i & 7) & 1)
+
+    def _setMissing(self, begin: int, end: int):
+        while begin < end and begin & 7:
+            self.missing[begin >> 3] |= 1 << (begin & 7)
+            begin += 1
+        while end > begin and end & 7:
+            end -= 1
+            self.missing[end >> 3] |= 1 << (end & 7)
+        if begin < end:
+            self.missing[begin >> 3:end >> 3] = b'\xff' * ((end - begin) >> 3)
+
+    # appends count missing lines
+    def grow(self, count: int):
+        n = len(self.starts)
+        self.starts.extend(repeat(0, count))
+        self.sizes.extend(repeat(0, count))
+        size = (n + count + 7) >> 3
+        if size > len(self.missing):
+            self.missing.extend(bytes(size - len(self.missing)))
+        self._setMissing(n, n + count)
+
+    def append(self, line: str):
+        self.grow(1)
+        self[len(self.starts) - 1] = line
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    # the UTF-8 text of the lines [begin, end) each followed by a newline, in chunks of about size bytes
+    def chunks(self, begin=0, end=None, size=CHUNK_SIZE):
+        end = len(self.starts) if end is None else min(end, len(self.starts))
+        arena, starts, sizes, missing = self.arena, self.starts, self.sizes, self.missing
+        parts = []
+        total = 0
+        for i in range(begin, end):
+            if missing[i >> 3] >> (i & 7) & 1:
+                parts.append(b'\n')
+                total += 1
+            else:
+                start = starts[i]
+                parts.append(arena[start:start + sizes[i]])
+                parts.append(b'\n')
+                total += sizes[i] + 1
+            if total >= size:
+                yield b''.join(parts)
+                parts = []
+                total = 0
+        if parts: yield b''.join(parts)
+
+    def compact(self):
+        arena = bytearray()
+        for i in range(len(self.starts)):
+            start, size = self.starts[i], self.sizes[i]
+            self.starts[i] = len(arena)
+            arena += self.arena[start:start + size]
+        self.arena = arena
+        self.garbage = 0
+
+    # the bytes taken besides the object itself
+    def nbytes(self):
+        return len(self.arena) + (len(self.starts) + len(self.sizes)) * self.starts.itemsize + len(self.missing)
+
+    # built-in objects for pickling and snapshots, see ptt_snapshot.py
+    def getSnapshot(self):
+        if self.garbage: self.compact()
+        return {'arena': bytes(self.arena), 'starts': self.starts.tobytes(), 'sizes': self.sizes.tobytes(),
+                'missing': bytes(self.missing)}
+
+    def setSnapshot(self, state):
+        self.arena = bytearray(state['arena'])
+        self.starts = array('I')
+        self.starts.frombytes(state['starts'])
+        self.sizes = array('I')
+        self.sizes.frombytes(state['sizes'])
+        self.missing = bytearray(state['missing'])
+        self.garbage = 0
+
+    __getstate__ = getSnapshot
+    __setstate__ = setSnapshot
@@ -0,0 +1,65 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+
+'''
+    Logging of the proxy.
+    Messages are formatted only if the level is enabled, so pass arguments instead of formatting them, e.g.
+
+        log.debug("client: %s", content)
+
+    and guard an expensive argument with "if log.isEnabledFor(logging.DEBUG)".
+    Enabled records are put to a queue and written by a listener thread so the event loop never blocks on stdout.
+
+    The level is from the environment variable PTT_LOG_LEVEL, INFO by default, and can be switched at runtime, e.g.
+    by the debug socket of mitm_ptt_proxy.py:
+
+        :.setLogLevel("DEBUG")
+'''
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+ROOT = "ptt"
+
+_listener = None
+
+def getLogger(name: str):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+def setLevel(level):
+    if isinstance(level, str): level = level.upper()
+    logging.getLogger(ROOT).setLevel(level)
+
+def getLevel():
+    return logging.getLevelName(logging.getLogger(ROOT).getEffectiveLevel())
+
+def start(stream=None):
+    global _listener
+    if _listener: return
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+
+    q = queue.SimpleQueue()
+    root = logging.getLogger(ROOT)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.propagate = False
+    setLevel(os.environ.get("PTT_LOG_LEVEL", "INFO"))
+
+    _listener = logging.handlers.QueueListener(q, handler)
+    _listener.start()
+    atexit.register(stop)
+
+def stop():
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+start()
@@ -0,0 +1,62 @@
+class ScreenOverlay:
+    '''
+        Draws strings of a fixed width over the rows of the client at a fixed column,
+        e.g. the floor numbers beyond the text of PTT.
+
+        What is drawn is marked on the rows of the screen (CompactScreen.mark()). The marks move with the rows
+        as the server scrolls and are removed once the server writes over them, i.e. the marks are what
+        the client shows, so only the rows of which the strings differ are drawn.
+        The rows are drawn from top to bottom, an adjacent row is reached by a relative move
+        unless the string ends at the last column, where the cursor stays on the last column.
+
+        A screen without marks, e.g. MyScreen, is drawn in full every time.
+    '''
+
+    def __init__(self, column: int, width: int, tracked=True):
+        self.column = column    # 1-based
+        self.width = width
+        self.tracked = tracked
+        self.blank = b' ' * width
+        # the column drawn at in the next row, the cursor is after the string
+        self.nextRow = b'\x1b[B\x1b[%dD' % width
+        self.positions = {}     # row -> b'\x1b[row;columnH'
+
+    def isTracked(self, screen):
+        return self.tracked and hasattr(screen, "marks")
+
+    def position(self, row: int):
+        data = self.positions.get(row)
+        if data is None:
+            data = self.positions[row] = b'\x1b[%d;%dH' % (row, self.column)
+        return data
+
+    def draw(self, screen, cells: dict):
+        '''
+            Returns the data to draw cells, {row: bytes} of 1-based rows, a blank string to clear.
+            Rows not in cells are left as they are.
+        '''
+        tracked = self.isTracked(screen)
+        begin = self.column - 1
+        end = begin + self.width
+        relative = end < screen.columns
+
+        data = []
+        last = None
+        for row in sorted(cells):
+            cell = cells[row]
+            if tracked:
+                y = row - 1
+                if y >= screen.lines: continue
+                shown = screen.marked(y, begin, end)
+                if cell == (shown or self.blank): continue
+                screen.mark(y, begin, end, cell if cell != self.blank else None)
+            data.append(self.nextRow if relative and last == row - 1 else self.position(row))
+            data.append(cell)
+            last = row
+        return b''.join(data)
+
+    # clear all the rows drawn
+    def clear(self, screen):
+        begin = self.column - 1
+        return self.draw(screen, {y + 1: self.blank for y in range(screen.lines)
+                                  if screen.marked(y, begin, begin + self.width)})
@@ -8,6 +8,7 @@ import traceback
 import asyncio
 
 from ptt_thread import PttThread, PttThreadPersist
+from ptt_linestore import LineStore
 
 
 class PttPersist:
@@ -247,6 +248,32 @@ class PttPersist:
             names = []
         return root, names
 
+    # the threads of a board in the archive in chunks, each after a line of "==> board/aidc <=="
+    @classmethod
+    def boardChunks(cls, board, size=LineStore.CHUNK_SIZE):
+        root, names = cls.getThreads(board)
+        for aidc in sorted(names):
+            yield f"==> {board}/{aidc} <==\n".encode()
+            try:
+                with open(os.path.join(root, aidc), "rb") as f:
+                    while True:
+                        chunk = f.read(size)
+                        if not chunk: break
+                        yield chunk
+            except OSError:
+                traceback.print_exc()
+
+    # writes the boards in the archive, all if None, by write() like PttThread.export(), returns the bytes written
+    @classmethod
+    def exportBoards(cls, write, boards=None, size=LineStore.CHUNK_SIZE):
+        if boards is None: boards = sorted(cls.getBoards()[1])
+        total = 0
+        for board in boards:
+            for chunk in cls.boardChunks(board, size):
+                write(chunk)
+                total += len(chunk)
+        return total
+
 
 if __name__ == "__main__":
     try:
@@ -9,58 +9,116 @@ import copy
 from mitmproxy import http, ctx
 from mitmproxy.proxy import layer, layers
 
-from user_event import UserEvent
+from user_event import UserEvent, KeyDecoder
+from ptt_buffer import SegmentBuffer
+from ptt_frame import FrameDetector
+from ptt_stats import latency
 import ptt_term
+import ptt_log
+import ptt_snapshot
+import ptt_resolver
+from ptt_persist import PttPersist
+
+log = ptt_log.getLogger("proxy")
+
+
+class PttSession:
+    '''
+        The state of a WebSocket connection to the PTT server, there is one for each flow.
+        It works as the ProxyFlow of its PttTerm.
+
+        Memory of an idle session is bounded: the screen has a limited size, messages are buffered only
+        during a burst, and the thread being viewed is persisted and cleared when the session ends.
+    '''
+
+    COLUMNS = 128
+    LINES = 32
+    # the screen is not resized beyond the limits by the client
+    MAX_COLUMNS = 256
+    MAX_LINES = 128
+
+    def __init__(self, flow: http.HTTPFlow, read_flow: bool):
+        self.flow = flow
+        self.term = ptt_term.PttTerm(self.COLUMNS, self.LINES)
+        self.frame = FrameDetector()
+        self.server_timer = None
+        self.reset()
 
-pttTerm = ptt_term.PttTerm(128, 32)
+        self.term.flowStarted(self, read_flow)
 
+    def __repr__(self):
+        return f"PttSession({self.flow.id}, {self.term.state})"
 
-class PttProxy:
+    def reset(self):
+        self.firstSegment = False
+        self.lastSegment  = False
+        self.server_pending = 0     # bytes fed to the screen but not refreshed yet
+        self.standby_msgs = SegmentBuffer()     # to be sent to the client
 
-    def __init__(self):
+        # server timer depends on flow
+        self.cancel_server_timer()
+
+    def close(self):
         self.reset()
-        self.wslayer = None
-        self.is_running = False
-        self.is_done = False
+        self.term.flowStopped()
+        if self.term.isMacroRunning():
+            self.term.macro_task.cancel()
+        self.term.thread.switch(self.term.persistThread)
 
-        # only immutable attribute refers to new object by assignment but PttProxy.last_cmds is not
-        self.last_cmds = copy.copy(self.last_cmds)
+    # ProxyFlow of PttTerm
 
-    def reset(self):
-        self.firstSegment = False
-        self.lastSegment  = False
-        self.server_msgs = bytes()      # to be feed to the screen
-        self.standby_msgs = bytes()     # to be sent to the client
+    def sendToServer(self, data):
+        ctx.master.sendToServer(self.flow, data)
 
-        # server task depends on flow
-        if hasattr(self, "server_task") and not self.server_task.done():
-            self.server_task.cancel()
-        if hasattr(self, "server_event") and self.server_event.is_set():
-            self.server_event.clear()
+    def insertToClient(self, data):
+        if self.firstSegment:
+            # insert ahead of the first segment
+            log.debug("Insert to client: %d", len(data))
+            self.current_message.prepend(data)
+        else:
+            self.standby_msgs.append(data)
+            log.debug("Queued to insert: %d", len(data))
 
-    # feed to the screen
-    # event must be checked if not None
-    def purge_server_message(self, event: asyncio.Event):
-        event.clear()
+    def sendToClient(self, data):
+        if self.lastSegment:
+            # piggyback to the last segment
+            log.debug("Piggyback to client: %d", len(data))
+            self.current_message.append(data)
+        else:
+            self.standby_msgs.append(data)
+            log.debug("Queued to send: %d", len(data))
 
-        if len(self.server_msgs):
-            pttTerm.pre_refresh()
-            pttTerm.feed(self.server_msgs)
-            pttTerm.post_refresh()
-            self.server_msgs = bytes()
+    # refresh the screen fed with the segments so far
+    def purge_server_message(self):
+        self.cancel_server_timer()
 
-        if len(self.standby_msgs): event.set()
+        if self.server_pending:
+            self.server_pending = 0
+            t = latency.timer()
+            self.term.post_refresh()
+            latency.record("post_refresh", t, self.term.state.name())
+
+        # messages queued during refresh are sent after the current one
+        if len(self.standby_msgs):
+            asyncio.get_running_loop().call_soon(self.purge_standby_message)
 
     # send to the client
-    def purge_standby_message(self, flow: http.HTTPFlow):
+    def purge_standby_message(self):
         if len(self.standby_msgs):
-            ctx.master.sendToClient(flow, self.standby_msgs)
-            self.standby_msgs = bytes()
+            ctx.master.sendToClient(self.flow, self.standby_msgs.take())
 
     def server_message(self, content):
-        self.server_msgs += content
-
-        if self.firstSegment: pttTerm.pre_update()
+        if self.firstSegment:
+            t = latency.timer()
+            self.term.pre_update()
+            latency.record("pre_update", t, self.term.state.name())
+            self.term.pre_refresh()
+
+        # a double-byte character split into two segments is held by the decoder of PttTerm
+        t = latency.timer()
+        self.term.feed(content)
+        latency.record("feed", t, self.term.state.name())
+        self.server_pending += len(content)
 
         n = len(content)
 #        print("\nserver: (%d)" % n)
@@ -68,191 +126,166 @@ class PttProxy:
         # dirty trick to identify the last segment with size
         # (FIXME) Done: handled in server_msg_timeout()
         # but sometimes a segment with size 1021 is not the last or the last segment is larger than 1021
-        # (FIXME) Done: queue message segments in server_msgs
-        # a double-byte character could be split into two segments
+        # (FIXME) Done: feed message segments as they come and refresh the screen in the end
         if self.lastSegment:
-            self.purge_server_message(self.server_event)
+            self.purge_server_message()
         else:
-            self.server_event.set()
+            self.arm_server_timer()
 
-    vt_keys = ["Home", "Insert", "Delete", "End", "PgUp", "PgDn", "Home", "End"]
-    xterm_keys = ["Up", "Down", "Right", "Left", "?", "End", "Keypad 5", "Home"]
     def client_message(self, content):
-        print("\nclient:", content)
+        log.debug("\nclient: %s", content)
 
         if len(content) > 1 or not UserEvent.isViewable(content[0]):
             # need to reset userEvent for unknown keys otherwise PttTerm.pre_refresh() would go wrong
-            pttTerm.userEvent(UserEvent.Unknown)
+            self.term.userEvent(UserEvent.Unknown)
 
         uncommitted = (len(content) > 1 and content[-1] == ord('\r'))
 
-        # VT100 escape
-        sESC = '\x1b'
-        sCSI = '['
-        sNUM = '0'
-
-        # Telnet escape
-        IAC = 0xff
-        SUB = 0xfa
-        NOP = 0xf1
-        SUBEND = 0xf0
-        WINSIZE = 0x1f
-
-        state = None
-        number = ""
-        n = 0
-        while n < len(content):
-            resp = None
-            b = content[n]
-
-            if state != sNUM: number = ""
-
-            c = chr(b)
-            if state == None:
-                cmdBegin = n
-                if c == sESC:
-                    state = sESC
-                elif c == '\b':
-                    resp = pttTerm.userEvent(UserEvent.Key_Backspace)
-                elif c == '\r':
-                    resp = pttTerm.userEvent(UserEvent.Key_Enter)
-                elif b == IAC:
-                    state = IAC
-                elif UserEvent.isViewable(b):
-                    resp = pttTerm.userEvent(b)
-            elif state == sESC:
-                if c == sCSI:
-                    state = sCSI
-                else:
-                    state = None
-            elif state == sCSI:
-                if 'A' <= c <= 'H':
-                    if c == 'A':
-                        resp = pttTerm.userEvent(UserEvent.Key_Up, uncommitted)
-                    elif c == 'B':
-                        resp = pttTerm.userEvent(UserEvent.Key_Down, uncommitted)
-                    elif c == 'C':
-                        resp = pttTerm.userEvent(UserEvent.Key_Right)
-                    elif c == 'D':
-                        resp = pttTerm.userEvent(UserEvent.Key_Left)
-                    elif c == 'F':
-                        resp = pttTerm.userEvent(UserEvent.Key_End)
-                    elif c == 'H':
-                        resp = pttTerm.userEvent(UserEvent.Key_Home)
-                    else:
-                        print("xterm key:", self.xterm_keys[b - ord('A')])
-                elif '0' <= c <= '9':
-                    state = sNUM
-                    number += c
-                    n += 1
-                    continue
-                state = None
-            elif state == sNUM:
-                if '0' <= c <= '9':
-                    number += c
-                    n += 1
-                    continue
-                elif c == '~':
-                    number = int(number)
-                    if number == 5:
-                        resp = pttTerm.userEvent(UserEvent.Key_PgUp)
-                    elif number == 6:
-                        resp = pttTerm.userEvent(UserEvent.Key_PgDn)
-                    elif number in [1, 7]:
-                        resp = pttTerm.userEvent(UserEvent.Key_Home)
-                    elif number in [4, 8]:
-                        resp = pttTerm.userEvent(UserEvent.Key_End)
-                    elif 1 <= number <= len(self.vt_keys):
-                        print("vt key:", self.vt_keys[number-1])
-                state = None
-            elif state == IAC:
-                if SUB <= b < IAC:
-                    state = SUB
-                elif b == SUBEND or b == NOP:
-                    state = None
-                else:
-                    break
-            elif state == SUB:
-                if b == WINSIZE:
-                    if n + 4 < len(content):
-                        width  = (content[n+1] << 8) | content[n+2]
-                        height = (content[n+3] << 8) | content[n+4]
-                        print("Window size", width, height)
-                        pttTerm.resize(width, height)
-                        n += 4
-                        state = None
-                    else:
-                        break
-                elif 0 <= b <= 3:
-                    state = None
-                else:
-                    break
+        replaced = False
+        pieces = []
+        last = 0
+        for event, begin, end, arg in KeyDecoder.decode(content):
+            if event == UserEvent.WindowSize:
+                log.info("Window size %d %d", *arg)
+                self.resize(*arg)
+                continue
 
+            resp = self.term.userEvent(event, uncommitted and event in self.uncommittedEvents)
             if isinstance(resp, bytes):
                 # replace the current input with resp
-                content = content[:cmdBegin] + resp + content[n+1:]
+                pieces.append(content[last:begin])
+                pieces.append(resp)
+                last = end
+                replaced = True
             elif resp is False:
                 return False
 
-            n += 1
+        if replaced:
+            pieces.append(content[last:])
+            content = b''.join(pieces)
 
         return content
 
-    async def server_msg_timeout(self, flow: http.HTTPFlow, event: asyncio.Event):
-        print("server_msg_timeout() started, socket opened:", (flow.websocket.timestamp_end is None))
-        cancelled = False
-        while (flow.websocket.timestamp_end is None) and not cancelled:
-            try:
-                await event.wait()
-            except asyncio.CancelledError:
-                cancalled = True
-                break
-            except Exception:
-                traceback.print_exc()
+    # the cursor moves before the input is committed by Enter
+    uncommittedEvents = frozenset([UserEvent.Key_Up, UserEvent.Key_Down])
 
-            self.purge_standby_message(flow)
+    def resize(self, columns, lines):
+        self.term.resize(min(columns, self.MAX_COLUMNS), min(lines, self.MAX_LINES))
 
-            rcv_len = len(self.server_msgs)
-            if rcv_len == 0:
-                event.clear()
-                continue
+    def arm_server_timer(self):
+        if self.server_timer: self.server_timer.cancel()
+        self.server_timer = asyncio.get_running_loop().call_later(self.frame.timeout(), self.server_msg_timeout)
 
-            while not cancelled:
-                try:
-                    # message could be purged during sleeping
-                    await asyncio.sleep(0.1)
-                except asyncio.CancelledError:
-                    cancalled = True
-                    break
-                except Exception:
-                    traceback.print_exc()
+    def cancel_server_timer(self):
+        if self.server_timer:
+            self.server_timer.cancel()
+            self.server_timer = None
 
-                # no more coming data
-                if len(self.server_msgs) <= rcv_len:
-                    break
+    # no more segment comes within the learned timeout
+    def server_msg_timeout(self):
+        self.server_timer = None
+        if self.flow.websocket.timestamp_end is not None:
+            log.info("server_msg_timeout() socket closed, pending: %d", self.server_pending)
+            return
 
-            if cancelled: break
+        self.frame.timedOut(asyncio.get_running_loop().time())
 
-            if len(self.server_msgs):
-                print("Server event timeout! Pending:", len(self.server_msgs))
+        try:
+            self.purge_server_message()
+            self.purge_standby_message()
+        except Exception:
+            traceback.print_exc()
+
+    # the time spent in between is the latency added by the proxy
+    def websocket_message(self, flow_msg):
+        t = latency.timer()
+        state = self.term.state.name()
+        if flow_msg.from_client:
+            self.firstSegment = False
+            self.lastSegment  = False
 
-            self.purge_server_message(event)
+            self.purge_standby_message()
+            if self.frame.inBurst(): self.frame.interrupted()
+            self.purge_server_message()
 
-        print("server_msg_timeout() finished")
+            resp = self.client_message(flow_msg.content)
+            if isinstance(resp, bytes):
+                if resp != flow_msg.content: log.debug("replace client message: %s", resp)
+                flow_msg.content = resp
+            else:
+                log.debug("Drop client message!")
+                flow_msg.drop()
+        else:
+            self.firstSegment = not self.frame.inBurst() # (len(flow.websocket.messages) == 1 or flow.websocket.messages[-2].from_client)
+            # see the comment in server_message() for why it's 1021
+            self.frame.statusRow = self.term.screen.lines
+            self.lastSegment  = self.frame.segment(flow_msg.content, asyncio.get_running_loop().time())
+            # insertion and piggyback are queued around the content and joined once
+            self.current_message = SegmentBuffer(flow_msg.content)
+
+            self.server_message(flow_msg.content)
+
+            if self.current_message.isSegmented():
+                flow_msg.content = self.current_message.take()
+                log.debug("server -> client, changed: %d", len(flow_msg.content))
+
+            del self.current_message
+            self.firstSegment = False
+            self.lastSegment  = False
+
+        latency.record("client" if flow_msg.from_client else "server", t, state)
+
+    def on_signal(self, signum: int):
+        print(self)
+        print("server_pending:", self.server_pending)
+        print("server_timer:", self.server_timer)
+        print("frame:", self.frame.stats())
+        self.term.showState()
+
+
+class PttProxy:
+
+    # sessions are saved on done() and restored to the sessions started next, None not to
+    snapshot_filename = os.path.join(PttPersist.archive_dir, ".ptt_snapshot")
+
+    def __init__(self):
+        self.sessions = {}      # flow.id: PttSession
+        self.last_session = None    # the session receives the latest message
+        self.wslayer = None
+        self.is_running = False
+        self.is_done = False
+        self.snapshots = []     # (flow, snapshot of PttTerm) taken on done()
+        self.restoring = []     # snapshots of PttTerm to restore to new sessions
+        self.restoringVersion = ptt_snapshot.VERSION
+        self.resolver = None    # URLResolver of the hidden session
+
+        # only immutable attribute refers to new object by assignment but PttProxy.last_cmds is not
+        self.last_cmds = copy.copy(self.last_cmds)
+
+    def reset(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+        self.last_session = None
+
+    def session(self, flow: http.HTTPFlow):
+        return self.sessions.get(flow.id)
+
+    # the terminal of the latest session for debugging
+    @property
+    def pttTerm(self):
+        return self.last_session.term if self.last_session else None
 
     # self-defined hooks
 
     def on_signal(self, signum: int):
         print("Addon got", signum, "(%d)" % int(signum))
-        print("server_msgs:", len(self.server_msgs))
-        if hasattr(self, "server_event"):
-            print("server_event:", self.server_event)
-        if hasattr(self, "server_task"):
-            print("server_task:", self.server_task)
-        pttTerm.showState()
-
-    cmd_formats = {'.':  "pttTerm.{data}",
-                   '?':  "print(pttTerm.{data})",
+        print("sessions:", len(self.sessions))
+        for session in self.sessions.values():
+            session.on_signal(signum)
+
+    cmd_formats = {'.':  "self.pttTerm.{data}",
+                   '?':  "print(self.pttTerm.{data})",
                    '!':  "{data}",
                    '\\': "print({data})" }
 
@@ -285,14 +318,107 @@ class PttProxy:
         self.is_running = True
         print("log_verbosity:", self.log_verbosity)
         print("flow_detail:", self.flow_detail)
+        if not self.read_flow:
+            self.loadSnapshot()
 
     # the addon is still loaded even after done()
     # it just will not receive event from the addon manager
     def done(self):
         print(self, "done!")
+        self.takeSnapshot()
+        if self.snapshots and not self.read_flow:
+            self.saveSnapshot()
         self.reset()
+        self.stopResolver()
         self.is_done = True
 
+    # Snapshot, see ptt_snapshot.py
+
+    def takeSnapshot(self):
+        self.snapshots = []
+        # the latest session last
+        sessions = [s for s in self.sessions.values() if s is not self.last_session] + \
+                   ([self.last_session] if self.last_session in self.sessions.values() else [])
+        for session in sessions:
+            try:
+                self.snapshots.append((session.flow, session.term.getSnapshot()))
+            except Exception:
+                traceback.print_exc()
+        return self.snapshots
+
+    # the current sessions unless done, e.g. by ":.saveSnapshot()" of mitm_ptt_proxy.py
+    def saveSnapshot(self):
+        if not self.snapshot_filename: return
+        if not self.is_done: self.takeSnapshot()
+        t = latency.timer()
+        try:
+            size = ptt_snapshot.save(self.snapshot_filename,
+                                     {'sessions': [snapshot for _, snapshot in self.snapshots]})
+        except Exception:
+            traceback.print_exc()
+            return
+        log.info("Snapshot of %d sessions saved to %s: %d bytes in %.1f ms", len(self.snapshots),
+                 self.snapshot_filename, size, (latency.timer() - t) * 1000)
+
+    def loadSnapshot(self):
+        if not self.snapshot_filename: return
+        t = latency.timer()
+        try:
+            state, version = ptt_snapshot.load(self.snapshot_filename)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.warning("Snapshot %s is not loaded: %s", self.snapshot_filename, e)
+            return
+        self.restoring = state.get('sessions', [])
+        self.restoringVersion = version
+        log.info("Snapshot of %d sessions loaded from %s in %.1f ms", len(self.restoring),
+                 self.snapshot_filename, (latency.timer() - t) * 1000)
+
+    # the screen and the state are restored only onto the same flow, e.g. by reload()
+    def restoreSnapshot(self, session, snapshot, screen=True, version=ptt_snapshot.VERSION):
+        t = latency.timer()
+        try:
+            restored = session.term.setSnapshot(snapshot, screen, version)
+        except Exception:
+            traceback.print_exc()
+            restored = False
+        log.info("Session %s %srestored in %.1f ms", session.flow.id, "" if restored else "not ",
+                 (latency.timer() - t) * 1000)
+
+    # URL resolver, see ptt_resolver.py
+
+    # PTT_RESOLVER=ws logs in to the upstream of the flow as PTT_RESOLVER_USER with PTT_RESOLVER_PASSWORD,
+    # PTT_RESOLVER=standin to a local stand-in of the server
+    def startResolver(self, flow: http.HTTPFlow):
+        mode = os.environ.get("PTT_RESOLVER")
+        if not mode or self.read_flow or (self.resolver and self.resolver.isRunning()): return
+
+        credentials = {'user': os.environ.get("PTT_RESOLVER_USER", ""),
+                       'password': os.environ.get("PTT_RESOLVER_PASSWORD", "")}
+        if mode == "standin":
+            transport = ptt_resolver.StandInTransport()
+        elif mode == "ws":
+            if not credentials['user']:
+                log.warning("PTT_RESOLVER=ws needs PTT_RESOLVER_USER and PTT_RESOLVER_PASSWORD")
+                return
+            transport = ptt_resolver.WebSocketTransport(flow.request.url, flow.request.headers.get("origin"))
+        else:
+            log.warning("Unknown PTT_RESOLVER: %s", mode)
+            return
+        self.resolver = ptt_resolver.URLResolver(transport, ptt_term.PttTerm.urlCache,
+                                                 credentials if credentials['user'] else None)
+        self.resolver.start()
+        ptt_term.PttTerm.resolver = self.resolver
+        log.info("Resolver started: %s", mode)
+
+    def stopResolver(self):
+        if self.resolver:
+            self.resolver.stop()
+            if ptt_term.PttTerm.resolver is self.resolver:
+                ptt_term.PttTerm.resolver = None
+            self.resolver = None
+
     # next_layer() is called to determine the next layer and return in nextlayer.layer
     def next_layer(self, nextlayer: layer.NextLayer):
         _layers = nextlayer.context.layers
@@ -304,32 +430,6 @@ class PttProxy:
 
     # reloading the addon script will not run the hook websocket_start()
     def websocket_start(self, flow: http.HTTPFlow):
-        class ProxyFlow:
-
-            @staticmethod
-            def sendToServer(data):
-                ctx.master.sendToServer(flow, data)
-
-            @staticmethod
-            def insertToClient(data):
-                if self.firstSegment:
-                    # insert ahead of the first segment
-                    print("Insert to client: ", len(data))
-                    self.current_message.content = data + self.current_message.content
-                else:
-                    self.standby_msgs += data
-                    print("Queued to insert: ", len(data))
-
-            @staticmethod
-            def sendToClient(data):
-                if self.lastSegment:
-                    # piggyback to the last segment
-                    print("Piggyback to client: ", len(data))
-                    self.current_message.content += data
-                else:
-                    self.standby_msgs += data
-                    print("Queued to send: ", len(data))
-
         print("websocket_start")
         wslayer = getattr(self, "wslayer", None)
         httplayer = getattr(self, "httplayer", None)
@@ -344,18 +444,30 @@ class PttProxy:
             print(wslayer)
             ctx.master.websocketLayerStarted(wslayer)
 
-        if not hasattr(self, "server_event"):
-            self.server_event = asyncio.Event()
-            self.server_task = asyncio.create_task(self.server_msg_timeout(flow, self.server_event))
-        pttTerm.flowStarted(ProxyFlow, self.read_flow)
+        session = self.sessions.pop(flow.id, None)
+        if session: session.close()
+        self.sessions[flow.id] = self.last_session = PttSession(flow, self.read_flow)
+        print("sessions:", len(self.sessions))
+
+        # the latest session saved is restored first, onto a new connection which starts at the login screen
+        if self.restoring:
+            self.restoreSnapshot(self.last_session, self.restoring.pop(), False, self.restoringVersion)
+
+        self.startResolver(flow)
 
     def websocket_end(self, flow: http.HTTPFlow):
         print("websocket_end")
-        if getattr(self, "wslayer", None):
+        if getattr(self, "wslayer", None) and self.wslayer.flow is flow:
             ctx.master.websocketLayerEnded(self.wslayer)
             self.httplayer = None
             self.wslayer = None
 
+        session = self.sessions.pop(flow.id, None)
+        if session: session.close()
+        if self.last_session is session:
+            self.last_session = next(reversed(self.sessions.values()), None)
+        print("sessions:", len(self.sessions))
+
     def websocket_message(self, flow: http.HTTPFlow):
         """
             Called when a WebSocket message is received from the client or
@@ -368,35 +480,13 @@ class PttProxy:
         flow_msg = flow.websocket.messages[-1]
         if ctx.master.is_self_injected(flow_msg): return
 
-        if flow_msg.from_client:
-            self.firstSegment = False
-            self.lastSegment  = False
-
-            self.purge_standby_message(flow)
-            self.purge_server_message(self.server_event)
-
-            resp = self.client_message(flow_msg.content)
-            if isinstance(resp, bytes):
-                if resp != flow_msg.content: print("replace client message:", resp)
-                flow_msg.content = resp
-            else:
-                print("Drop client message!")
-                flow_msg.drop()
-        else:
-            self.firstSegment = not self.server_event.is_set() # (len(flow.websocket.messages) == 1 or flow.websocket.messages[-2].from_client)
-            self.lastSegment  = (len(flow_msg.content) < 1021) # see the comment in server_message() for why it's 1021
-            self.current_message = flow_msg
-
-            original_content = flow_msg.content
+        session = self.session(flow)
+        if session is None:
+            log.warning("No session for flow %s", flow.id)
+            return
 
-            self.server_message(flow_msg.content)
-
-            if self.current_message.content is not original_content:
-                print("server -> client, changed:", len(self.current_message.content))
-
-            del self.current_message
-            self.firstSegment = False
-            self.lastSegment  = False
+        self.last_session = session
+        session.websocket_message(flow_msg)
 
     def websocket_handshake(self, flow: http.HTTPFlow):
         """
@@ -413,9 +503,8 @@ class PttProxy:
         """
         print("websocket_error", flow)
 
-def reload(oldproxy, oldterm):
+def reload(oldproxy):
     from mitmproxy.addonmanager import Loader
-    pttTerm.reload(oldterm)
 
     addons[0].load(Loader(ctx.master))
     addons[0].configure({'termlog_verbosity', 'flow_detail'})
@@ -425,12 +514,15 @@ def reload(oldproxy, oldterm):
 
     print("self.wslayer: ", addons[0].wslayer)
 
-    if addons[0].wslayer:
-        addons[0].websocket_start(addons[0].wslayer.flow)
-        # only valid in inPanel state
-        pttTerm.post_refresh()
+    # sessions of the old proxy are closed on done() but their snapshots are taken
+    for flow, snapshot in getattr(oldproxy, "snapshots", []):
+        addons[0].websocket_start(flow)
+        addons[0].restoreSnapshot(addons[0].session(flow), snapshot)
 
     addons[0].running()
+    # restored from the old proxy rather than the file
+    if getattr(oldproxy, "snapshots", None):
+        addons[0].restoring = []
 
 addons = [
     PttProxy()
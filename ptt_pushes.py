@@ -0,0 +1,232 @@
+import os
+import re
+import traceback
+from array import array
+from itertools import repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+    Push messages parsed into columns, i.e. arrays of the type, the user, the time and the floor,
+    and aggregated by NumPy per thread and per board.
+
+        ThreadPushes    the pushes of a thread being viewed, parsed from the lines captured by PttThread.pushSummary()
+        BoardPushes     the pushes of the threads of a board, e.g. read from the archive in bulk
+
+    A time is the minutes since the beginning of a year, as the year is not shown, NO_TIME if not shown.
+    The users are numbered per columns, so the columns of threads are merged by the names.
+    The columns are kept without NumPy, which is needed for the aggregates only.
+'''
+
+TYPES = "推噓→"
+PUSH, BOO, ARROW = 0, 1, 2
+TYPE_IDS = {t: i for i, t in enumerate(TYPES)}
+REMOVED = -1
+NO_TIME = -1
+
+MONTH_DAYS = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)    # the days before a month
+
+# e.g. "推 tester: 推文內容                         1.2.3.4 03/04 12:34"
+re_push = re.compile(r"(推|噓|→) ([0-9A-Za-z]+)\s*:.*?(?:(\d{1,2})/(\d{1,2}) (\d{1,2}):(\d{2}))?\s*$")
+# the time is found backwards from the end of a line
+re_pushes = re.compile(r"^(推|噓|→) ([0-9A-Za-z]+)[ \t]*:(?:[^\n]* (\d{1,2})/(\d{1,2}) (\d{1,2}):(\d{2})[ \t]*$)?[^\n]*$",
+                       re.M)
+re_url = re.compile(r"^※ 文章網址:", re.M)
+
+def minutes(month, day, hour, minute):
+    if not month: return NO_TIME
+    month, day = int(month), int(day)
+    if not 1 <= month <= 12: return NO_TIME
+    return ((MONTH_DAYS[month-1] + day - 1) * 24 + int(hour)) * 60 + int(minute)
+
+
+class PushColumns:
+
+    def __init__(self):
+        self.types = array('b')
+        self.users = array('i')
+        self.times = array('i')
+        self.floors = array('i')
+        self.names = []     # of the users
+        self.ids = {}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self.types)} pushes, {len(self.names)} users)"
+
+    def __len__(self):
+        return len(self.types)
+
+    def userId(self, name: str):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    # (type, user, time) of a push line or None
+    @staticmethod
+    def parse(text: str):
+        m = re_push.match(text)
+        if m is None: return None
+        return TYPE_IDS[m.group(1)], m.group(2), minutes(*m.group(3, 4, 5, 6))
+
+    def append(self, kind: int, name: str, time: int, floor=0):
+        self.types.append(kind)
+        self.users.append(self.userId(name))
+        self.times.append(time)
+        self.floors.append(floor)
+
+    # the pushes after the URL of the text of a thread, e.g. a file of the archive
+    @classmethod
+    def fromText(cls, text: str):
+        columns = cls()
+        url = re_url.search(text)
+        pushes = re_pushes.findall(text, url.end() if url else 0)
+        if not pushes: return columns
+        # column by column
+        kinds, names, months, days, hours, mins = zip(*pushes)
+        columns.types = array('b', map(TYPE_IDS.__getitem__, kinds))
+        columns.users = array('i', map(columns.userId, names))
+        columns.times = array('i', map(minutes, months, days, hours, mins))
+        columns.floors = array('i', range(1, len(pushes) + 1))
+        return columns
+
+    def summary(self, top=10, interval=60):
+        return summary(self, top, interval)
+
+
+class ThreadPushes(PushColumns):
+    '''
+        The push lines of a thread captured in any order, a line added again is parsed again only if changed.
+        The floors are taken from the thread by updateFloors() as they're known.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.lines = array('i')     # of the pushes
+        self.hashes = array('q')    # of the text of the pushes
+        self.rows = array('i')      # of the lines, -1 if not a push
+
+    def grow(self, count: int):
+        self.rows.extend(repeat(-1, count))
+
+    def add(self, line: int, text: str):
+        row = self.rows[line-1]
+        h = hash(text)
+        if row >= 0 and self.hashes[row] == h and self.types[row] != REMOVED: return
+        push = self.parse(text)
+        if push is None:
+            self.discard(line)
+            return
+        kind, name, time = push
+        if row < 0:
+            self.rows[line-1] = len(self.types)
+            self.append(kind, name, time)
+            self.lines.append(line)
+            self.hashes.append(h)
+        else:
+            self.types[row] = kind
+            self.users[row] = self.userId(name)
+            self.times[row] = time
+            self.hashes[row] = h
+
+    def discard(self, line: int):
+        row = self.rows[line-1]
+        if row >= 0: self.types[row] = REMOVED
+
+    # floor(line) is PttThread.floor(), a floor unknown or from the end is 0
+    def updateFloors(self, floor):
+        for row, line in enumerate(self.lines):
+            f = floor(line)
+            self.floors[row] = f if f and f > 0 else 0
+
+
+class BoardPushes:
+
+    def __init__(self, board: str = None):
+        self.board = board
+        self.threads = {}   # aidc -> PushColumns
+
+    def __repr__(self):
+        return f"BoardPushes({self.board}, {len(self.threads)} threads)"
+
+    def add(self, aidc: str, columns: PushColumns):
+        self.threads[aidc] = columns
+
+    # all threads of a board in the archive
+    @classmethod
+    def fromArchive(cls, board: str):
+        from ptt_persist import PttPersist
+
+        pushes = cls(board)
+        root, names = PttPersist.getThreads(board)
+        for aidc in names:
+            try:
+                with open(os.path.join(root, aidc), "r", encoding="utf-8") as f:
+                    pushes.add(aidc, PushColumns.fromText(f.read()))
+            except (OSError, UnicodeDecodeError):
+                traceback.print_exc()
+        return pushes
+
+    # the columns of all threads with the users numbered by the names, and the thread of each push
+    def merged(self):
+        checkNumpy()
+        columns = PushColumns()
+        threads = array('i')
+        for i, thread in enumerate(self.threads.values()):
+            remap = numpy.array([columns.userId(name) for name in thread.names], dtype=numpy.int32)
+            columns.types.extend(thread.types)
+            columns.users.frombytes(remap[numpy.frombuffer(thread.users, dtype=numpy.int32)].tobytes())
+            columns.times.extend(thread.times)
+            columns.floors.extend(thread.floors)
+            threads.extend(array('i', [i]) * len(thread))
+        return columns, threads
+
+    def summary(self, top=10, interval=24*60):
+        '''
+            summary() of all pushes, and the threads of the most pushes and boos
+            with the push ratio, i.e. pushes / (pushes + boos), of each.
+        '''
+        columns, threads = self.merged()
+        result = summary(columns, top, interval)
+        aidcs = list(self.threads)
+        types = numpy.frombuffer(columns.types, dtype=numpy.int8)
+        threads = numpy.frombuffer(threads, dtype=numpy.int32)
+        valid = types >= 0
+        counts = numpy.bincount(threads[valid] * 3 + types[valid], minlength=len(aidcs) * 3).reshape(-1, 3)
+        voted = counts[:, PUSH] + counts[:, BOO]
+        ratios = numpy.divide(counts[:, PUSH], voted, out=numpy.zeros(len(aidcs)), where=voted > 0)
+        order = numpy.lexsort((-counts[:, BOO], -counts[:, PUSH]))[:top]
+        result['threads'] = len(aidcs)
+        result['topThreads'] = [(aidcs[i], int(counts[i, PUSH]), int(counts[i, BOO]), float(ratios[i]))
+                                for i in order]
+        return result
+
+
+def checkNumpy():
+    if numpy is None:
+        raise ImportError("NumPy is needed for the aggregates of pushes")
+
+def summary(columns: PushColumns, top=10, interval=60):
+    '''
+        The counts of the types, the push ratio, i.e. pushes / (pushes + boos), the users of the most pushes,
+        and the pushes over time in intervals of minutes since the first one.
+    '''
+    checkNumpy()
+    types = numpy.frombuffer(columns.types, dtype=numpy.int8)
+    valid = types >= 0
+    counts = numpy.bincount(types[valid], minlength=3)
+    users = numpy.bincount(numpy.frombuffer(columns.users, dtype=numpy.int32)[valid], minlength=len(columns.names))
+    order = numpy.argsort(-users, kind='stable')[:top]
+    times = numpy.frombuffer(columns.times, dtype=numpy.int32)[valid]
+    times = times[times != NO_TIME]
+    start = int(times.min()) if len(times) else NO_TIME
+    timeline = numpy.bincount((times - start) // interval).tolist() if len(times) else []
+    voted = int(counts[PUSH] + counts[BOO])
+    return {'pushes': int(counts[PUSH]), 'boos': int(counts[BOO]), 'arrows': int(counts[ARROW]),
+            'ratio': float(counts[PUSH] / voted) if voted else 0.0,
+            'topUsers': [(columns.names[i], int(users[i])) for i in order if users[i]],
+            'timeline': (start, interval, timeline)}
@@ -0,0 +1,215 @@
+import time
+import asyncio
+import argparse
+import traceback
+
+from mitmproxy import ctx, io, http
+
+import ptt_proxy
+from ptt_stats import latency
+
+'''
+    Replays recorded WebSocket flows into PttProxy without running mitmproxy.
+
+        python ptt_replay.py dumps/ws_ptt_dump
+        python ptt_replay.py --synthetic 200
+
+    Messages are fed to PttProxy.websocket_message() with stub flow and master objects.
+    The event loop runs on a virtual clock, i.e. whenever the loop would wait for a timer the clock jumps to it,
+    so the timeouts of server bursts and macros expire instantly while the recorded pacing between messages is kept.
+    It reports messages/s and refreshes/s per CPU second, and the wall time per stage from the latency histograms,
+    which are timed by time.perf_counter().
+    Macros run only with recorded dumps, the synthetic flow starts in a thread and never shows the main menu.
+'''
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self):
+        super().__init__()
+        self.clock = 0.0
+        self.jumped = 0.0
+
+        loop = self
+        selector = self._selector
+
+        class _Selector:
+            def select(self, timeout=None):
+                # nothing is ready in real time, jump to the next timer
+                if timeout:
+                    loop.clock += timeout
+                    loop.jumped += timeout
+                return selector.select(0)
+
+            def __getattr__(self, name):
+                return getattr(selector, name)
+
+        self._selector = _Selector()
+
+    def time(self):
+        return self.clock
+
+
+class ReplayMessage:
+
+    def __init__(self, from_client: bool, content: bytes, timestamp: float):
+        self.from_client = from_client
+        self.content = content
+        self.timestamp = timestamp
+        self.dropped = False
+
+    def drop(self):
+        self.dropped = True
+
+
+class ReplayWebSocket:
+
+    def __init__(self):
+        self.messages = []
+        self.timestamp_end = None
+
+
+class ReplayFlow:
+
+    def __init__(self, id: str, messages):
+        self.id = id
+        self.websocket = ReplayWebSocket()
+        # (from_client, content, timestamp) to replay
+        self.recorded = messages
+
+
+class ReplayMaster:
+
+    def __init__(self):
+        self.toServer = 0
+        self.toClient = 0
+
+    def sendToServer(self, flow, data):
+        self.toServer += 1
+
+    def sendToClient(self, flow, data):
+        self.toClient += 1
+
+    def is_self_injected(self, flow_msg):
+        return False
+
+    def websocketLayerStarted(self, wslayer):
+        return False
+
+    def websocketLayerEnded(self, wslayer):
+        pass
+
+
+def readFlows(path: str):
+    flows = []
+    with open(path, "rb") as f:
+        for flow in io.FlowReader(f).stream():
+            if not isinstance(flow, http.HTTPFlow) or not flow.websocket: continue
+            messages = [(m.from_client, m.content, m.timestamp) for m in flow.websocket.messages]
+            flows.append(ReplayFlow(flow.id, messages))
+    return flows
+
+# pages of the article browser separated by keys to scroll, see ptt_bench.samplePage()
+def syntheticFlow(pages: int):
+    from ptt_bench import samplePage, segments
+    messages = []
+    t = 0.0
+    first = 1
+    for n in range(pages):
+        t += 0.2
+        # scroll by a page or a line
+        if n % 2:
+            messages.append((True, b'\x1b[6~', t))
+            first += 31
+        else:
+            messages.append((True, b'\x1b[B', t))
+            first += 1
+        for seg in segments(samplePage(31, first)):
+            t += 0.003
+            messages.append((False, seg, t))
+    return [ReplayFlow("synthetic", messages)]
+
+
+async def replay(flows, macro: bool):
+    ctx.master = master = ReplayMaster()
+    proxy = ptt_proxy.PttProxy()
+    proxy.load(None)
+    # flows read from file don't run macro
+    proxy.read_flow = not macro
+    # sessions are neither saved nor restored
+    proxy.snapshot_filename = None
+    proxy.running()
+
+    count = 0
+    loop = asyncio.get_running_loop()
+    for flow in flows:
+        proxy.websocket_start(flow)
+        if not flow.recorded: continue
+        start = flow.recorded[0][2]
+        origin = loop.time()
+        for from_client, content, timestamp in flow.recorded:
+            delay = origin + (timestamp - start) - loop.time()
+            if delay > 0: await asyncio.sleep(delay)
+            flow.websocket.messages.append(ReplayMessage(from_client, content, timestamp))
+            try:
+                proxy.websocket_message(flow)
+            except Exception:
+                traceback.print_exc()
+            count += 1
+        # let the pending burst and macros finish
+        await asyncio.sleep(1.0)
+        flow.websocket.timestamp_end = loop.time()
+        proxy.websocket_end(flow)
+
+    proxy.done()
+    return count, master
+
+def report(count, master, wall, cpu, virtual):
+    refreshes = latency.histogram("post_refresh").count
+    print()
+    print(f"messages: {count}, refreshes: {refreshes}, to server: {master.toServer}, to client: {master.toClient}")
+    print(f"wall: {wall:.3f} s, cpu: {cpu:.3f} s, virtual: {virtual:.3f} s")
+    if cpu > 0:
+        print(f"messages/s: {count / cpu:.1f}, refreshes/s: {refreshes / cpu:.1f} (per cpu second)")
+    print()
+    print("%-16s %8s %12s %10s" % ("stage", "count", "wall (ms)", "share"))
+    stages = ["server", "client", "pre_update", "feed", "post_refresh", "updateThread"]
+    for stage in stages:
+        h = latency.histogram(stage)
+        share = h.total / 1000000 / wall * 100 if wall > 0 else 0
+        print("%-16s %8d %12.3f %9.1f%%" % (stage, h.count, h.total / 1000, share))
+    print()
+    latency.show()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded WebSocket flows into PttProxy")
+    parser.add_argument("dumps", nargs="*", help="files written by mitmdump -w")
+    parser.add_argument("--synthetic", type=int, default=0, help="replay a synthetic flow of the given pages")
+    parser.add_argument("--macro", action="store_true", help="run macros as if the flow were live")
+    args = parser.parse_args()
+    if args.macro and args.synthetic:
+        parser.error("--macro doesn't run with --synthetic, which never shows the main menu")
+
+    flows = []
+    for path in args.dumps:
+        flows.extend(readFlows(path))
+    if args.synthetic:
+        flows.extend(syntheticFlow(args.synthetic))
+    if not flows:
+        parser.error("no WebSocket flow to replay")
+
+    latency.reset()
+    loop = VirtualClockLoop()
+    try:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        count, master = loop.run_until_complete(replay(flows, args.macro))
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+    finally:
+        loop.close()
+
+    report(count, master, wall, cpu, loop.clock)
+
+if __name__ == "__main__":
+    main()
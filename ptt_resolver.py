@@ -0,0 +1,470 @@
+import ssl
+import asyncio
+import traceback
+from collections import deque
+from urllib.parse import urlsplit
+
+import pyte
+
+from ptt_screen import CompactScreen
+from ptt_thread import PttThread
+from ptt_urlcache import ThreadURLCache
+from ptt_boardlist import BoardIndex, BoardRow
+from ptt_term import PttTerm, Big5UAOIncrementalDecoder
+from ptt_stats import latency
+import ptt_log
+
+log = ptt_log.getLogger("resolver")
+
+'''
+    Resolves the URLs of the rows in the board list being viewed ahead of time, on a hidden session of its own,
+    so the session of the user enters them without 'Q' (see ThreadURLCache).
+
+    The hidden session is a transport of bytes to and from a PTT server:
+        WebSocketTransport  a WebSocket connection to the upstream of the proxy, logged in as PTT_RESOLVER_USER
+        StandInTransport    a local stand-in of the server for testing
+
+    It's off unless the environment variable PTT_RESOLVER is "ws" or "standin", see PttProxy.startResolver().
+'''
+
+
+class TokenBucket:
+    '''
+        At most rate acquisitions per second on average and burst at once.
+    '''
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HiddenTerm:
+    '''
+        The screen of the hidden session, version counts the messages fed.
+    '''
+
+    def __init__(self, columns, lines):
+        self.screen = CompactScreen(columns, lines)
+        self.stream = pyte.Stream()
+        self.stream.attach(self.screen)
+        self.decoder = Big5UAOIncrementalDecoder('replace')
+        self.version = 0
+        self.updated = asyncio.Event()
+
+    def feed(self, data: bytes):
+        self.stream.feed(self.decoder.decode(data))
+        self.version += 1
+        self.updated.set()
+
+    @property
+    def display(self):
+        return self.screen.display
+
+    def classify(self):
+        return PttTerm.classifier.classify(self.display)
+
+    def cursorLine(self):
+        return self.display[self.screen.cursor.y]
+
+    # the BoardRow at the cursor, see ptt_boardlist.py
+    def cursorRow(self):
+        return BoardIndex.parseRow(self.cursorLine())
+
+    def find(self, text: str):
+        return any(text in line for line in self.display)
+
+    # the result of the predicate once true after the version, None on timeout
+    async def waitFor(self, predicate, timeout: float, since=-1):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            self.updated.clear()
+            if self.version > since:
+                result = predicate(self)
+                if result: return result
+            remaining = deadline - loop.time()
+            if remaining <= 0: return None
+            try:
+                await asyncio.wait_for(self.updated.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+
+class URLResolver:
+    '''
+        Rows are queued by request() as the user views a board list, the latest first and the oldest dropped
+        once the queue is full. A row is resolved by entering its board, jumping to its number and reading its 'Q' box,
+        at most RATE rows per second.
+    '''
+
+    QUEUE_SIZE = 64
+    RATE = 1.0      # rows per second
+    BURST = 3
+    TIMEOUT = 5.0   # for the server to draw an expected screen
+    COLUMNS = 128
+    LINES = 32
+
+    # prompts after the login and the keys to answer
+    loginPrompts = [("請輸入代號", 'user'), ("請輸入您的密碼", 'password'),
+                    ("重複登入", b"n\r"), ("錯誤嘗試", b"n\r"), ("請按任意鍵繼續", b" ")]
+
+    def __init__(self, transport, cache: ThreadURLCache, credentials=None,
+                 rate=RATE, burst=BURST, queueSize=QUEUE_SIZE):
+        self.transport = transport
+        self.cache = cache
+        self.credentials = credentials  # {'user': str, 'password': str}
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = deque(maxlen=queueSize)    # (board, row)
+        self.queued = set()
+        self.wakeup = asyncio.Event()
+        self.term = HiddenTerm(self.COLUMNS, self.LINES)
+        self.board = None   # where the hidden session is
+        self.task = None
+        self.resolved = self.failed = self.dropped = 0
+
+    def __repr__(self):
+        return f"URLResolver(queued {len(self.queue)}, resolved {self.resolved}, failed {self.failed}, " \
+               f"dropped {self.dropped})"
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def isRunning(self):
+        return self.task is not None and not self.task.done()
+
+    # BoardRow of the board list, rows resolved or being queued are skipped
+    def request(self, board: str, rows):
+        if not board or not self.isRunning(): return 0
+        count = 0
+        for row in rows:
+            # a sticky thread can't be jumped to
+            if row is None or row.number is None or row.deleted: continue
+            # the push count changes
+            row = row._replace(push=0)
+            key = (board, row)
+            if key in self.queued or self.cache.find(board, row): continue
+            if len(self.queue) == self.queue.maxlen:
+                self.queued.discard(self.queue[0])
+                self.dropped += 1
+            self.queue.append(key)
+            self.queued.add(key)
+            count += 1
+        if count: self.wakeup.set()
+        return count
+
+    async def run(self):
+        reader = None
+        try:
+            await self.transport.connect()
+            reader = asyncio.create_task(self.receive())
+            if not await self.login():
+                log.warning("Resolver failed to log in")
+                return
+            log.info("Resolver logged in")
+
+            while not reader.done():
+                if not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                key = self.queue.pop()
+                self.queued.discard(key)
+                board, row = key
+                if self.cache.find(board, row): continue
+
+                await self.bucket.acquire()
+                t = latency.timer()
+                url = await self.resolve(board, row)
+                latency.record("resolve", t)
+                if url:
+                    self.resolved += 1
+                else:
+                    self.failed += 1
+                    log.debug("Resolver failed: %s %s", board, row)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if reader: reader.cancel()
+            await self.transport.close()
+            log.info("%s finished", self)
+
+    async def receive(self):
+        try:
+            while True:
+                self.term.feed(await self.transport.receive())
+        except (ConnectionError, EOFError) as e:
+            log.warning("Resolver disconnected: %s", e)
+        finally:
+            # run() waiting for rows sees the reader done
+            self.wakeup.set()
+
+    async def send(self, data: bytes):
+        version = self.term.version
+        await self.transport.send(data)
+        return version
+
+    async def login(self):
+        for _ in range(10):
+            screen = await self.term.waitFor(self.loginScreen, self.TIMEOUT)
+            if screen is None: return False
+            if screen is True: return True
+            if isinstance(screen, str):
+                if not self.credentials: return False
+                answer = (self.credentials.get(screen, "") + "\r").encode()
+            else:
+                answer = screen
+            since = await self.send(answer)
+            await self.term.waitFor(lambda term: True, self.TIMEOUT, since)
+        return False
+
+    # True in the main menu, or the answer to a prompt
+    def loginScreen(self, term):
+        if term.classify()[0] == PttTerm._State.InPanel: return True
+        for prompt, answer in self.loginPrompts:
+            if term.find(prompt): return answer
+        return None
+
+    async def enterBoard(self, board: str):
+        since = await self.send(b's' + board.encode() + b'\r')
+        for _ in range(3):
+            state = await self.term.waitFor(lambda term: self.boardScreen(term, board), self.TIMEOUT, since)
+            if state is None: return False
+            if state == PttTerm._State.InBoard: return True
+            # the welcome screen of a board
+            since = await self.send(b' ')
+        return False
+
+    @staticmethod
+    def boardScreen(term, board):
+        state, fields = term.classify()
+        if state == PttTerm._State.InBoard and (fields['board'] or "").lower() == board.lower():
+            return state
+        if state == PttTerm._State.Waiting and term.find("任意鍵"):
+            return state
+        return None
+
+    async def resolve(self, board: str, row: BoardRow):
+        if self.board != board:
+            self.board = None
+            if not await self.enterBoard(board): return None
+            self.board = board
+
+        # jump to the number
+        since = await self.send(str(row.number).encode() + b'\r')
+        found = await self.term.waitFor(lambda term: self.atRow(term, row.number), self.TIMEOUT, since)
+        # a thread of which the number is changed is another
+        if not found or (found.date, found.author) != (row.date, row.author) or \
+           not (found.title.startswith(row.title) or row.title.startswith(found.title)):
+            return None
+
+        since = await self.send(b'Q')
+        url = await self.term.waitFor(lambda term: PttTerm.findURL(term.display), self.TIMEOUT, since)
+        since = await self.send(b' ')
+        if not await self.term.waitFor(lambda term: term.classify()[0] == PttTerm._State.InBoard,
+                                       self.TIMEOUT, since):
+            self.board = None
+        if url:
+            self.cache.put(board, found, url)
+        return url
+
+    @staticmethod
+    def atRow(term, number: int):
+        row = term.cursorRow()
+        return row if row and row.number == number else None
+
+
+class WebSocketTransport:
+    '''
+        A WebSocket connection of binary messages by wsproto, which mitmproxy depends on.
+    '''
+
+    def __init__(self, url: str, origin: str = None):
+        parts = urlsplit(url)
+        self.secure = parts.scheme in ("wss", "https")
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.secure else 80)
+        self.target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.origin = origin
+        self.reader = self.writer = None
+        self.messages = deque()
+        self.partial = []
+
+    async def connect(self):
+        from wsproto import WSConnection, ConnectionType
+        from wsproto.events import Request, AcceptConnection, RejectConnection
+
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.secure else None)
+        self.ws = WSConnection(ConnectionType.CLIENT)
+        headers = [(b"origin", self.origin.encode())] if self.origin else []
+        self.writer.write(self.ws.send(Request(host=self.host, target=self.target, extra_headers=headers)))
+        await self.writer.drain()
+        while True:
+            for event in await self.events():
+                if isinstance(event, AcceptConnection): return
+                if isinstance(event, RejectConnection):
+                    raise ConnectionError(f"WebSocket rejected: {event.status_code}")
+
+    async def events(self):
+        data = await self.reader.read(65536)
+        if not data: raise ConnectionError("closed by the server")
+        self.ws.receive_data(data)
+        return list(self.ws.events())
+
+    async def send(self, data: bytes):
+        from wsproto.events import Message
+        self.writer.write(self.ws.send(Message(data=data)))
+        await self.writer.drain()
+
+    async def receive(self):
+        from wsproto.events import BytesMessage, TextMessage, Ping, CloseConnection
+
+        while not self.messages:
+            for event in await self.events():
+                if isinstance(event, (BytesMessage, TextMessage)):
+                    self.partial.append(event.data if isinstance(event.data, bytes) else event.data.encode())
+                    if event.message_finished:
+                        self.messages.append(b''.join(self.partial))
+                        self.partial = []
+                elif isinstance(event, Ping):
+                    self.writer.write(self.ws.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    raise ConnectionError(f"closed: {event.code}")
+        return self.messages.popleft()
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+
+class StandInTransport:
+    '''
+        A local stand-in of the PTT server with the main menu and boards of posts
+        of which the rows are drawn as ptt_bench.sampleBoard() does. It answers after a delay.
+
+            's' board Enter     enters the board
+            number Enter        jumps to the post
+            'Q'                 shows the box of the AID and the URL until any key
+    '''
+
+    def __init__(self, boards=None, delay=0.02, columns=URLResolver.COLUMNS, lines=URLResolver.LINES):
+        self.boards = boards or {'Test': 100}   # board -> posts
+        self.delay = delay
+        self.columns = columns
+        self.lines = lines
+        self.incoming = None
+        self.mode = 'menu'
+        self.input = ''
+        self.board = None
+        self.cursor = 1
+        self.sent = 0   # messages from the client
+
+    @staticmethod
+    def url(board: str, n: int):
+        return PttThread.fn2url(board, f"M.{1600000000 + n}.A.{n % 4096:03X}")
+
+    async def connect(self):
+        self.incoming = asyncio.Queue()
+        self.respond(self.menuScreen())
+
+    async def send(self, data: bytes):
+        self.sent += 1
+        screens = [self.key(c) for c in data.decode("latin-1")]
+        screen = b''.join(s for s in screens if s)
+        if screen: self.respond(screen)
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def close(self):
+        pass
+
+    def respond(self, screen: bytes):
+        asyncio.get_running_loop().call_later(self.delay, self.incoming.put_nowait, screen)
+
+    def key(self, c: str):
+        if self.mode == 'menu':
+            if c == 's':
+                self.mode, self.input = 'search', ''
+                return self.status("請輸入看板名稱(按空白鍵自動搜尋)：")
+        elif self.mode == 'search':
+            if c != '\r':
+                self.input += c
+                return None
+            board = next((b for b in self.boards if b.lower() == self.input.lower()), None)
+            if board is None:
+                self.mode = 'menu' if self.board is None else 'board'
+                return self.menuScreen() if self.board is None else self.boardScreen()
+            self.mode, self.board, self.cursor = 'board', board, self.boards[board]
+            return self.boardScreen()
+        elif self.mode == 'board':
+            if c.isdigit():
+                self.mode, self.input = 'jump', c
+                return self.status(f"跳至第幾項: {c}")
+            if c == 's':
+                self.mode, self.input = 'search', ''
+                return self.status("請輸入看板名稱(按空白鍵自動搜尋)：")
+            if c == 'Q':
+                self.mode = 'box'
+                return self.boxScreen()
+        elif self.mode == 'jump':
+            if c.isdigit():
+                self.input += c
+                return self.status(f"跳至第幾項: {self.input}")
+            self.mode = 'board'
+            if c == '\r':
+                self.cursor = min(max(int(self.input), 1), self.boards[self.board])
+            return self.boardScreen()
+        elif self.mode == 'box':
+            self.mode = 'board'
+            return self.boardScreen()
+        return None
+
+    def status(self, text: str):
+        return f"\x1b[{self.lines};1H\x1b[K{text}".encode("big5uao", "replace")
+
+    def menuScreen(self):
+        return "\x1b[H\x1b[2J\x1b[1;37;44m【主功能表】                    批踢踢實業坊\x1b[m".encode("big5uao", "replace")
+
+    def boardScreen(self):
+        rows = self.lines - 4
+        first = (self.cursor - 1) // rows * rows + 1
+        screen = f"\x1b[H\x1b[2J\x1b[1;37;44m【板主:tester】          測試看板                  看板《{self.board}》\x1b[m"
+        screen += "\x1b[3;1H   編號    日 期 作  者       文  章  標  題"
+        for n in range(first, min(first + rows, self.boards[self.board] + 1)):
+            screen += f"\x1b[{n - first + 4};1H{'>' if n == self.cursor else ' '}{n:6}   3/04 user{n:05d}    □ [測試] 第 {n} 篇文章"
+        screen += f"\x1b[{self.lines};1H\x1b[34;46m 文章選讀 \x1b[30;47m (y)回應(X)推文(^X)轉錄 (=[]<>)相關主題\x1b[m"
+        screen += f"\x1b[{(self.cursor - first) + 4};1H"
+        return screen.encode("big5uao", "replace")
+
+    def boxScreen(self):
+        url = self.url(self.board, self.cursor)
+        aidc = PttThread.fn2aidc(PttThread.url2fn(url)[1])
+        box = f"\x1b[10;1H┌──────────────────────────────────────┐" \
+              f"\x1b[11;1H│ 文章代碼(AID): #{aidc} ({self.board}) [ptt.cc] [測試] 第 {self.cursor} 篇文章 │" \
+              f"\x1b[12;1H│ 文章網址: {url} │" \
+              f"\x1b[13;1H└──────────────────────────────────────┘" \
+              f"\x1b[{self.lines};1H\x1b[K請按任意鍵繼續"
+        return box.encode("big5uao", "replace")
@@ -0,0 +1,634 @@
+import re
+import sys
+from array import array
+
+import pyte
+from pyte import modes as mo
+from pyte.screens import Char, Margins
+
+
+class CompactScreen(pyte.Screen):
+    '''
+        A pyte screen of which a row is an array of code points and an array of packed attributes
+        rather than a list of Char, i.e. two objects per row instead of one per cell.
+
+        A character above U+00FF, i.e. a double-byte character of Big5-UAO, takes two cells
+        as MyScreen of ptt_term.py draws it, the second cell is STUB and isn't displayed.
+        Changed rows are recorded in dirty as pyte.DiffScreen does.
+
+        marks are what ScreenOverlay drew over the rows on the client, see mark(). A mark moves with
+        its row when the screen scrolls and is removed once the row is written over at its columns.
+
+        buffer is built from the arrays on access for compatibility, it's slow and read-only.
+    '''
+
+    STUB = 0
+    UTF32 = "utf-32-le" if sys.byteorder == "little" else "utf-32-be"
+
+    # an attribute is packed as fg | bg << COLOR_BITS | flags << 2*COLOR_BITS
+    # where flags are the boolean fields of Char, e.g. bold and reverse
+    COLOR_BITS = 12
+    COLOR_MASK = (1 << COLOR_BITS) - 1
+    flagFields = Char._fields[3:]
+    REVERSE = 1 << (2 * COLOR_BITS + flagFields.index("reverse"))
+
+    # color names are shared by all screens
+    colors = ["default"]
+    colorIndex = {"default": 0}
+
+    def __init__(self, columns, lines):
+        self.dirty = set()
+        self.chars = []
+        self.attrs = []
+        self.marks = []     # (begin, end, data) or None by row
+        self._cursorChar = None     # cursor.attrs of which _cursorAttr is packed
+        self._cursorAttr = 0
+        super().__init__(columns, lines)
+
+    @property
+    def buffer(self):
+        return [[self.unpack(code, attr) for code, attr in zip(chars, attrs)]
+                for chars, attrs in zip(self.chars, self.attrs)]
+
+    @buffer.setter
+    def buffer(self, value):
+        # assigned by pyte.Screen.__init__(), the arrays are the buffer
+        pass
+
+    @property
+    def display(self):
+        return [chars.tobytes().decode(self.UTF32).replace('\0', '') for chars in self.chars]
+
+    # cells of a row as strings, '' for STUB
+    def cells(self, y: int):
+        return [chr(code) if code != self.STUB else '' for code in self.chars[y]]
+
+    # the contents, the cursor and the modes as built-in objects, see ptt_snapshot.py
+    def getSnapshot(self):
+        cursor = self.cursor
+        return {'columns': self.columns, 'lines': self.lines,
+                'chars': [chars.tobytes() for chars in self.chars],
+                'attrs': [attrs.tobytes() for attrs in self.attrs],
+                'colors': list(self.colors),
+                'cursor': (cursor.x, cursor.y, cursor.hidden, dict(cursor.attrs._asdict())),
+                'mode': sorted(self.mode), 'margins': tuple(self.margins), 'tabstops': sorted(self.tabstops),
+                'charset': self.charset}
+
+    def setSnapshot(self, state):
+        rows = list(zip(state['chars'], state['attrs']))
+        size = state['columns'] * self.chars[0].itemsize
+        if len(rows) != state['lines'] or any(len(chars) != size or len(attrs) != size for chars, attrs in rows):
+            return False
+        self.resize(state['lines'], state['columns'])
+
+        # the colors are indexed in the order they are seen by a process
+        colors = [self.color(name) for name in state['colors']]
+        remap = colors != list(range(len(colors)))
+        for y, (chars, attrs) in enumerate(rows):
+            self.chars[y] = array('I', chars)
+            self.attrs[y] = array('I', attrs)
+            if remap:
+                row = self.attrs[y]
+                for x, attr in enumerate(row):
+                    row[x] = (attr & ~(self.COLOR_MASK | self.COLOR_MASK << self.COLOR_BITS) |
+                              colors[attr & self.COLOR_MASK] |
+                              colors[attr >> self.COLOR_BITS & self.COLOR_MASK] << self.COLOR_BITS)
+
+        x, y, hidden, attrs = state['cursor']
+        self.cursor.x, self.cursor.y, self.cursor.hidden = x, y, hidden
+        self.cursor.attrs = self.cursor.attrs._replace(**{k: v for k, v in attrs.items()
+                                                          if k in self.cursor.attrs._fields})
+        self.mode = set(state['mode'])
+        self.margins = Margins(*state['margins'])
+        self.tabstops = set(state['tabstops'])
+        self.charset = state.get('charset', 0)
+        self.dirty.update(range(self.lines))
+        self.marks[:] = [None] * self.lines
+        return True
+
+    # data drawn over the cells [begin, end) of a row by the client only
+    def mark(self, y: int, begin: int, end: int, data: bytes):
+        self.marks[y] = (begin, end, data) if data else None
+
+    def marked(self, y: int, begin: int, end: int):
+        mark = self.marks[y]
+        return mark[2] if mark and mark[0] == begin and mark[1] == end else None
+
+    # the cells [begin, end) of a row are written
+    def unmark(self, y: int, begin: int, end: int):
+        mark = self.marks[y]
+        if mark and begin < mark[1] and mark[0] < end:
+            self.marks[y] = None
+
+    @classmethod
+    def color(cls, name):
+        index = cls.colorIndex.get(name)
+        if index is None:
+            index = len(cls.colors)
+            assert index <= cls.COLOR_MASK, "Too many colors"
+            cls.colors.append(name)
+            cls.colorIndex[name] = index
+        return index
+
+    @classmethod
+    def pack(cls, char: Char):
+        attr = cls.color(char.fg) | cls.color(char.bg) << cls.COLOR_BITS
+        for bit, field in enumerate(cls.flagFields, 2 * cls.COLOR_BITS):
+            if getattr(char, field): attr |= 1 << bit
+        return attr
+
+    @classmethod
+    def unpack(cls, code: int, attr: int):
+        # Char.__new__() doesn't take the fields in order
+        flags = {field: bool(attr >> bit & 1) for bit, field in enumerate(cls.flagFields, 2 * cls.COLOR_BITS)}
+        return Char(data=chr(code) if code != cls.STUB else '', fg=cls.colors[attr & cls.COLOR_MASK],
+                    bg=cls.colors[attr >> cls.COLOR_BITS & cls.COLOR_MASK], **flags)
+
+    def cursorAttr(self):
+        char = self.cursor.attrs
+        if char is not self._cursorChar:
+            self._cursorChar = char
+            self._cursorAttr = self.pack(char)
+        return self._cursorAttr
+
+    # a row filled with the character
+    def row(self, char: Char, columns=None):
+        if columns is None: columns = self.columns
+        return (array('I', [ord(char.data) if char.data else self.STUB]) * columns,
+                array('I', [self.pack(char)]) * columns)
+
+    def fill(self, y: int, begin: int, end: int, char: Char):
+        end = min(end, self.columns)
+        if begin >= end: return
+        chars, attrs = self.row(char, end - begin)
+        self.chars[y][begin:end] = chars
+        self.attrs[y][begin:end] = attrs
+        self.dirty.add(y)
+        if self.marks[y]: self.unmark(y, begin, end)
+
+    def reset(self):
+        self.dirty.update(range(self.lines))
+        rows = [self.row(self.default_char) for _ in range(self.lines)]
+        self.chars[:] = [chars for chars, _ in rows]
+        self.attrs[:] = [attrs for _, attrs in rows]
+        self.marks[:] = [None] * self.lines
+        super().reset()
+
+    def resize(self, lines=None, columns=None):
+        lines = lines or self.lines
+        columns = columns or self.columns
+
+        # lines are added to or taken off the bottom, columns are added to or clipped at the right
+        diff = self.lines - lines
+        if diff < 0:
+            for _ in range(-diff):
+                chars, attrs = self.row(self.default_char)
+                self.chars.append(chars)
+                self.attrs.append(attrs)
+        elif diff > 0:
+            del self.chars[:diff]
+            del self.attrs[:diff]
+
+        diff = self.columns - columns
+        if diff < 0:
+            blank, attr = self.row(self.default_char, -diff)
+            for chars, attrs in zip(self.chars, self.attrs):
+                chars.extend(blank)
+                attrs.extend(attr)
+        elif diff > 0:
+            for chars, attrs in zip(self.chars, self.attrs):
+                del chars[columns:]
+                del attrs[columns:]
+
+        self.dirty.clear()
+        self.dirty.update(range(lines))
+        self.marks[:] = [None] * lines
+        self.lines, self.columns = lines, columns
+        self.margins = Margins(0, self.lines - 1)
+        self.reset_mode(mo.DECOM)
+
+    def reverse(self, enabled: bool):
+        for attrs in self.attrs:
+            for x, attr in enumerate(attrs):
+                attrs[x] = attr | self.REVERSE if enabled else attr & ~self.REVERSE
+        self.dirty.update(range(self.lines))
+
+    def set_mode(self, *modes, **kwargs):
+        super().set_mode(*modes, **kwargs)
+        if mo.DECSCNM in (modes if not kwargs.get("private") else [mode << 5 for mode in modes]):
+            self.reverse(True)
+
+    def reset_mode(self, *modes, **kwargs):
+        super().reset_mode(*modes, **kwargs)
+        if mo.DECSCNM in (modes if not kwargs.get("private") else [mode << 5 for mode in modes]):
+            self.reverse(False)
+
+    def draw(self, char):
+        code = ord(char)
+        # a character is double-byte by the code before translated, as MyScreen draws it
+        wide = code > 0xff
+        if not wide:
+            code = ord(char.translate(self.g1_charset if self.charset else self.g0_charset))
+        elif self.cursor.x + 2 <= self.columns and mo.IRM not in self.mode:
+            # a double-byte character at once
+            x, y = self.cursor.x, self.cursor.y
+            chars = self.chars[y]
+            chars[x] = code
+            chars[x + 1] = self.STUB
+            attrs = self.attrs[y]
+            attrs[x] = attrs[x + 1] = self.cursorAttr()
+            self.cursor.x = x + 2
+            self.dirty.add(y)
+            if self.marks[y]: self.unmark(y, x, x + 2)
+            return
+
+        self.put(code)
+        if wide:
+            self.put(self.STUB)
+
+    # put a cell at the cursor and advance the cursor
+    def put(self, code: int):
+        if self.cursor.x == self.columns:
+            if mo.DECAWM in self.mode:
+                self.carriage_return()
+                self.linefeed()
+            else:
+                self.cursor.x -= 1
+
+        if mo.IRM in self.mode:
+            self.insert_characters(1)
+
+        x, y = self.cursor.x, self.cursor.y
+        self.chars[y][x] = code
+        self.attrs[y][x] = self.cursorAttr()
+        self.dirty.add(y)
+        if self.marks[y]: self.unmark(y, x, x + 1)
+        self.cursor.x = x + 1
+
+    # remove the row at begin and insert a row at end
+    def scroll(self, begin: int, end: int, char: Char):
+        del self.chars[begin]
+        del self.attrs[begin]
+        del self.marks[begin]
+        chars, attrs = self.row(char)
+        self.chars.insert(end, chars)
+        self.attrs.insert(end, attrs)
+        self.marks.insert(end, None)
+        self.dirty.update(range(min(begin, end), max(begin, end) + 1))
+
+    def index(self):
+        top, bottom = self.margins
+        if self.cursor.y == bottom:
+            self.scroll(top, bottom, self.default_char)
+        else:
+            self.cursor_down()
+
+    def reverse_index(self):
+        top, bottom = self.margins
+        if self.cursor.y == top:
+            self.scroll(bottom, top, self.default_char)
+        else:
+            self.cursor_up()
+
+    def insert_lines(self, count=None):
+        count = count or 1
+        top, bottom = self.margins
+
+        if top <= self.cursor.y <= bottom:
+            for line in range(self.cursor.y, min(bottom + 1, self.cursor.y + count)):
+                self.scroll(bottom, line, self.default_char)
+            self.carriage_return()
+
+    def delete_lines(self, count=None):
+        count = count or 1
+        top, bottom = self.margins
+
+        if top <= self.cursor.y <= bottom:
+            for _ in range(min(bottom - self.cursor.y + 1, count)):
+                self.scroll(self.cursor.y, bottom, self.cursor.attrs)
+            self.carriage_return()
+
+    def insert_characters(self, count=None):
+        count = min(self.columns - self.cursor.x, count or 1)
+        x, y = self.cursor.x, self.cursor.y
+        chars, attrs = self.row(self.cursor.attrs, count)
+        self.chars[y][x:x] = chars
+        self.attrs[y][x:x] = attrs
+        del self.chars[y][self.columns:]
+        del self.attrs[y][self.columns:]
+        self.dirty.add(y)
+        if self.marks[y]: self.unmark(y, x, self.columns)
+
+    def delete_characters(self, count=None):
+        count = min(self.columns - self.cursor.x, count or 1)
+        x, y = self.cursor.x, self.cursor.y
+        chars, attrs = self.row(self.cursor.attrs, count)
+        del self.chars[y][x:x + count]
+        del self.attrs[y][x:x + count]
+        self.chars[y].extend(chars)
+        self.attrs[y].extend(attrs)
+        self.dirty.add(y)
+        if self.marks[y]: self.unmark(y, x, self.columns)
+
+    def erase_characters(self, count=None):
+        count = count or 1
+        self.fill(self.cursor.y, self.cursor.x, min(self.cursor.x + count, self.columns), self.cursor.attrs)
+
+    def erase_in_line(self, how=0, private=False):
+        begin, end = {0: (self.cursor.x, self.columns),
+                      1: (0, self.cursor.x + 1),
+                      2: (0, self.columns)}[how]
+        self.fill(self.cursor.y, begin, end, self.cursor.attrs)
+
+    def erase_in_display(self, how=0, private=False):
+        begin, end = {0: (self.cursor.y + 1, self.lines),
+                      1: (0, self.cursor.y),
+                      2: (0, self.lines)}[how]
+        for y in range(begin, end):
+            self.fill(y, 0, self.columns, self.cursor.attrs)
+
+        # the line with the cursor
+        if how == 0 or how == 1:
+            self.erase_in_line(how)
+
+    def alignment_display(self):
+        for chars in self.chars:
+            chars[:] = array('I', [ord('E')]) * self.columns
+        self.dirty.update(range(self.lines))
+        self.marks[:] = [None] * self.lines
+
+
+class ScreenScanner:
+    '''
+        Tracks the cursor, the first and the last rows of a screen from the text to feed it,
+        while the text is kept pending to be fed later, i.e. the screen is emulated only if needed.
+
+        Cursor movement, erasing and drawing are followed as CompactScreen does.
+        Anything else, e.g. scrolling or mode changes, gets the scanner lost,
+        then the pending text has to be fed to the screen and the scanner synced again.
+
+        The pending text is dropped up to an erase of the whole display if the cursor and
+        the graphic rendition are known, so that it doesn't grow while browsing boards.
+    '''
+
+    MAX_PENDING = 1 << 16   # characters
+
+    re_token = re.compile(r"(?:\x1b\[|\x9b)(\??)([0-9;]*)([\x40-\x7e])"   # CSI
+                          r"|\x1b([^\[#%()])"                        # escape
+                          r"|\x1b%."                                 # charset_default/utf8, noop
+                          r"|([^\x00\x07-\x0f\x1b\x7f\x9b]+)"        # drawn text
+                          r"|([\x00\x07-\x0d\x0f\x7f])"              # basic controls
+                          r"|.", re.DOTALL)
+    re_incomplete = re.compile(r"(?:\x1b(?:\[[?0-9;]*|[#%()])?|\x9b[?0-9;]*)\Z")
+
+    def __init__(self):
+        self.pending = []
+        self.pendingSize = 0
+        self.tail = ''          # an incomplete sequence at the end of the text
+        self.tailFlushed = False
+        self.synced = False
+
+    # start from an emulated screen with nothing pending, return False if the screen is too complicated
+    # or the stream is in the middle of a sequence
+    def sync(self, screen, stream):
+        assert not self.pending
+        self.tail = ''
+        self.tailFlushed = False
+        self.synced = stream.state == "stream" and mo.DECAWM in screen.mode and \
+                      not ({mo.IRM, mo.LNM, mo.DECOM} & screen.mode) and \
+                      tuple(screen.margins) == (0, screen.lines - 1) and \
+                      screen.charset == 0 and not screen.savepoints
+        if not self.synced: return False
+
+        self.columns, self.lines = screen.columns, screen.lines
+        self.x, self.y = screen.cursor.x, screen.cursor.y
+        self.saved = []
+        self.tabstops = sorted(screen.tabstops)
+        self.g0 = screen.g0_charset
+        self.sgr = [] if screen.cursor.attrs == screen.default_char else None    # None if unknown
+        self.top = self.cells(screen, 0)
+        self.bottom = self.cells(screen, self.lines - 1)
+        return True
+
+    @staticmethod
+    def cells(screen, y: int):
+        if hasattr(screen, "cells"): return screen.cells(y)
+        return [char.data for char in screen.buffer[y]]
+
+    # the text to feed the screen
+    def take(self):
+        text = "".join(self.pending)
+        self.pending.clear()
+        self.pendingSize = 0
+        self.tailFlushed = bool(self.tail)
+        return text
+
+    # the first and the last rows, other rows are empty
+    def probes(self):
+        lines = [''] * self.lines
+        lines[0] = "".join(self.top)
+        lines[-1] = "".join(self.bottom)
+        return lines
+
+    def row(self, y: int):
+        return self.top if y == 0 else self.bottom if y == self.lines - 1 else None
+
+    def bound(self):
+        self.x = min(max(0, self.x), self.columns - 1)
+        self.y = min(max(0, self.y), self.lines - 1)
+
+    # return False if lost, the text is pending in either case
+    def feed(self, text: str):
+        assert self.synced
+        self.pending.append(text)
+        self.pendingSize += len(text)
+
+        text = self.tail + text
+        compactable = not self.tailFlushed
+        self.tail = ''
+        self.tailFlushed = False
+
+        incomplete = self.re_incomplete.search(text)
+        end = incomplete.start() if incomplete else len(text)
+
+        for m in self.re_token.finditer(text, 0, end):
+            final, escape, drawn, control = m.group(3), m.group(4), m.group(5), m.group(6)
+            if drawn:
+                if not self.draw(drawn): return self.lost()
+            elif final:
+                params = [int(p) if p else 0 for p in m.group(2).split(';')]
+                if m.group(1):
+                    # only the cursor visibility is private
+                    if final not in "hl" or params != [25]: return self.lost()
+                    continue
+                if final == 'J' and compactable and self.sgr is not None and not self.saved and \
+                   self.x < self.columns and (params[0] == 2 or (params[0] == 0 and self.x == self.y == 0)):
+                    self.compact(text[m.start():])
+                if not self.csi(final, params): return self.lost()
+            elif escape:
+                if not self.escape(escape): return self.lost()
+            elif control:
+                if not self.control(control): return self.lost()
+            elif not m.group().startswith("\x1b%"):
+                return self.lost()
+
+        self.tail = text[end:]
+        if self.pendingSize > self.MAX_PENDING: return self.lost()
+        return True
+
+    def lost(self):
+        self.synced = False
+        return False
+
+    # drop the pending text before the erase of the whole display
+    def compact(self, text: str):
+        prefix = "\x1b[0m" + "".join(f"\x1b[{p}m" for p in self.sgr) + f"\x1b[{self.y + 1};{self.x + 1}H"
+        self.pending[:] = [prefix, text]
+        self.pendingSize = len(prefix) + len(text)
+
+    def linefeed(self):
+        # the screen would scroll
+        if self.y == self.lines - 1: return False
+        self.y += 1
+        self.bound()
+        return True
+
+    def draw(self, text: str):
+        # a character above U+00FF takes two cells, by the code before translated
+        width = 2 * len(text) - len(text.encode("latin-1", "ignore"))
+        drawn = text.translate(self.g0) if self.g0 is not None else text
+        row = self.row(self.y)
+        if self.x + width <= self.columns:
+            if row is not None:
+                cells = []
+                for c, d in zip(text, drawn):
+                    cells.append(d)
+                    if c > '\xff': cells.append('')
+                row[self.x:self.x + width] = cells
+            self.x += width
+            return True
+
+        # wrapped as CompactScreen.put()
+        for c, d in zip(text, drawn):
+            for cell in ([d, ''] if c > '\xff' else [d]):
+                if self.x == self.columns:
+                    self.x = 0
+                    if not self.linefeed(): return False
+                    row = self.row(self.y)
+                if row is not None: row[self.x] = cell
+                self.x += 1
+        return True
+
+    def erase(self, y: int, begin: int, end: int):
+        end = min(end, self.columns)
+        row = self.row(y)
+        if row is not None and begin < end:
+            row[begin:end] = [' '] * (end - begin)
+
+    def csi(self, final: str, params):
+        n = params[0] or 1
+        if final != 'm' and len(params) > (2 if final in "Hf" else 1):
+            return False
+        if final in "Hf":
+            self.y = (params[0] or 1) - 1
+            self.x = ((params[1] if len(params) > 1 else 0) or 1) - 1
+            self.bound()
+        elif final in "AF":
+            self.y -= n
+            if final == 'F': self.x = 0
+            self.bound()
+        elif final in "BeE":
+            self.y += n
+            if final == 'E': self.x = 0
+            self.bound()
+        elif final in "Ca":
+            self.x += n
+            self.bound()
+        elif final == 'D':
+            self.x -= n
+            self.bound()
+        elif final in "G`":
+            self.x = n - 1
+            self.bound()
+        elif final == 'd':
+            self.y = n - 1
+            self.bound()
+        elif final == 'K':
+            begin, end = {0: (self.x, self.columns), 1: (0, self.x + 1), 2: (0, self.columns)}.get(params[0], (0, 0))
+            self.erase(self.y, begin, end)
+        elif final == 'J':
+            how = params[0]
+            if how not in (0, 1, 2): return True
+            rows = {0: range(self.y + 1, self.lines), 1: range(self.y), 2: range(self.lines)}[how]
+            for y in (0, self.lines - 1):
+                if y in rows: self.erase(y, 0, self.columns)
+            if how != 2: return self.csi('K', [how])
+        elif final == 'X':
+            self.erase(self.y, self.x, min(self.x + n, self.columns))
+        elif final in "@P":
+            row = self.row(self.y)
+            if row is not None:
+                n = min(self.columns - self.x, n)
+                if final == '@':
+                    row[self.x:self.x] = [' '] * n
+                    del row[self.columns:]
+                else:
+                    del row[self.x:self.x + n]
+                    row.extend([' '] * n)
+        elif final == 'm':
+            if self.sgr is None and 0 not in params: return True
+            if 0 in params:
+                i = len(params) - 1 - params[::-1].index(0)
+                self.sgr = [";".join(map(str, params[i + 1:]))] if i + 1 < len(params) else []
+            else:
+                self.sgr.append(";".join(map(str, params)))
+        elif final in "cn":
+            pass    # reports to the server
+        elif final in pyte.Stream.csi:
+            # scrolling, margins, modes and tab stops
+            return False
+        return True
+
+    def escape(self, char: str):
+        if char == '7':
+            self.saved.append((self.x, self.y, None if self.sgr is None else list(self.sgr)))
+        elif char == '8':
+            if self.saved:
+                self.x, self.y, self.sgr = self.saved.pop()
+                self.bound()
+            else:
+                self.x = self.y = 0
+        elif char == 'D':
+            # index doesn't bound the column as linefeed does
+            if self.y == self.lines - 1: return False
+            self.y += 1
+            self.x = min(max(0, self.x), self.columns - 1)
+        elif char == 'E':
+            return self.linefeed()
+        elif char == 'M':
+            # reverse index
+            if self.y == 0: return False
+            self.y -= 1
+            self.bound()
+        elif char in pyte.Stream.escape:
+            return False
+        return True
+
+    def control(self, char: str):
+        if char == '\r':
+            self.x = 0
+        elif char in "\n\x0b\x0c":
+            return self.linefeed()
+        elif char == '\b':
+            self.x -= 1
+            self.bound()
+        elif char == '\t':
+            for stop in self.tabstops:
+                if self.x < stop:
+                    self.x = stop
+                    break
+            else:
+                self.x = self.columns - 1
+        elif char == '\x0f':
+            pass    # shift_in to G0
+        return True
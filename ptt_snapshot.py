@@ -0,0 +1,67 @@
+import io
+import os
+import pickle
+import struct
+
+'''
+    A versioned binary snapshot of the sessions to restore after a restart or a hot reload.
+
+        MAGIC, version (2 bytes), size (4 bytes), payload
+
+    The payload is pickled built-in objects only, e.g. dict, list, str, bytes and int, which the objects
+    to snapshot build in getSnapshot() and take in setSnapshot(). A snapshot refers to no class of the proxy,
+    so it's restored whatever classes are changed. setSnapshot() takes the fields it knows and ignores the others.
+    Rows of a screen are arrays as bytes, it takes a few milliseconds to save or restore a session.
+
+    The version is bumped once a field changes its layout, setSnapshot() takes the version of a snapshot
+    to read the layouts before, and a snapshot newer than the code is refused.
+        1   the lines and the floors of a thread as lists
+        2   the lines as LineStore and the floors as FloorIndex, see PttThread.setSnapshot()
+'''
+
+MAGIC = b"PTTSNAP\n"
+VERSION = 2
+
+HEADER = struct.Struct(">HI")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# built-in objects only, a snapshot of classes is refused
+class _Unpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        raise SnapshotError(f"Snapshot refers to {module}.{name}")
+
+
+def dumps(state) -> bytes:
+    payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    return MAGIC + HEADER.pack(VERSION, len(payload)) + payload
+
+# (state, version)
+def loads(data: bytes):
+    if not data.startswith(MAGIC):
+        raise SnapshotError("Not a snapshot")
+    version, size = HEADER.unpack_from(data, len(MAGIC))
+    if version > VERSION:
+        raise SnapshotError(f"Snapshot version {version} is newer than {VERSION}")
+    payload = data[len(MAGIC) + HEADER.size:]
+    if len(payload) != size:
+        raise SnapshotError(f"Snapshot is truncated: {len(payload)} of {size} bytes")
+    return _Unpickler(io.BytesIO(payload)).load(), version
+
+# written to a temporary file and renamed, a snapshot being written is never read
+def save(filename: str, state):
+    dirname = os.path.dirname(filename)
+    if dirname: os.makedirs(dirname, exist_ok=True)
+    data = dumps(state)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(filename + ".tmp", filename)
+    return len(data)
+
+def load(filename: str):
+    with open(filename, "rb") as f:
+        return loads(f.read())
@@ -0,0 +1,153 @@
+import time
+
+
+class LatencyHistogram:
+    '''
+        An HDR-style histogram of latencies in microseconds.
+        Values below 2**SUB_BITS have their own buckets, larger values share buckets of the same
+        relative width, i.e. the precision is about 1 / 2**(SUB_BITS-1) at any magnitude.
+    '''
+
+    SUB_BITS = 6    # about 3% precision
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def index(cls, value: int):
+        if value < (1 << cls.SUB_BITS): return value
+        e = value.bit_length() - cls.SUB_BITS
+        return (e << (cls.SUB_BITS - 1)) + (value >> e)
+
+    # the lowest value of a bucket
+    @classmethod
+    def value(cls, index: int):
+        if index < (1 << cls.SUB_BITS): return index
+        e = (index >> (cls.SUB_BITS - 1)) - 1
+        return (index - (e << (cls.SUB_BITS - 1))) << e
+
+    def record(self, usec: int):
+        if usec < 0: usec = 0
+        i = self.index(usec)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += usec
+        if self.min is None or usec < self.min: self.min = usec
+        if self.max is None or usec > self.max: self.max = usec
+
+    def percentile(self, p: float):
+        if self.count == 0: return None
+        target = max(1, int(self.count * p / 100 + 0.5))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                # the highest value of the bucket but not more than the maximum
+                return min(self.value(i + 1) - 1, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.mean(), 'min': self.min,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'p99.9': self.percentile(99.9), 'max': self.max}
+
+
+class LatencyStats:
+    '''
+        Latency histograms by stage, and by stage and PttTerm state as "stage[state]".
+        Use timer() and record(), e.g.
+
+            t = latency.timer()
+            ...
+            latency.record("feed", t, state)
+    '''
+
+    def __init__(self):
+        self.enabled = True
+        self.histograms = {}
+
+    @staticmethod
+    def timer():
+        return time.perf_counter()
+
+    def record(self, stage: str, start: float, state=None):
+        if not self.enabled: return
+        usec = int((time.perf_counter() - start) * 1000000)
+        self.histogram(stage).record(usec)
+        if state is not None:
+            self.histogram(f"{stage}[{state}]").record(usec)
+
+    def histogram(self, name: str):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = LatencyHistogram()
+        return h
+
+    def reset(self, stage: str = None):
+        for name, h in self.histograms.items():
+            if stage is None or name == stage or name.startswith(stage + '['):
+                h.reset()
+
+    def report(self, stage: str = None):
+        lines = ["%-32s %8s %9s %8s %8s %8s %8s %8s" % ("stage (usec)", "count", "mean", "p50", "p90", "p99", "p99.9", "max")]
+        for name in sorted(self.histograms):
+            if stage is not None and name != stage and not name.startswith(stage + '['): continue
+            s = self.histograms[name].summary()
+            if s['count'] == 0: continue
+            lines.append("%-32s %8d %9.1f %8d %8d %8d %8d %8d" % (name, s['count'], s['mean'], s['p50'], s['p90'],
+                                                               s['p99'], s['p99.9'], s['max']))
+        return "\n".join(lines)
+
+    def show(self, stage: str = None):
+        print(self.report(stage))
+
+
+class RoundTripEstimator:
+    '''
+        The smoothed round-trip time and its variation in seconds as TCP does (RFC 6298),
+        and a timeout derived from them within [minimum, maximum].
+    '''
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial=1.0, minimum=0.5, maximum=3.0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.reset()
+
+    def reset(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def update(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.samples += 1
+
+    def timeout(self):
+        if self.srtt is None: return self.initial
+        return min(max(self.srtt + 4 * self.rttvar, self.minimum), self.maximum)
+
+
+# shared by all sessions
+latency = LatencyStats()
+
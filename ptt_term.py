@@ -1,7 +1,9 @@
 import sys
 import os
 import re
+import codecs
 import pyte
+from pyte import modes as mo
 import asyncio
 import time
 import socket
@@ -10,22 +12,101 @@ import traceback
 from uao import register_uao
 register_uao()
 
+# the codec from uao has no incremental decoder
+class Big5UAOIncrementalDecoder(codecs.BufferedIncrementalDecoder):
+
+    def _buffer_decode(self, data, errors, final):
+        end = len(data)
+        if not final:
+            # bytes after the last one below 0x81 are pairs of double-byte characters since a trail byte
+            # below 0x81 only follows a lead byte, so an odd run of them leaves a lead byte at the end
+            run = 0
+            while run < end and data[end - run - 1] > 0x80:
+                run += 1
+            if run & 1: end -= 1
+        return codecs.decode(data[:end], "big5uao", errors), end
+
+
 from user_event import UserEvent
 from ptt_thread import PttThread
+from ptt_boardlist import BoardIndex, BoardRow
 from ptt_persist import PttPersist
+from ptt_stats import latency, RoundTripEstimator
+from ptt_classifier import ScreenClassifier
+from ptt_screen import CompactScreen, ScreenScanner
+from ptt_overlay import ScreenOverlay
+from ptt_urlcache import ThreadURLCache
+import ptt_snapshot
+import ptt_log
 
-# fix for double-byte character positioning and drawing
-class MyScreen(pyte.Screen):
+log = ptt_log.getLogger("term")
+
+# pyte records dirty lines in Screen since 0.6, in DiffScreen only before that
+DirtyScreen = pyte.Screen if hasattr(pyte.Screen(1, 1), "dirty") else pyte.DiffScreen
+PYTE_WCWIDTH = hasattr(pyte.screens, "wcwidth")
+
+# fix for double-byte character positioning and drawing of the stock pyte screen
+# PttTerm uses CompactScreen which draws double-byte characters in the same way
+class MyScreen(DirtyScreen):
 
     def draw(self, char):
         # the current character won't be null, will it?
         #     assert self.buffer[self.cursor.y][self.cursor.x].data != ''
-        super().draw(char)
+        self.drawCell(char)
 
         # the cursor will not be at the last column, won't it?
         #     assert self.cursor.x < self.columns
         if ord(char) > 0xff:
-            super().draw('')
+            self.drawCell('')
+
+    # pyte draws a character in as many cells as wcwidth() counts since 0.5, while a double-byte character
+    # of Big5-UAO takes two cells on PTT whatever its width, e.g. '→', so a character takes a cell as before
+    def drawCell(self, char):
+        if not PYTE_WCWIDTH:
+            super().draw(char)
+            return
+
+        char = char.translate(self.g1_charset if self.charset else self.g0_charset)
+        if self.cursor.x == self.columns:
+            if mo.DECAWM in self.mode:
+                self.carriage_return()
+                self.linefeed()
+            else:
+                self.cursor.x -= 1
+        if mo.IRM in self.mode:
+            self.insert_characters(1)
+        self.buffer[self.cursor.y][self.cursor.x] = self.cursor.attrs._replace(data=char)
+        self.cursor.x += 1
+
+
+class ScreenSnapshot:
+    '''
+        Lines of the screen rendered once, as Screen.display builds every line again on each access.
+        A slice is a view of the rows but not a copy of them.
+    '''
+
+    __slots__ = ("lines", "start", "stop")
+
+    def __init__(self, lines, start=0, stop=None):
+        self.lines = lines
+        self.start = start
+        self.stop = len(lines) if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1, "A view of rows in steps is unsupported"
+            return ScreenSnapshot(self.lines, self.start + start, self.start + max(start, stop))
+        if key < 0: key += len(self)
+        if not 0 <= key < len(self): raise IndexError(f"Row {key} is out of range 0~{len(self) - 1}")
+        return self.lines[self.start + key]
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield self.lines[i]
 
 
 # for event debugging
@@ -68,6 +149,12 @@ class PttTerm:
         def __repr__(self):
             return str(self.state) if self.substate == 0 else f"{self.state}.{self.substate}"
 
+        names = ["Unknown", "Waiting", "InPanel", "InBoard", "InThread"]
+
+        def name(self):
+            name = self.names[self.state]
+            return name if self.substate == 0 else f"{name}.{self.substate}"
+
         def __eq__(self, other):
             if isinstance(other, self.__class__):
                 return self.state == other.state and \
@@ -95,15 +182,56 @@ class PttTerm:
     _State.InBoardWaitingRefresh = _State(InBoard, waitingRefresh)
     _State.InThread = _State(InThread)
 
+    # in the order of priority, row 0 is the title line and row -1 is the status line
+    # a regex for board name should be "[\w-]+"
+    screenTable = [
+        {'state': _State.Waiting, 'row': -1, 'pattern': ".+請?按.+鍵.*繼續"},
+        {'state': _State.Waiting, 'row': -1, 'pattern': "請選擇"},
+        {'state': _State.Waiting, 'row': -1, 'pattern': '搜尋.+'},
+        {'state': _State.Waiting, 'row': -1, 'pattern': r'\s*★快速切換'},
+        {'state': _State.Waiting, 'row': -1, 'pattern': r'\s*跳至第幾項:'},
+        {'state': _State.InPanel, 'row': 0, 'pattern': "(?P<panel>【主功能表】)"},
+        {'state': _State.InPanel, 'row': 0, 'pattern': "(?P<panel>【分類看板】)"},
+        {'state': _State.InPanel, 'row': 0, 'pattern': "(?P<panel>【看板列表】)"},
+        {'state': _State.InPanel, 'row': 0, 'pattern': "(?P<panel>【 選擇看板 】)"},
+        {'state': _State.InPanel, 'row': 0, 'pattern': "(?P<panel>【個人設定】)"},
+        {'state': _State.InBoard, 'row': -1, 'pattern': r"\s*文章選讀",
+         # In '系列' only displays the first thread for a series
+         'fields': {'board': (0, r"\s*【(?:板主:|徵求中).+(?:看板|系列|文摘)《(?P<board>[\w-]+)》\s*$")}},
+        # note the pattern '\ *?\d+' to match variable percentage digits
+        {'state': _State.InThread, 'row': -1,
+         'pattern': r"\s*瀏覽.+\(\ *?(?P<percent>\d+)%\)\s+目前顯示: 第 (?P<firstLine>\d+)~(?P<lastLine>\d+) 行",
+         'ints': ['percent', 'firstLine', 'lastLine'],
+         # the header of a thread at the first line
+         'fields': {'board': (0, r"\s+作者\s+.+看板\s+(?P<board>[\w-]+)\s*$"),
+                    'title': (1, r"\s+標題\s+(?P<title>\S.+)\s*$")}}
+    ]
+
+    classifier = ScreenClassifier(screenTable, _State.Unknown)
+
     persistor = PttPersist()
 
+    # URLs of the threads in the board lists, shared by sessions
+    urlCache = ThreadURLCache()
+
+    # an URLResolver filling urlCache, see PttProxy.startResolver()
+    resolver = None
+
+    screenClass = CompactScreen
+
+    # out of threads the text is fed to the screen only if more than the first and the last lines are needed
+    lazy = True
+
     def __init__(self, columns, lines):
         self.reset()
 
-        self.screen = MyScreen(columns, lines)
+        self.screen = self.screenClass(columns, lines)
         # self.stream = MyDebugStream(only=["draw", "cursor_position"])
         self.stream = pyte.Stream()
         self.stream.attach(self.screen)
+        self.scanner = ScreenScanner()
+        self._display = None
+        self.decoder = Big5UAOIncrementalDecoder('replace')
 
         self.thread = PttThread()
 
@@ -117,62 +245,161 @@ class PttTerm:
         self.state = self._State()
         self.autoURL = True    # get URL/AIDC automatically when starts reading a thread
         self.threadLine = None
+        self.threadRow = None   # BoardRow of threadLine
         self.threadURL = None
+        self.board = None   # of the last board list
+        self.boardIndex = BoardIndex()  # the rows of the board list
 
         self.threadUpdated = None
         if hasattr(self, "thread"):
             self.thread.clear()
 
+        # (state, browse) classified by the last refresh, reused if the first and last lines are not changed
+        self.classified = None
+        self.rescan = True
+
         self._userEvent = UserEvent.Unknown
         if self.isMacroRunning():
             self.macro_task.cancel()
             del self.macro_task
 
-    def reload(self, retired):
-        print("PttTerm.reload()!")
-        retired.persistor.close()
-
-        # copying attributes from __dict__ only works if all attributes are system-defined objects
-        #vars(self).update(vars(retired))
-
-        # it's assumed the class of screen and stream are not changed.
-        self.screen = retired.screen
-        self.stream = retired.stream
-
-        # just assign self.thread to retired.thread is insufficient for reloading.
-        # this is why ptt_thread.py seems not being reloaded.
-        #self.thread = retired.thread
-
-        self.thread.reload(retired.thread)
+    # the screen, the state and the thread as built-in objects, see ptt_snapshot.py
+    def getSnapshot(self):
+        self.emulate()
+        state = {'state': (self.state.state, self.state.substate),
+                 'autoURL': self.autoURL, 'threadLine': self.threadLine, 'threadURL': self.threadURL,
+                 'threadRow': tuple(self.threadRow) if self.threadRow else None,
+                 'board': self.board,
+                 'decoder': self.decoder.getstate(),
+                 'thread': self.thread.getSnapshot(),
+                 'time': time.time()}
+        if hasattr(self.screen, "getSnapshot"):
+            state['screen'] = self.screen.getSnapshot()
+        return state
+
+    # return False if the screen isn't restored
+    # a new connection starts at the login screen, so the thread is only persisted unless screen is True
+    def setSnapshot(self, state, screen=True, version=ptt_snapshot.VERSION):
+        if screen:
+            self.emulate()
+            snapshot = state.get('screen')
+            if not snapshot or not hasattr(self.screen, "setSnapshot") or not self.screen.setSnapshot(snapshot):
+                return False
+            self.scanner.synced = False
+            self._display = None
+            self.classified = None
+            self.rescan = True
+
+            self.state = self.stateOf(*state.get('state', (self.Unknown, 0)))
+            self.board = state.get('board')
+            if 'decoder' in state:
+                self.decoder.setstate(state['decoder'])
+
+        self.autoURL = state.get('autoURL', self.autoURL)
+        if 'thread' in state:
+            self.thread.setSnapshot(state['thread'], version)
+        if not screen:
+            # the thread viewed until the snapshot, the next thread viewed starts clean
+            self.thread.switch(self.persistThread, state.get('time'))
+            return True
+
+        self.threadLine = state.get('threadLine')
+        row = state.get('threadRow')
+        self.threadRow = BoardRow(*row) if row and len(row) == len(BoardRow._fields) else None
+        self.threadURL = state.get('threadURL')
+        return True
+
+    # the state compared by 'is', e.g. _State.InBoardWaitingURL of (InBoard, waitingURL)
+    @classmethod
+    def stateOf(cls, state, substate=0):
+        for s in (cls._State.Unknown, cls._State.Waiting, cls._State.InPanel, cls._State.InBoard,
+                  cls._State.InBoardWaitingURL, cls._State.InBoardWaitingRefresh, cls._State.InThread):
+            if s.state == state and s.substate == substate:
+                return s
+        return cls._State.Unknown
 
     def showScreen(self):
         self.showCursor(False)
-        lines = self.screen.display
+        lines = self.display
         for n, line in enumerate(lines, 1):
             print("%2d" % n, "'%s'" % line)
 
     def showCursor(self, lineAtCursor=True):
+        self.emulate()
         print("Cursor:", self.screen.cursor.y + 1, self.screen.cursor.x + 1, end = " ")
         if lineAtCursor:
-            print("'%s'" % self.screen.display[self.screen.cursor.y])
+            print("'%s'" % self.display[self.screen.cursor.y])
         else:
             print("lines: %d" % self.screen.lines)
 
     def resize(self, columns, lines):
+        self.emulate()
         self.screen.resize(lines, columns)
+        self.scanner.synced = False
+        self._display = None
+        self.rescan = True
+
+    # the snapshot of the screen until the next feed
+    @property
+    def display(self):
+        if self._display is None:
+            self.emulate()
+            self._display = ScreenSnapshot(self.screen.display)
+        return self._display
+
+    # feed the screen with the text pending in lazy mode
+    def emulate(self):
+        if self.scanner.pending:
+            self.stream.feed(self.scanner.take())
+
+    def isLazy(self):
+        return bool(self.scanner.pending)
+
+    # rows changed since the last refresh, all rows if a full rescan is needed
+    def takeDirty(self):
+        if self.rescan:
+            self.rescan = False
+            dirty = set(range(self.screen.lines))
+        else:
+            dirty = set(self.screen.dirty)
+        self.screen.dirty.clear()
+        return dirty
 
     def cursor_up(self):
-        self.screen.cursor_up()
+        self.moveCursor("\x1b[A", self.screen.cursor_up)
 
     def cursor_down(self):
-        self.screen.cursor_down()
+        self.moveCursor("\x1b[B", self.screen.cursor_down)
+
+    def moveCursor(self, sequence: str, move):
+        self._display = None
+        if self.scanner.pending and not self.scanner.tail:
+            if not self.scanner.feed(sequence):
+                self.emulate()
+        else:
+            self.emulate()
+            move()
+            self.scanner.synced = False
 
+    # segments can be fed as they come, a double-byte character split into two is held by the decoder
     def feed(self, data: bytes):
-        self.stream.feed(data.decode("big5uao", 'replace'))
+        text = self.decoder.decode(data)
+        self._display = None
+
+        if self.lazy and self.state != self._State.InThread and \
+           (self.scanner.synced or (not self.scanner.pending and self.scanner.sync(self.screen, self.stream))):
+            if not self.scanner.feed(text):
+                log.debug("Scanner lost, %d characters to emulate", self.scanner.pendingSize)
+                self.emulate()
+        else:
+            self.emulate()
+            self.stream.feed(text)
+            self.scanner.synced = False
 
     def flowStarted(self, flow, from_file: bool):
         self.flow = flow    # ptt_proxy.websocket_message.ProxyFlow
         self.read_flow = from_file
+        self.decoder.reset()
 
         # if flow is read from file, don't persist
         self.thread.setPersistentState(not from_file)
@@ -195,23 +422,24 @@ class PttTerm:
     def isMacroRunning(self):
         return hasattr(self, "macro_task") and not self.macro_task.done()
 
+    # consecutive steps of the same 'group' are sent at once and checked by the last state and all the patterns
     macros_pmore_config = [
         #{'data': b' ', 'state': _State.Unknown},  # if starts with onboarding screen once logged in
-        {'data': b'\x1a', 'state': [_State.InPanel, _State.InBoard]},   # Ctrl-Z
+        {'data': b'\x1a', 'state': [_State.InPanel, _State.InBoard], 'group': 1},   # Ctrl-Z
         # will send to the board SYSOP if no board is viewed previously
-        {'data': b'b',    'state': [_State.InPanel, _State.InBoard]},
+        {'data': b'b',    'state': [_State.InPanel, _State.InBoard], 'group': 1},
         {'data': b' ',    'state': _State.InBoard, 'timeout': True},    # skips the onboarding screen or allows timeout
         # reads the thread at cursor or retry after cursor Up
         # b'r' will not trigger autoURL in contrary to Enter(b'\r') and Right(b'\x1b[C')
         {'data': b'r',   'state': [_State.InBoard, _State.InThread], 'timeout': b'\x1b[A\x1b[A\x1b[A', 'retry': 5},
-        {'data': b'o',   'state': _State.InThread},   # enters thread browser config
-        {'data': b'm',   'state': _State.InThread, 'row': -5, 'pattern': '\*顯示', 'retry': 3}, # 斷行符號: 顯示
-        {'data': b'l',   'state': _State.InThread, 'row': -4, 'pattern': '\*無', 'retry': 3},   # 文章標頭分隔線: 無
-        {'data': b' ',   'state': _State.InThread},    # ends config
-        {'data': b'\x1b[D', 'state': _State.InBoard},   # Left and leaves the thread
-        {'data': b'\x1a',   'state': _State.InBoard},   # Ctrl-Z
-        {'data': b'c',      'state': _State.InPanel},   # goes to 分類看板
-        {'data': b'\x1b[D', 'state': _State.InPanel}    # Left and goes to 主功能表
+        {'data': b'o',   'state': _State.InThread, 'group': 2},   # enters thread browser config
+        {'data': b'm',   'state': _State.InThread, 'row': -5, 'pattern': r'\*顯示', 'retry': 3, 'group': 2}, # 斷行符號: 顯示
+        {'data': b'l',   'state': _State.InThread, 'row': -4, 'pattern': r'\*無', 'retry': 3, 'group': 2},   # 文章標頭分隔線: 無
+        {'data': b' ',   'state': _State.InThread, 'group': 3},    # ends config
+        {'data': b'\x1b[D', 'state': _State.InBoard, 'group': 3},   # Left and leaves the thread
+        {'data': b'\x1a',   'state': _State.InBoard, 'group': 3},   # Ctrl-Z
+        {'data': b'c',      'state': _State.InPanel, 'group': 3},   # goes to 分類看板
+        {'data': b'\x1b[D', 'state': _State.InPanel, 'row': 0, 'pattern': '【主功能表】', 'group': 3}  # Left and goes to 主功能表
         ]
     def runPmoreConfig(self):
 
@@ -240,12 +468,15 @@ class PttTerm:
 
     # before the first segment is sent to the client
     def pre_update(self):
+        # floor numbers moved or overwritten by the update are redrawn after the refresh if the overlay is tracked
         if self.state == self._State.InThread and self.threadUpdated and \
-           (self.thread.isUpdateEvent(self._userEvent) or self.thread.isSwitchEvent(self._userEvent)):
+           ((self.thread.isUpdateEvent(self._userEvent) and not self.overlay.isTracked(self.screen)) or \
+            self.thread.isSwitchEvent(self._userEvent)):
             self.updateThread(*self.threadUpdated, True)
             self.threadUpdated = None
 
     def _threadLine(self, line=0):
+        self.emulate()
         if line == 0:
             line = self.screen.cursor.y
         elif 1 <= line <= self.screen.lines:
@@ -253,8 +484,8 @@ class PttTerm:
         else:
             raise AssertionError(f"Line {line} is out of range 1~{self.screen.lines}")
 
-        return self.screen.display[line].lstrip(" >").rstrip()
-        '''
+        return self.display[line].lstrip(" >").rstrip()
+        r'''
         try:
             # how about '★' sticky threads?
             number = re.match("[\s>]\s*?([0-9]+)", line).group(1)
@@ -266,7 +497,9 @@ class PttTerm:
             return number
         '''
 
-    def isThreadDeleted(self, line=0):
+    # the BoardRow of the line in the board list, the cursor line if 0
+    def boardRow(self, line=0):
+        self.emulate()
         if line == 0:
             line = self.screen.cursor.y
         elif 1 <= line <= self.screen.lines:
@@ -274,20 +507,25 @@ class PttTerm:
         else:
             raise AssertionError(f"Line {line} is out of range 1~{self.screen.lines}")
 
-        line = self.screen.display[line].strip()
-        # (本文已被刪除) or (已被xxx刪除)
-        deleted = re.search("-            □ (.*已被.*刪除)", line) is not None
-        print(deleted, "'%s'" % line)
+        # the lines changed since the last refresh are parsed
+        self.boardIndex.update(self.board, self.display)
+        return self.boardIndex.at(line)
+
+    def isThreadDeleted(self, line=0):
+        row = self.boardRow(line)
+        deleted = row is not None and row.deleted
+        log.debug("%s %s", deleted, row)
         return deleted
 
     # before the screen is updated, some segments have already been sent to the client
     def pre_refresh(self):
-        print("pre_refresh:", self.state, UserEvent.name(self._userEvent))
+        if log.isEnabledFor(ptt_log.DEBUG):
+            log.debug("pre_refresh: %s %s", self.state, UserEvent.name(self._userEvent))
         # "== self._State.InBoard" doesn't work here
         if self.state is self._State.InBoard and self.isThreadEnteringEvent(self._userEvent, True):
             # entering a thread
             if self.threadURL:
-                print("Set URL:", self.threadURL, "'%s'" % self.threadLine)
+                log.debug("Set URL: %s '%s'", self.threadURL, self.threadLine)
                 self.thread.setURL(self.threadURL)
 
         if self.state == self._State.InThread and self.thread.isSwitchEvent(self._userEvent):
@@ -296,15 +534,19 @@ class PttTerm:
             # don't clear self.threadURL until cursor is moved
 
     def scanURL(self):
+        return self.findURL(self.display)
+
+    # the URL in the box of 'Q'
+    @staticmethod
+    def findURL(lines):
         url = None
-        lines = self.screen.display
-        for i in range(2, self.screen.lines - 4):   # the box spans at least 4 lines
+        for i in range(2, len(lines) - 4):   # the box spans at least 4 lines
             if lines[i  ].startswith("│ 文章代碼(AID):") and \
                lines[i+1].startswith("│ 文章網址:"):
 
                 url = (lines[i+1])[7:].strip(" │")
                 board_fn = PttThread.url2fn(url)
-                _aidc = re.match("\ *?#([0-9A-Za-z-_]{8})", (lines[i])[12:])
+                _aidc = re.match(r"\ *?#([0-9A-Za-z-_]{8})", (lines[i])[12:])
 
                 if board_fn and _aidc and \
                    PttThread.fn2aidc(board_fn[1]) == _aidc.group(1):
@@ -321,6 +563,8 @@ class PttTerm:
         if newState in [self._State.Waiting, self._State.Unknown]:
             if self.state is self._State.InBoardWaitingURL:
                 self.threadURL = self.scanURL()
+                if self.threadURL:
+                    self.urlCache.put(self.board, self.threadRow, self.threadURL)
                 if newState == self._State.Waiting:
                     self.flow.sendToServer(b' ')    # escape from waiting
                     self.state = self._State.InBoardWaitingRefresh
@@ -337,6 +581,8 @@ class PttTerm:
 
         prevState = self.state
         self.state = newState
+        if not prevState.is_exact(newState):
+            self.rescan = True
 
         if prevState.is_exact(self._State.InBoardWaitingURL, self._State.InBoardWaitingRefresh) and \
            newState is self._State.InBoard:
@@ -356,8 +602,17 @@ class PttTerm:
            (prevState == self._State.InThread and newState == self._State.InBoard and \
             self.threadLine != self._threadLine()):
             self.threadLine = None
+            self.threadRow = None
             self.threadURL = None
 
+        # the archive of the board is read in the background for the URL cache
+        if self.autoURL and newState is self._State.InBoard and self.board:
+            self.urlCache.load(self.board)
+
+        # the rows of the board list are resolved ahead of time by the hidden session
+        if self.resolver and newState is self._State.InBoard:
+            self.resolver.request(self.board, self.boardIndex.onScreen(3, -1))
+
         # if flow is read from file, don't run macro
         if not self.read_flow and not hasattr(self, "macro_task"):
             if prevState == self._State.Unknown and newState == self._State.InPanel:
@@ -366,106 +621,118 @@ class PttTerm:
             self.macro_event.set()
 
     def _refresh(self):
-        lines = self.screen.display
-
-        for input_pattern in [".+請?按.+鍵.*繼續", "請選擇", '搜尋.+', '\s*★快速切換', '\s*跳至第幾項:']:
-            if re.match(input_pattern, lines[-1]):
-                print("Waiting input...")
-                return self._State.Waiting
-
-        for panel in ['【主功能表】', '【分類看板】', '【看板列表】', '【 選擇看板 】', '【個人設定】']:
-            if re.match(panel, lines[0]):
-                print("In panel:", panel)
-                return self._State.InPanel
-
-        # a regex for board name should be "[\w-]+"
+        if self.isLazy():
+            # the first and the last lines are enough unless browsing a thread,
+            # or a board list of which the rows are resolved ahead of time
+            state, browse = self._classify(self.scanner.probes())
+            if state is not self._State.InThread and not (state is self._State.InBoard and self.resolver):
+                self.classified = None
+                return state
+            log.debug("Emulating %d characters for %s", self.scanner.pendingSize, state.name())
+            self.emulate()
+
+        dirty = self.takeDirty()
+        lines = self.display
+
+        if self.classified is None or 0 in dirty or len(lines) - 1 in dirty:
+            self.classified = self._classify(lines)
+        elif log.isEnabledFor(ptt_log.DEBUG):
+            log.debug("Refresh: %d dirty rows, same as %s", len(dirty), self.classified[0])
+        state, browse = self.classified
+
+        if state is self._State.InBoard:
+            # all lines are compared if the screen was not the board list
+            self.boardIndex.update(self.board, lines, dirty if self.state is self._State.InBoard else None)
 
-        if re.match("\s*文章選讀", lines[-1]):
-            try:
-                # In '系列' only displays the first thread for a series
-                board = re.search("^\s*【(板主:|徵求中).+(看板|系列|文摘)《([\w-]+)》\s*$", lines[0]).group(3)
-                print("In board: '%s'" % board)
-            except (AttributeError, IndexError):
-                print("Board missing: '%s'" % lines[0])
-            return self._State.InBoard
-
-        # note the pattern '\ *?\d+' to match variable percentage digits
-        browse = re.match("\s*瀏覽.+\(\ *?(\d+)%\)\s+目前顯示: 第 (\d+)~(\d+) 行", lines[-1])
         if browse:
-            percent = int(browse.group(1))
-            firstLine = int(browse.group(2))
-            lastLine  = int(browse.group(3))
-#            print("Browse: %d%%" % percent, "Lines:", firstLine, "~", lastLine)
-
-            if firstLine == 1:
-                try:
-                    board = re.match("\s+作者\s+.+看板\s+([\w-]+)\s*$", lines[0]).group(1)
-#                    print("Board: '%s'" % board)
-                except (AttributeError, IndexError):
-                    print("Board missing: '%s'" % lines[0])
-                try:
-                    title = re.match("\s+標題\s+(\S.+)\s*$", lines[1]).group(1)
-#                    print("Title: '%s'" % title)
-                except (AttributeError, IndexError):
-                    print("Title missing: '%s'" % lines[1])
+            percent, firstLine, lastLine = browse
+            # the floors cleared in pre_update() are drawn again even if no line is changed
+            if dirty or self.threadUpdated is None:
+                dirty.discard(len(lines) - 1)   # the status line
+                updateThread, lastRow = self.thread.view(lines[0:-1], firstLine, lastLine, percent == 100, dirty)
+                if updateThread:
+                    self.threadUpdated = (firstLine, lastLine, lastRow)
+                    self.updateThread(*self.threadUpdated)
+                    # floor numbers will be cleared in pre_update()
+
+        return state
+
+    # return the state and (percent, firstLine, lastLine) if browsing a thread
+    def _classify(self, lines):
+        state, fields = self.classifier.classify(lines)
+        if log.isEnabledFor(ptt_log.DEBUG):
+            log.debug("Screen: %s %s", state.name(), fields)
+
+        if state is self._State.InThread:
+            return state, (fields['percent'], fields['firstLine'], fields['lastLine'])
+        if state is self._State.InBoard:
+            self.board = fields['board']
+        return state, None
+
+    # floor numbers are drawn beyond the text, right before the column
+    floorColumns = 86
+    floorWidth = 5
+    overlay = ScreenOverlay(floorColumns + 1 - floorWidth, floorWidth)
+    floorCells = {}     # floor -> bytes drawn
+
+    @classmethod
+    def floorCell(cls, floor):
+        cell = cls.floorCells.get(floor)
+        if cell is None:
+            if len(cls.floorCells) >= 1 << 16: cls.floorCells.clear()
+            cell = "{:^{width}}".format(floor, width=cls.floorWidth) if floor else ' ' * cls.floorWidth
+            cell = cls.floorCells[floor] = cell.encode()
+        return cell
 
-            updateThread, lastRow = self.thread.view(self.screen.display[0:-1], firstLine, lastLine, percent == 100)
-            if updateThread:
-                self.threadUpdated = (firstLine, lastLine, lastRow)
-                self.updateThread(*self.threadUpdated)
-                # floor numbers will be cleared in pre_update()
+    def updateThread(self, firstLine, lastLine, lastRow, clear=False):
+        if self.screen.columns < self.floorColumns: return
+        t = latency.timer()
+        self.emulate()
 
-            return self._State.InThread
+        if clear and self.overlay.isTracked(self.screen):
+            data = self.overlay.clear(self.screen)
+        else:
+            cells = {}
+            for i in range(lastLine, firstLine-1, -1):
+                floor = self.thread.floor(i)
+                if (floor is None) or (clear and floor == 0): continue
+                cells[lastRow - (lastLine - i)] = self.floorCell(0 if clear else floor)
+            # only the floors not shown on the client if tracked
+            data = self.overlay.draw(self.screen, cells)
+
+        if data:
+            # restore cursor position
+            data += (b'\x1b[%d;%dH' % (self.screen.cursor.y + 1, self.screen.cursor.x + 1))
+
+            if clear:
+                self.flow.insertToClient(data)
+            else:
+                self.flow.sendToClient(data)
 
-        return self._State.Unknown
+        latency.record("updateThread", t, self.state.name())
 
-    def updateThread(self, firstLine, lastLine, lastRow, clear=False):
-        minColumns = 86
-        maxWidth = 5
-        if self.screen.columns < minColumns: return
+    cursorMovingEvents = frozenset([UserEvent.Key_Up, UserEvent.Key_Down, UserEvent.Key_PgUp, UserEvent.Key_PgDn,
+                                    UserEvent.Key_Home, UserEvent.Key_End, UserEvent.Ctrl_B, UserEvent.Ctrl_F,
+                                    # leaving a board
+                                    UserEvent.Key_Left] +
+                                   [ord(c) for c in "pknjPN0$=[]<>-+S{}123456789q"])     # 'q' as well
 
-        def floorStr(floor):
-            if floor and not clear:
-                return "{:^{width}}".format(floor, width=maxWidth)
-            else:
-                return ' ' * maxWidth
-
-        data = b''
-        width = 0
-        for i in range(lastLine, firstLine-1, -1):
-            floor = self.thread.floor(i)
-            if (floor is None) or (clear and floor == 0): continue
-            row = lastRow - (lastLine - i)
-            col = minColumns + 1 - maxWidth
-            floor = floorStr(floor)
-#            print(f"update [{row:2}, {col:2}] = '{floor}'")
-            data += (b'\x1b[%d;%dH' % (row, col)) + floor.encode()
-
-        # restore cursor position
-        data += (b'\x1b[%d;%dH' % (self.screen.cursor.y + 1, self.screen.cursor.x + 1))
-
-        if clear:
-            self.flow.insertToClient(data)
-        else:
-            self.flow.sendToClient(data)
+    threadEnteringEvents = frozenset([UserEvent.Key_Right, UserEvent.Key_Enter])
 
-    @staticmethod
-    def isCursorMovingEvent(event: UserEvent):
-        return event in [UserEvent.Key_Up, UserEvent.Key_Down, UserEvent.Key_PgUp, UserEvent.Key_PgDn,
-                         UserEvent.Key_Home, UserEvent.Key_End, UserEvent.Ctrl_B, UserEvent.Ctrl_F,
-                         # leaving a board
-                         UserEvent.Key_Left] or \
-               chr(event) in "pknjPN0$=[]<>-+S{}123456789q"     # 'q' as well
+    @classmethod
+    def isCursorMovingEvent(cls, event: UserEvent):
+        return event in cls.cursorMovingEvents
 
-    @staticmethod
-    def isThreadEnteringEvent(event: UserEvent, include_r=False):
-        return event in [UserEvent.Key_Right, UserEvent.Key_Enter] or \
+    @classmethod
+    def isThreadEnteringEvent(cls, event: UserEvent, include_r=False):
+        return event in cls.threadEnteringEvents or \
                (include_r and event == UserEvent.r)
 
     # the client message will be dropped if false is returned
     # the current user event will be replaced if a bytes object is returned
     def userEvent(self, event: UserEvent, uncommitted = False):
-        print("User event:", UserEvent.name(event))
+        if log.isEnabledFor(ptt_log.DEBUG):
+            log.debug("User event: %s", UserEvent.name(event))
 
         # most often event first
 
@@ -475,16 +742,23 @@ class PttTerm:
 
         if self.autoURL and (self.state is self._State.InBoard):
             if self.isCursorMovingEvent(event):
-                print("Clear URL:", self.threadURL, "'%s'" % self.threadLine)
+                log.debug("Clear URL: %s '%s'", self.threadURL, self.threadLine)
                 self.threadLine = None
+                self.threadRow = None
                 self.threadURL = None
             elif self.isThreadEnteringEvent(event) and \
                  self.threadLine is None and not self.isThreadDeleted():
-                # replace event with 'Q' for getting the URL
-                self.state = self._State.InBoardWaitingURL
                 self.threadLine = self._threadLine()
-                self._userEvent = event
-                return b"Q"
+                self.threadRow = self.boardRow()
+                self.threadURL = self.urlCache.get(self.board, self.threadRow)
+                if self.threadURL:
+                    # enter the thread directly and the URL is set in pre_refresh()
+                    log.debug("Cached URL: %s '%s'", self.threadURL, self.threadLine)
+                else:
+                    # replace event with 'Q' for getting the URL
+                    self.state = self._State.InBoardWaitingURL
+                    self._userEvent = event
+                    return b"Q"
 
         if uncommitted:
             if event == UserEvent.Key_Up:
@@ -495,114 +769,166 @@ class PttTerm:
         self._userEvent = event
         return event
 
-    # return value:
-    #   False: to break
-    #   True:  to continue
-    #   bytes: priority data to send
-    #   None:  to loop normally
-    def handle_macro_event(self, macro, timeout, priority):
+    # the server is expected to respond to a macro step within the timeout
+    roundTrip = RoundTripEstimator()
+
+    # the state expected after the data of a macro step is sent
+    def isMacroExpected(self, macro):
+        if 'until' in macro:
+            return macro['until'](self)
         if isinstance(macro['state'], list):
-            if self.state not in macro['state']:
-                print("expected state", macro['state'], "but", self.state)
-                return False
-        elif self.state != macro['state']:
-            print("expected state", macro['state'], "but", self.state)
-            return False
+            return self.state in macro['state']
+        return self.state == macro['state']
 
-        if 'timeout' in macro and 'retry' in macro and isinstance(macro['timeout'], bytes):
-            if timeout or priority:
-                if self.macro_retry < 0: self.macro_retry = macro['retry']
-                if self.macro_retry > 0:
-                    print("retry", self.macro_retry)
-                    if not priority:
-                        self.macro_retry -= 1
-                        return macro['timeout']
-                    else:
-                        return True
-                else:
-                    print("Reach maximum retry!")
-                    self.macro_retry = -1
-                    return False
-            else:
-                self.macro_retry = -1
-
-        if 'row' in macro and 'pattern' in macro and 'retry' in macro:
-            if re.search(macro['pattern'], self.screen.display[macro['row']]) is None:
-                if self.macro_retry < 0: self.macro_retry = macro['retry']
-                if self.macro_retry > 0:
-                    print("retry", self.macro_retry)
-                    self.macro_retry -= 1
-                    return True
-                else:
-                    print("Reach maximum retry!")
-                    self.macro_retry = -1
-                    return False
-            else:
-                print("found", macro['pattern'])
-                self.macro_retry = -1
+    def isMacroMatched(self, macro):
+        return 'pattern' not in macro or re.search(macro['pattern'], self.display[macro['row']]) is not None
 
-        return None
+    # the steps from the i-th of the same group
+    @staticmethod
+    def macroGroup(macros, i):
+        group = macros[i].get('group')
+        j = i + 1
+        if group is not None:
+            while j < len(macros) and macros[j].get('group') == group:
+                j += 1
+        return macros[i:j]
+
+    async def waitMacro(self, macros, event):
+        '''
+            Waits for refreshes until the state is expected by the last of the macro steps, returns
+                True:  the state and the patterns are expected
+                False: the state is expected but not the patterns
+                None:  timeout
+            The timeout is from the round trips observed and restarts on every refresh as the server is responding.
+            A step returns on the first expected state, steps sent at once wait for the patterns until timeout
+            since the server may refresh before all of them are handled.
+        '''
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        responded = False
+        expected = False
+        while True:
+            try:
+                await asyncio.wait_for(event.wait(), self.roundTrip.timeout())
+            except asyncio.TimeoutError:
+                return False if expected else None
+            event.clear()
+            if not responded:
+                responded = True
+                self.roundTrip.update(loop.time() - sent)
+            expected = self.isMacroExpected(macros[-1])
+            if expected:
+                matched = all(self.isMacroMatched(macro) for macro in macros)
+                if matched or len(macros) == 1:
+                    return matched
 
     # macros is list of {data, expected states} pairs, see macros_pmore_config above
+    # a step is done as soon as the expected screen is refreshed, 'until' is a predicate of PttTerm in place of 'state'
     async def run_macro(self, macros, event, doneHook=None):
-        print("run_macro task started!")
-        self.macro_retry = -1
-        prio_data = None
+        log.info("Macro started: %d steps, timeout %.0f ms", len(macros), self.roundTrip.timeout() * 1000)
+        started = latency.timer()
+        retry = None    # retries left of the step
+        data = None     # sent in place of the data of the step, e.g. to recover from timeout
+        stepwise = 0    # steps before are sent one by one after a group failed to check
         i = 0
         while i < len(macros):
-            await asyncio.sleep(0.5)
             macro = macros[i]
-            assert ('data' in macro and 'state' in macro)
-            if self.flow:
+            assert ('data' in macro and ('state' in macro or 'until' in macro))
+            if not self.flow:
+                log.warning("ProxyFlow is unavailable!")
+                break
+
+            group = self.macroGroup(macros, i) if i >= stepwise and not data else [macro]
+            if len(group) > 1:
+                t = latency.timer()
+                event.clear()
                 try:
-                    self.flow.sendToServer(prio_data if prio_data else macro['data'])
+                    self.flow.sendToServer(b''.join(step['data'] for step in group))
+                    result = await self.waitMacro(group, event)
+                except asyncio.CancelledError:
+                    log.info("Macro cancelled at step %d", i)
+                    break
                 except Exception:
                     traceback.print_exc()
                     break
-            else:
-                print("ProxyFlow is unavailable!")
-                break
-
-            timeout = False
-            try:
-                await asyncio.wait_for(event.wait(), 1.0)
-            except asyncio.TimeoutError:
-                if 'timeout' in macro and macro['timeout']:
-                    # ignore timeout and proceed
-                    event.set()
-                    timeout = True
+                latency.record("macro", t, i)
+                if log.isEnabledFor(ptt_log.DEBUG):
+                    log.debug("Macro steps %d~%d: %s, %s in %.1f ms", i, i + len(group) - 1,
+                              {True: "done", False: "unmatched", None: "timeout"}[result], self.state.name(),
+                              (latency.timer() - t) * 1000)
+
+                if result:
+                    i += len(group)
+                elif result is False:
+                    # continue one by one from the first step of which the pattern isn't matched
+                    stepwise = i + len(group)
+                    while self.isMacroMatched(macros[i]): i += 1
+                    log.info("Macro steps %d~%d: '%s' is not found, continue step by step",
+                             i, stepwise - 1, macros[i]['pattern'])
                 else:
-                    print("macro event timeout!")
-                    break
+                    # continue one by one after the last step of which the state is expected, i.e. the steps
+                    # before are taken as done since the server handles them in order
+                    log.info("Macro steps %d~%d: timeout, expected state %s but %s, continue step by step",
+                             i, i + len(group) - 1, group[-1].get('state', group[-1].get('until')), self.state.name())
+                    stepwise = i + len(group)
+                    for j in range(stepwise - 1, i - 1, -1):
+                        if self.isMacroExpected(macros[j]) and self.isMacroMatched(macros[j]):
+                            i = j + 1
+                            break
+                continue
+
+            # the rest of a group is done if its pattern is found
+            if i < stepwise and 'pattern' in macro and retry is None and \
+               self.isMacroExpected(macro) and self.isMacroMatched(macro):
+                i += 1
+                continue
+
+            if retry is None:
+                retry = macro.get('retry', 0)
+
+            t = latency.timer()
+            event.clear()
+            try:
+                self.flow.sendToServer(data or macro['data'])
+                result = await self.waitMacro([macro], event)
             except asyncio.CancelledError:
-                print("macro event cancelled!")
+                log.info("Macro cancelled at step %d", i)
                 break
-            except Exception as e:
+            except Exception:
                 traceback.print_exc()
-
-            if event.is_set():
-                event.clear()
-                try:
-                    next = self.handle_macro_event(macro, timeout, prio_data is not None)
-                except Exception as e:
-                    traceback.print_exc()
-                    break
-                if next is True:
-                    prio_data = None
-                    continue
-                elif next is False:
-                    break
-                elif isinstance(next, bytes):
-                    prio_data = next
-                    continue
+                break
+            latency.record("macro", t, i)
+            if log.isEnabledFor(ptt_log.DEBUG):
+                log.debug("Macro step %d %s: %s, %s in %.1f ms", i, data or macro['data'],
+                          {True: "done", False: "unmatched", None: "timeout"}[result], self.state.name(),
+                          (latency.timer() - t) * 1000)
+
+            if data:
+                # recovered, send the data of the step again
+                data = None
+                continue
+
+            if result or (result is None and macro.get('timeout') is True and
+                          self.isMacroExpected(macro) and self.isMacroMatched(macro)):
+                # the timeout is allowed if the step may have no response
+                retry = None
+                i += 1
+            elif retry > 0:
+                retry -= 1
+                log.info("Macro step %d: retry %d", i, retry)
+                if result is None and isinstance(macro.get('timeout'), bytes):
+                    data = macro['timeout']
             else:
-                print("macro event is not set")
+                if result is None:
+                    log.warning("Macro step %d: timeout, expected state %s but %s",
+                                i, macro.get('state', macro.get('until')), self.state.name())
+                else:
+                    log.warning("Macro step %d: '%s' is not found", i, macro['pattern'])
                 break
-            prio_data = None
-            i += 1
 
+        log.info("Macro finished %d/%d steps in %.0f ms, round trip %.0f ms", i, len(macros),
+                 (latency.timer() - started) * 1000, (self.roundTrip.srtt or 0) * 1000)
         if doneHook: doneHook(macros)
-        print("run_macro task finished!")
 
 if __name__ == "__main__":
     PttTerm(128, 32)
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import time
 import traceback
 
@@ -7,6 +8,14 @@ from uao import register_uao
 register_uao()
 
 from user_event import UserEvent
+from ptt_linestore import LineStore
+from ptt_floors import FloorIndex
+from ptt_pushes import ThreadPushes
+import ptt_width
+import ptt_snapshot
+import ptt_log
+
+log = ptt_log.getLogger("thread")
 
 # a PTT thread being viewed
 class PttThread:
@@ -20,23 +29,54 @@ class PttThread:
             print("read from ", filename, "lines", self.lastLine, "url:", self.url)
 
     def clear(self):
-        self.lines = []
+        self.lines = LineStore()
         self.lastLine = 0
         self.url = None
         self.urlLine = 0
+        self.urlLines = set()   # the indexes of "※ 文章網址:" captured, None to scan all lines
 
-        self.floors = []
-        self.lastFloorLine = 0
+        self.floors = FloorIndex()  # the push lines captured
+        self.endLine = 0    # the last line once viewed at the end
+        self.pushes = ThreadPushes()    # parsed by pushSummary()
+        self.pushesChanged = set()  # the lines of which the pushes aren't parsed, None for all lines
 
         self.firstViewed = self.lastViewed = 0  # Epoch time
         self.elapsedTime = 0  # in seconds
 
         self.atBegin = self.atEnd = False
         self.waitingForInput = False
+        self.viewed = None  # (first, last) of the last view if each row was a line
+
+    snapshotFields = ["lines", "lastLine", "url", "urlLine", "floors", "endLine",
+                      "firstViewed", "lastViewed", "elapsedTime", "atBegin", "atEnd", "waitingForInput"]
+
+    # the thread as built-in objects, see ptt_snapshot.py
+    def getSnapshot(self):
+        state = {name: getattr(self, name) for name in self.snapshotFields}
+        state['lines'] = self.lines.getSnapshot()
+        state['floors'] = self.floors.getSnapshot()
+        return state
 
-    def reload(self, retired):
-        # works only if all attributes are system-defined objects
-        vars(self).update(vars(retired))
+    def setSnapshot(self, state, version=ptt_snapshot.VERSION):
+        self.clear()
+        for name in self.snapshotFields:
+            if name in state: setattr(self, name, state[name])
+        self.urlLines = None
+        lines, floors = state.get('lines'), state.get('floors')
+        self.lines, self.floors = LineStore(), FloorIndex()
+        if version >= 2:
+            if lines: self.lines.setSnapshot(lines)
+            if floors: self.floors.setSnapshot(floors)
+        else:
+            # lists of the version 1, of which the floors are counted again
+            self.lines.extend(lines or [])
+            self.floors.grow(len(self.lines))
+            for line, text in enumerate(self.lines, 1):
+                if text != self.LINE_HOLDER: self.floors.set(line, self.isPush(text))
+        if len(self.lines) != self.lastLine or len(self.floors) != self.lastLine:
+            self.clear()
+            raise ptt_snapshot.SnapshotError(f"Thread of version {version} doesn't match its lines")
+        self.pushesChanged = None
 
     # remove attributes which don't need to persist
     # It's for PttThreadPersist only but is here for symmetrical purpose.
@@ -46,38 +86,47 @@ class PttThread:
         # only self.lines is initiated in PttThreadPersist.__setstate__()
         del state['lines']
         if 'floors'  in state: del state['floors']
+        if 'endLine' in state: del state['endLine']
+        if 'urlLines' in state: del state['urlLines']
+        if 'pushes'   in state: del state['pushes']
+        if 'pushesChanged' in state: del state['pushesChanged']
         if 'atBegin' in state: del state['atBegin']
         if 'atEnd'   in state: del state['atEnd']
         if 'persistent'      in state: del state['persistent']
         if 'waitingForInput' in state: del state['waitingForInput']
+        if 'viewed'          in state: del state['viewed']
         return state
 
     # initiate attributes removed by removeForPickling() but are needed by PttThreadPersist
     def initiateUnpickled(self):
-        self.lines = []
-        self.floors = []
+        self.lines = LineStore()
+        self.floors = FloorIndex()
+        self.endLine = 0
+        self.urlLines = None
+        self.pushes = ThreadPushes()
+        self.pushesChanged = None
         if not hasattr(self, "urlLine"): self.urlLine = 0
-        if not hasattr(self, "lastFloorLine"): self.lastFloorLine = 0
 
     def loadContent(self, filename):
         try:
             with open(filename, "r", encoding="utf-8") as f:
-                self.lines = [line.rstrip("\n") for line in f.readlines()]
+                self.lines = LineStore(line.rstrip("\n") for line in f)
         except FileNotFoundError:
             return False
         else:
             self.lastLine = len(self.lines)
+            self.urlLines = None
+            self.pushesChanged = None
             print("Load from ", filename, "lines:", self.lastLine)
             return True
 
-    LINE_HOLDER = chr(0x7f)
+    LINE_HOLDER = LineStore.HOLDER
 
     def saveContent(self, filename):
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                for line in self.lines:
-                    f.write((line if line != self.LINE_HOLDER else '') + '\n')
-                print("Write", filename, "bytes", f.tell())
+            with open(filename, "wb") as f:
+                size = self.export(f.write)
+                print("Write", filename, "bytes", size)
         except Exception as e:
             traceback.print_exc()
 
@@ -87,7 +136,24 @@ class PttThread:
             self.urlLine = 0
             self.scanURL()
 
-    def view(self, lines, first: int, last: int, atEnd: bool):
+    # it's assummed the minimum screen width is 80 and line-wrap occurrs only after 78 characters
+    @staticmethod
+    def isWrapped(line: str):
+        return line[-1:] == '\\' and len(line) > 39 and (len(line) > 78 or ptt_width.width(line) > 78)
+
+    # the indexes of the lines wrapped, of which the widths are counted in a batch
+    @staticmethod
+    def wrappedRows(lines):
+        rows = [i for i, line in enumerate(lines) if line[-1:] == '\\' and len(line) > 39]
+        if not rows: return ()
+        return frozenset(i for i, width in zip(rows, ptt_width.widths([lines[i] for i in rows])) if width > 78)
+
+    def view(self, lines, first: int, last: int, atEnd: bool, rows=None):
+        '''
+        rows are the indexes of changed lines, all lines if None.
+        Only the changed lines are read if the same thread lines are viewed as the last time
+        and none is wrapped, otherwise all lines.
+        '''
         assert 0 < first <= last
         assert last - first + 1 <= len(lines)
 
@@ -97,87 +163,122 @@ class PttThread:
         if self.firstViewed == 0: self.firstViewed = time.time()
 
         if self.lastLine < last:
-            # which is better?
-            #   [self.LINE_HOLDER for _ in range(last - self.lastLine)]
-            #   self.LINE_HOLDER * (last - self.lastLine)
-            self.lines.extend(self.LINE_HOLDER * (last - self.lastLine))
-            self.floors.extend([0] * (last - self.lastLine))
+            self.lines.grow(last - self.lastLine)
+            self.floors.grow(last - self.lastLine)
             self.lastLine = last
+        if atEnd: self.endLine = last
 
 #        print("View lines:", first, last, "curr:", len(self.lines), self.lastLine)
 
+        if rows is not None and self.viewed == (first, last):
+            for i in rows:
+                if i > last - first: continue
+                line = lines[i].rstrip()
+                if self.isWrapped(line): break
+                self.setLine(first+i, line)
+            else:
+                return self.isFloorShown(last), last - first + 1
+
+        lines = [line.rstrip() for line in lines]
+        wrapped = self.wrappedRows(lines)
         i = 0
         f = first
         text = ""
         while i < len(lines) and f <= last:
-            line = lines[i].rstrip()
-            # it's assummed the minimum screen width is 80 and line-wrap occurrs only after 78 characters
-            if len(line.encode("big5uao", "replace")) > 78 and line[-1] == '\\':
+            line = lines[i]
+            if i in wrapped:
                 text += line[0:-1]
             else:
-                self.lines[f-1] = text + line
+                self.setLine(f, text + line)
 #                print("add [%d]" % f, "'%s'" % self.lines[f-1])
                 text = ""
                 f += 1
             i += 1
 
+        self.viewed = (first, last) if i == f - first and f > last else None
+
         if text and f <= last:
-            self.lines[f-1] = text
+            self.setLine(f, text)
 #            print("add [%d]" % f, "'%s'" % self.lines[f-1])
             f += 1
 
         if f <= last:
-            print("\nCaution: line wrap is probably missing!\n")
+            log.warning("Caution: line wrap is probably missing!")
 
-        self.scanFloor(first, last)
-        updateScreen = 0 < self.urlLine < last
+        updateScreen = self.isFloorShown(last)
         lastRow = i
         return updateScreen, lastRow
 
+    re_push_msg = re.compile(r"(推|噓|→) [0-9A-Za-z]+\ *:")
+
+    @classmethod
+    def isPush(cls, text: str):
+        return cls.re_push_msg.match(text) is not None
+
+    # a line captured, 1-based
+    def setLine(self, line: int, text: str):
+        self.lines[line-1] = text
+        push = self.isPush(text)
+        if self.pushesChanged is not None and (push or self.floors.isPush(line)):
+            self.pushesChanged.add(line)
+        self.floors.set(line, push)
+        if self.urlLines is not None and text.startswith("※ 文章網址:"):
+            self.urlLines.add(line-1)
+
+    # floors are shown below the URL, or from the end before the URL is captured
+    def isFloorShown(self, last: int):
+        self.scanURL()
+        return 0 < self.urlLine < last or (self.urlLine == 0 and self.endLine == self.lastLine)
+
     def floor(self, line):
         assert 1 <= line <= self.lastLine
-        # the value could be None(article), 0(reply) or positive int(floor)
-        return self.floors[line-1]
-
-    def scanFloor(self, first: int, last: int):
-#        re_floor_in_front = "(\ *?[0-9]+\ )?"
-        re_push_msg = "(推|噓|→) [0-9A-Za-z]+\ *:"
-        if not self.scanURL(): return False
-        if self.lastFloorLine:
-            floor = self.floors[self.lastFloorLine - 1]
-            line = self.lastFloorLine
-        else:
-            floor = 0
-            line = self.urlLine
-        while line < first-1:
-            if self.lines[line] == self.LINE_HOLDER: return False
-            if re.match(re_push_msg, self.lines[line]):
-                floor += 1
-                self.floors[line] = floor
-                self.lastFloorLine = line + 1
-#                print("line:", line+1, "floor:", floor)
-            line += 1
-        while line <= last-1:
-            if self.lines[line] == self.LINE_HOLDER: return False
-            if re.match(re_push_msg, self.lines[line]):
-                floor += 1
-                self.floors[line] = floor
-                self.lastFloorLine = line + 1
-#                print("(line):", line+1, "(floor):", floor)
-            line += 1
+        # the value could be None(article), 0(reply), positive int(floor) or negative int(floor from the end)
+        if 0 < self.urlLine and line <= self.urlLine: return None
+        if not self.floors.isPush(line): return 0
+        if self.urlLine and self.floors.isKnown(self.urlLine + 1, line):
+            return self.floors.count(self.urlLine + 1, line)
+        # the lines after it are captured to the end, the URL would be found if it were among them
+        if self.endLine == self.lastLine and self.floors.isKnown(line, self.lastLine):
+            return -self.floors.count(line, self.lastLine)
+        return 0
+
+    # the aggregates of the pushes captured, see ptt_pushes.summary()
+    def pushSummary(self, top=10, interval=60):
+        self.parsePushes()
+        self.pushes.updateFloors(self.floor)
+        return self.pushes.summary(top, interval)
+
+    # the push lines changed since the last time are parsed
+    def parsePushes(self):
+        self.pushes.grow(self.lastLine - len(self.pushes.rows))
+        changed = range(1, self.lastLine + 1) if self.pushesChanged is None else sorted(self.pushesChanged)
+        for line in changed:
+            if self.floors.isPush(line):
+                self.pushes.add(line, self.lines[line-1])
+            else:
+                self.pushes.discard(line)
+        self.pushesChanged = set()
 
     def text(self, first = 1, last = -1):
-#        print("text:", first, last, self.lastLine)
+        return b''.join(self.chunks(first, last)).decode()
+
+    def chunks(self, first = 1, last = -1, size = LineStore.CHUNK_SIZE):
+        '''
+        The UTF-8 text of the lines first~last in chunks of about size bytes, a negative line counts from the end.
+        A chunk ends with a whole line, so it's decoded by itself. Nothing if the range is out of the lines.
+        '''
         if first < 0: first = self.lastLine + 1 + first
         if last < 0: last = self.lastLine + 1 + last
-#        print("text:", first, last, self.lastLine)
+        if 0 < first <= last <= self.lastLine:
+            yield from self.lines.chunks(first-1, last, size)
 
-        text = ""
-        while 0 < first <= last <= self.lastLine:
-#            print("line [%d]" % first, "'%s'" % self.lines[first-1])
-            text += ((self.lines[first-1] if self.lines[first-1] != self.LINE_HOLDER else '') + '\n')
-            first += 1
-        return text
+    # writes the lines by write(), e.g. file.write, socket.sendall or StreamWriter.write, returns the bytes written
+    def export(self, write, first = 1, last = -1, size = LineStore.CHUNK_SIZE):
+        total = 0
+        for chunk in self.chunks(first, last, size):
+            write(chunk)
+            total += len(chunk)
+        return total
 
     def scanURL(self):
         if self.lastLine < 3:
@@ -185,34 +286,29 @@ class PttThread:
         if self.url and self.urlLine:
             return self.url
 
+        # the indexes of the lines of URL captured, or all lines
+        candidates = range(3, self.lastLine) if self.urlLines is None else sorted(self.urlLines)
         if self.url:
             # top-down as we are confident what the URL is
-            i = 2
-            while i < self.lastLine - 2:
-                if self.lines[i].startswith("※ 發信站: 批踢踢實業坊") and \
-                   self.lines[i+1].startswith("※ 文章網址:") and \
-                  (self.lines[i+1])[7:].strip() == self.url:
-                    self.urlLine = (i+1)+1
-                    # article lines has no floor
-                    self.floors[0:self.urlLine] = [None] * self.urlLine
-                    print("scanURL top-down", self.url, "at", self.urlLine)
+            for i in candidates:
+                if i < self.lastLine - 1 and \
+                   self.lines[i-1].startswith("※ 發信站: 批踢踢實業坊") and \
+                   self.lines[i].startswith("※ 文章網址:") and \
+                  (self.lines[i])[7:].strip() == self.url:
+                    self.urlLine = i+1
+                    log.debug("scanURL top-down %s at %d", self.url, self.urlLine)
                     return self.url
-                i += 1
         else:
             # bottom-up to try to avoid collision
-            print("scanURL bottom-up")
-            i = self.lastLine - 3
-            while i > 0:
+            log.debug("scanURL bottom-up")
+            for i in reversed(candidates):
                 # there is thread without the leading "--" line
-                if self.lines[i] == "--" and \
-                   self.lines[i+1].startswith("※ 發信站: 批踢踢實業坊") and \
-                   self.lines[i+2].startswith("※ 文章網址:"):
-                    self.url = (self.lines[i+2])[7:].strip()
-                    self.urlLine = (i+2)+1
-                    # article lines has no floor
-                    self.floors[0:self.urlLine] = [None] * self.urlLine
+                if self.lines[i-2] == "--" and \
+                   self.lines[i-1].startswith("※ 發信站: 批踢踢實業坊") and \
+                   self.lines[i].startswith("※ 文章網址:"):
+                    self.url = (self.lines[i])[7:].strip()
+                    self.urlLine = i+1
                     return self.url
-                i -= 1
 
         return None
 
@@ -240,7 +336,9 @@ class PttThread:
             aidc = self.fn2aidc(fn)
             print("board:", board, "fn:", fn, "aidc:", aidc)
         if complete:
-            print(self.text())
+            for chunk in self.chunks():
+                sys.stdout.write(chunk.decode())
+            print()
         else:
             print(self.text(1, 3))
             print(self.text(-3))
@@ -255,32 +353,36 @@ class PttThread:
 
     # deliberate to prohibit thread switch by Up/BS at the first line, or Down/Enter/Space at the last line
     # It makes little sense to me to browse thread blindly. Use those in isSwitchEvent() if desired.
+    prohibitedAtBegin = frozenset([UserEvent.Key_Up, UserEvent.Key_Backspace])
+    prohibitedAtEnd   = frozenset([UserEvent.Key_Down, UserEvent.Key_Enter, UserEvent.Key_Space])
+
     def is_prohibited(self, event: UserEvent):
         return False if self.waitingForInput else ( \
-               (event in [UserEvent.Key_Up, UserEvent.Key_Backspace] and self.atBegin) or \
-               (event in [UserEvent.Key_Down, UserEvent.Key_Enter, UserEvent.Key_Space] and self.atEnd) )
+               (self.atBegin and event in self.prohibitedAtBegin) or \
+               (self.atEnd and event in self.prohibitedAtEnd) )
+
+    updateEvents = frozenset([UserEvent.Key_Up, UserEvent.Key_Down, UserEvent.Key_Right, UserEvent.Key_Enter,
+                              UserEvent.Key_Space, UserEvent.Key_Backspace,
+                              UserEvent.Key_PgUp, UserEvent.Key_PgDn, UserEvent.Key_Home, UserEvent.Key_End] +
+                             [ord(c) for c in "$0Ggjk"])
 
     # update thread
     def isUpdateEvent(self, event: UserEvent):
-        return (event is not None) and (not self.waitingForInput) and (not self.is_prohibited(event)) and ( \
-               (event in [UserEvent.Key_Up, UserEvent.Key_Down, UserEvent.Key_Right, UserEvent.Key_Enter,
-                          UserEvent.Key_Space, UserEvent.Key_Backspace,
-                          UserEvent.Key_PgUp, UserEvent.Key_PgDn, UserEvent.Key_Home, UserEvent.Key_End]) or \
-               (chr(event) in "$0Ggjk") )
+        return (event in self.updateEvents) and (not self.waitingForInput) and (not self.is_prohibited(event))
+
+    switchEvents = frozenset([UserEvent.Key_Left] + [ord(c) for c in ("fb[]+-=tAa" + "qsQ")])
 
     # switch to board or another thread
     def isSwitchEvent(self, event: UserEvent):
-        return (event is not None) and (not self.waitingForInput) and \
-               (not self.is_prohibited(event)) and ( \
-               (event == UserEvent.Key_Left) or \
-               (event == UserEvent.Key_Right and self.atEnd) or \
-               (chr(event) in ("fb[]+-=tAa" + "qsQ")) )
+        return (event in self.switchEvents or (event == UserEvent.Key_Right and self.atEnd)) and \
+               (not self.waitingForInput) and (not self.is_prohibited(event))
 
-    def switch(self, pickler):
+    # lastViewed is now unless given, e.g. the time of a snapshot
+    def switch(self, pickler, lastViewed=None):
         if self.lastLine == 0: return False
         assert self.firstViewed > 0
 
-        self.lastViewed = time.time()
+        self.lastViewed = lastViewed or time.time()
         elapsed = self.lastViewed - self.firstViewed
         if elapsed > 0: self.elapsedTime = elapsed
 
@@ -351,6 +453,10 @@ class PttThread:
         fn    = result.group(2)
         return board, fn
 
+    @staticmethod
+    def fn2url(board, fn):
+        return f"https://www.ptt.cc/bbs/{board}/{fn}.html"
+
     ENCODE = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
     @classmethod
     def fn2aidc(cls, fn):
@@ -372,6 +478,17 @@ class PttThread:
         aidc += cls.ENCODE[lo & 0x3f]
         return aidc
 
+    # the reverse of fn2aidc()
+    @classmethod
+    def aidc2fn(cls, aidc):
+        if not re.fullmatch("[0-9A-Za-z_-]{8}", aidc): return None
+        aidu = 0
+        for c in aidc:
+            aidu = (aidu << 6) | cls.ENCODE.index(c)
+        m = aidu >> 44
+        if m > 1: return None
+        return "%s.%d.A.%03X" % ('M' if m == 0 else 'G', (aidu >> 12) & 0xffffffff, aidu & 0xfff)
+
 # A PttThread object will be sent to the persistence server through normal pickling,
 # then the object is merged to a PttThreadPersist object for persistence.
 # A PttThreadPersist object is the accumulated status of the same PttThread objects.
@@ -396,8 +513,10 @@ class PttThreadPersist(PttThread):
         return "<empty>" if len(self.lines) == 0 else super().text(first, last)
 
     def merge(self, thread):
-        self.lines = [line for line in self.mergedLines(thread.lines)]
+        self.lines = LineStore(self.mergedLines(thread.lines))
         self.lastLine = len(self.lines)
+        self.urlLines = None
+        self.pushesChanged = None
         self.url = thread.url
 
         if self.firstViewed == 0:
@@ -0,0 +1,146 @@
+import os
+import re
+import time
+import asyncio
+import traceback
+from collections import OrderedDict
+
+from ptt_thread import PttThread
+from ptt_boardlist import BoardRow
+from ptt_persist import PttPersist
+
+
+class ThreadURLCache:
+    '''
+        URLs of threads by the board and the fields of their rows in the board list which don't change,
+        i.e. the number, the date, the author and the title, but not the push count.
+
+        The rows are BoardRow parsed by BoardIndex of the term, see ptt_boardlist.py.
+        It's filled from the 'Q' boxes and the persisted archive. The threads of a board are read from the archive
+        in the background the first time the board is entered or looked up, and not found until they're read.
+        The archive has no number, so a row is found by the same number and title, or else by the only URL of
+        the same title. A title clipped at the right of the list is matched by the titles it starts.
+    '''
+
+    MAX_KEYS = 1 << 14      # (board, date, author) kept in the least recently used order
+
+    # the prefixes of a title in the list and in the article
+    titlePrefixes = [("□ ", ""), ("R: ", "Re: "), ("R:", "Re: "), ("轉 ", "Fw: ")]
+
+    def __init__(self):
+        self.entries = OrderedDict()    # (board, date, author) -> [(number, title, url)]
+        self.loaded = set()     # boards read from the archive
+        self.loading = set()    # boards being read
+        self.hits = self.misses = 0
+
+    # (number, date, author, title) of a row with the title as in the article, None if it has no URL
+    @classmethod
+    def rowFields(cls, row: BoardRow):
+        if row is None or row.deleted or not row.date or not row.author: return None
+        title = row.title
+        for prefix, replacement in cls.titlePrefixes:
+            if title.startswith(prefix):
+                title = replacement + title[len(prefix):]
+                break
+        return row.number, row.date, row.author, title
+
+    def add(self, board: str, number, date: str, author: str, title: str, url: str):
+        key = (board, date, author)
+        urls = self.entries.get(key)
+        if urls is None:
+            urls = self.entries[key] = []
+            if len(self.entries) > self.MAX_KEYS:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+            for i, (n, t, u) in enumerate(urls):
+                if u == url:
+                    # the number is known once the thread is found in the list
+                    urls[i] = (number or n, t if len(t) >= len(title) else title, url)
+                    return
+        urls.append((number, title, url))
+
+    # the URL found by a 'Q' box of the row
+    def put(self, board: str, row: BoardRow, url: str):
+        fields = self.rowFields(row)
+        if fields is None or not board: return
+        self.add(board, *fields, url)
+
+    def get(self, board: str, row: BoardRow):
+        url = self.find(board, row)
+        if url: self.hits += 1
+        else: self.misses += 1
+        return url
+
+    def find(self, board: str, row: BoardRow):
+        fields = self.rowFields(row)
+        if fields is None or not board: return None
+        number, date, author, title = fields
+        if board not in self.loaded:
+            self.load(board)
+
+        urls = self.entries.get((board, date, author))
+        if not urls: return None
+        self.entries.move_to_end((board, date, author))
+        match = (lambda t: t.startswith(title)) if row.clipped else title.__eq__
+        found = [u for n, t, u in urls if n == number and match(t)] or \
+                [u for n, t, u in urls if match(t)]
+        return found[0] if len(set(found)) == 1 else None
+
+    # the archive of a board read in the default executor, or at once without a running loop, e.g. by a tool
+    def load(self, board: str):
+        if board in self.loaded or board in self.loading: return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loaded.add(board)
+            self.addArchive(board, self.readArchive(board))
+            return
+        self.loading.add(board)
+        future = loop.run_in_executor(None, self.readArchive, board)
+        future.add_done_callback(lambda future: self.archiveRead(board, future))
+
+    def archiveRead(self, board: str, future):
+        self.loading.discard(board)
+        self.loaded.add(board)
+        if future.cancelled(): return
+        try:
+            threads = future.result()
+        except Exception:
+            traceback.print_exc()
+            return
+        self.addArchive(board, threads)
+
+    def addArchive(self, board: str, threads):
+        for date, author, title, url in threads:
+            self.add(board, None, date, author, title, url)
+
+    # the header of an article, e.g. " 作者  tester (測試者)  看板  Test", " 標題  [測試] 範例文章", " 時間  Sun Sep 13 20:26:40 2020"
+    re_author = re.compile(r"\s*作者\s+([\w-]+)")
+    re_title = re.compile(r"\s*標題\s+(\S.*?)\s*$")
+    re_time = re.compile(r"\s*時間\s+(\w{3} \w{3} +\d{1,2} [\d:]+ \d{4})")
+
+    # (date, author, title, url) of the threads of a board in the archive by their headers
+    @classmethod
+    def readArchive(cls, board: str):
+        root, names = PttPersist.getThreads(board)
+        threads = []
+        for aidc in names:
+            fn = PttThread.aidc2fn(aidc)
+            if fn is None: continue
+            try:
+                with open(os.path.join(root, aidc), "r", encoding="utf-8") as f:
+                    header = [f.readline() for _ in range(3)]
+            except (OSError, UnicodeDecodeError):
+                continue
+            author = cls.re_author.match(header[0])
+            title = cls.re_title.match(header[1])
+            posted = cls.re_time.match(header[2])
+            if not (author and title and posted): continue
+            try:
+                posted = time.strptime(posted.group(1), "%a %b %d %H:%M:%S %Y")
+            except ValueError:
+                continue
+            date = f"{posted.tm_mon}/{posted.tm_mday:02}"
+            threads.append((date, author.group(1), title.group(1), PttThread.fn2url(board, fn)))
+        return threads
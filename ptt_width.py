@@ -0,0 +1,52 @@
+from uao import register_uao
+register_uao()
+from uao.u2b import u2b_table
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+    Display widths of text on the terminal of PTT, i.e. the length of the text encoded in Big5-UAO,
+    without encoding it. A double-byte character takes 2 columns and any other character 1,
+    '?' if it's replaced.
+
+    width() looks up each character in a table of the BMP built from the table of the codec.
+    widths() takes a batch of lines, by NumPy if it's installed and the batch is large enough.
+'''
+
+def _buildTable():
+    table = bytearray(b'\x01') * 0x10000
+    for c, encoded in u2b_table.items():
+        if len(encoded) == 2: table[ord(c)] = 2
+    # the codec encodes it in UTF-8
+    table[0x80] = 2
+    return table
+
+WIDTHS = _buildTable()
+NUMPY_LINES = 16    # the lines of a batch at least for NumPy
+
+if numpy is not None:
+    _widths = numpy.frombuffer(bytes(WIDTHS) + b'\x01', dtype=numpy.uint8)
+
+def width(text: str):
+    if text.isascii(): return len(text)
+    try:
+        return sum(map(WIDTHS.__getitem__, map(ord, text)))
+    except IndexError:
+        # beyond the BMP
+        return sum(WIDTHS[c] if c < 0x10000 else 1 for c in map(ord, text))
+
+def widths(lines):
+    if numpy is None or len(lines) < NUMPY_LINES:
+        return [width(line) for line in lines]
+
+    codes = numpy.frombuffer("".join(lines).encode("utf-32-le"), dtype=numpy.uint32)
+    # beyond the BMP to the last entry of 1
+    columns = _widths[numpy.minimum(codes, 0x10000)]
+    sums = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+    numpy.cumsum(columns, out=sums[1:])
+    sizes = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=len(lines))
+    ends = numpy.cumsum(sizes)
+    return (sums[ends] - sums[ends - sizes]).tolist()
@@ -21,9 +21,11 @@ class UserEvent:
     Key_Home  = 0x107
     Key_End   = 0x108
 
+    WindowSize = 0x200  # not a key, reported by the Telnet subnegotiation NAWS
+
     @staticmethod
     def isViewable(event: int):
-        return ' ' <= chr(event) <= '~'
+        return 0x20 <= event <= 0x7e
 
     @classmethod
     def name(cls, event: int):
@@ -32,7 +34,115 @@ class UserEvent:
             return f"'{chr(event)}'"
         elif cls.Key_Up <= event <= cls.Key_End:
             return ["Up", "Down", "Right", "Left", "PgUp", "PgDn", "Home", "End"][event - cls.Key_Up]
+        elif event == cls.WindowSize:
+            return "WindowSize"
         else:
             return event.to_bytes(1, 'big')
 
 
+# Decodes a client message into a batch of key events in one pass with transition tables of VT100 and Telnet IAC sequences
+class KeyDecoder:
+
+    # states
+    GROUND = 0
+    ESC = 1
+    CSI = 2
+    NUM = 3
+    IAC = 4
+    SUB = 5
+
+    # actions other than to emit an event
+    NONE   = -1
+    DIGIT  = -2
+    TILDE  = -3
+    NAWS   = -4     # window size
+    BREAK  = -5     # stop decoding at unexpected Telnet command
+
+    # VT100 escape
+    cESC = 0x1b
+    cCSI = ord('[')
+
+    # Telnet escape
+    cIAC = 0xff
+    cSB = 0xfa
+    cNOP = 0xf1
+    cSE = 0xf0
+    cNAWS = 0x1f
+
+    # number in "ESC [ number ~"
+    vt_keys = {1: UserEvent.Key_Home, 4: UserEvent.Key_End, 5: UserEvent.Key_PgUp, 6: UserEvent.Key_PgDn,
+               7: UserEvent.Key_Home, 8: UserEvent.Key_End}
+
+    @classmethod
+    def buildTables(cls):
+        ground = [(cls.GROUND, cls.NONE)] * 256
+        for b in range(ord(' '), ord('~') + 1):
+            ground[b] = (cls.GROUND, b)
+        ground[UserEvent.Key_Backspace] = (cls.GROUND, UserEvent.Key_Backspace)
+        ground[UserEvent.Key_Enter] = (cls.GROUND, UserEvent.Key_Enter)
+        ground[cls.cESC] = (cls.ESC, cls.NONE)
+        ground[cls.cIAC] = (cls.IAC, cls.NONE)
+
+        esc = [(cls.GROUND, cls.NONE)] * 256
+        esc[cls.cCSI] = (cls.CSI, cls.NONE)
+
+        csi = [(cls.GROUND, cls.NONE)] * 256
+        for c, event in zip(b"ABCDFH", [UserEvent.Key_Up, UserEvent.Key_Down, UserEvent.Key_Right,
+                                        UserEvent.Key_Left, UserEvent.Key_End, UserEvent.Key_Home]):
+            csi[c] = (cls.GROUND, event)
+
+        num = [(cls.GROUND, cls.NONE)] * 256
+        for b in range(ord('0'), ord('9') + 1):
+            csi[b] = num[b] = (cls.NUM, cls.DIGIT)
+        num[ord('~')] = (cls.GROUND, cls.TILDE)
+
+        iac = [(cls.GROUND, cls.BREAK)] * 256
+        for b in range(cls.cSB, cls.cIAC):
+            iac[b] = (cls.SUB, cls.NONE)
+        iac[cls.cSE] = iac[cls.cNOP] = (cls.GROUND, cls.NONE)
+
+        sub = [(cls.GROUND, cls.BREAK)] * 256
+        for b in range(0, 4):
+            sub[b] = (cls.GROUND, cls.NONE)
+        sub[cls.cNAWS] = (cls.GROUND, cls.NAWS)
+
+        return (ground, esc, csi, num, iac, sub)
+
+    # a list of (event, begin, end, argument), content[begin:end] is the sequence of the event
+    @classmethod
+    def decode(cls, content: bytes):
+        tables = cls.tables
+        events = []
+        state = cls.GROUND
+        number = 0
+        begin = 0
+        n = 0
+        size = len(content)
+        while n < size:
+            b = content[n]
+            if state == cls.GROUND: begin = n
+            state, action = tables[state][b]
+            if action >= 0:
+                events.append((action, begin, n+1, None))
+            elif action == cls.NONE:
+                pass
+            elif action == cls.DIGIT:
+                number = number * 10 + (b - 0x30)
+            elif action == cls.TILDE:
+                event = cls.vt_keys.get(number)
+                if event: events.append((event, begin, n+1, None))
+            elif action == cls.NAWS:
+                if n + 4 < size:
+                    width  = (content[n+1] << 8) | content[n+2]
+                    height = (content[n+3] << 8) | content[n+4]
+                    n += 4
+                    events.append((UserEvent.WindowSize, begin, n+1, (width, height)))
+                else:
+                    break
+            else:   # BREAK
+                break
+            if state != cls.NUM: number = 0
+            n += 1
+        return events
+
+KeyDecoder.tables = KeyDecoder.buildTables()